@@ -0,0 +1,55 @@
+import os
+import json
+import pickle as pkl
+import numpy as np
+
+
+def _manifest_path(path, prefix):
+    return os.path.join(path, prefix + 'manifest.json')
+
+
+def save_arrays(path, arrays, prefix=''):
+    """
+    Save each array as an uncompressed <prefix><name>.npy file, along with a <prefix>manifest.json listing their names,
+    shapes and dtypes. The arrays can then be memory-mapped by load_array instead of being unpickled in memory
+    :param arrays: Dictionary of name -> array
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+    manifest = {}
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        np.save(os.path.join(path, prefix + name + '.npy'), array)
+        manifest[name] = {'file': prefix + name + '.npy', 'shape': list(array.shape), 'dtype': str(array.dtype)}
+    with open(_manifest_path(path, prefix), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+
+def has_arrays(path, prefix=''):
+    """ Whether path holds a complete store for prefix (the manifest is written after all the arrays)
+    """
+    return os.path.exists(_manifest_path(path, prefix))
+
+
+def array_names(path, prefix=''):
+    """ Names of the arrays stored for prefix, in the order they were saved
+    """
+    with open(_manifest_path(path, prefix)) as f:
+        return list(json.load(f).keys())
+
+
+def load_array(path, name, prefix='', mmap_mode='c'):
+    """
+    Open a stored array without reading it in memory. Datasets written before the manifest format are read from their
+    <prefix><name>.pkl pickle
+    :param mmap_mode: Memory-map mode passed to np.load. The default copy-on-write mode gives writable arrays (so that
+                      torch.from_numpy can share their memory) without ever modifying the file
+    """
+    manifest_file = _manifest_path(path, prefix)
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        if name in manifest:
+            return np.load(os.path.join(path, manifest[name]['file']), mmap_mode=mmap_mode)
+    with open(os.path.join(path, prefix + name + '.pkl'), 'rb') as f:
+        return pkl.load(f)
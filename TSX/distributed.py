@@ -0,0 +1,123 @@
+import os
+import copy
+import socket
+import tempfile
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
+from TSX.loaders import make_loader, batch_size_of
+
+
+def is_main_process():
+    """ True outside of data-parallel training, or on the rank 0 worker
+    """
+    return not (dist.is_available() and dist.is_initialized()) or dist.get_rank() == 0
+
+
+class AllReduceOptimizer:
+    """Wraps an optimizer so that gradients are averaged over all the data-parallel workers before each update
+    Floating point buffers (e.g. BatchNorm running statistics) are averaged after the update, so every worker holds
+    the same model at all times.
+    """
+
+    def __init__(self, optimizer, model):
+        self.optimizer = optimizer
+        self.model = model
+        self.world_size = dist.get_world_size()
+
+    def zero_grad(self):
+        self.optimizer.zero_grad()
+
+    def step(self):
+        for group in self.optimizer.param_groups:
+            for p in group['params']:
+                if p.grad is None:
+                    # Every worker has to take part in the same collectives
+                    p.grad = torch.zeros_like(p)
+                dist.all_reduce(p.grad.data, op=dist.ReduceOp.SUM)
+                p.grad.data /= self.world_size
+        self.optimizer.step()
+        for b in self.model.buffers():
+            if b.dtype.is_floating_point:
+                dist.all_reduce(b.data, op=dist.ReduceOp.SUM)
+                b.data /= self.world_size
+
+    def __getattr__(self, name):
+        return getattr(self.optimizer, name)
+
+
+def distributed_optimizer(optimizer, model):
+    """ Wrap the optimizer for gradient all-reduce when running inside run_data_parallel, no-op otherwise
+    """
+    if dist.is_available() and dist.is_initialized() and not isinstance(optimizer, AllReduceOptimizer):
+        return AllReduceOptimizer(optimizer, model)
+    return optimizer
+
+
+def shard_loader(loader, rank, world_size):
+    """ Same loader over the subset of the dataset assigned to this worker. All shards have the same number of batches
+    """
+    if hasattr(loader.dataset, 'shard'):
+        # Iterable datasets split their samples between the ranks themselves. Loading in the main process keeps the
+        # number of batches (and so of all-reduce steps) identical on every rank
+        return make_loader(loader.dataset.shard(rank, world_size), batch_size_of(loader), num_workers=0)
+    sampler = DistributedSampler(loader.dataset, num_replicas=world_size, rank=rank, shuffle=False)
+    if loader.batch_size is None:
+        return make_loader(loader.dataset, batch_size_of(loader), sampler=sampler)
+    return DataLoader(loader.dataset, batch_size=loader.batch_size, sampler=sampler)
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _worker(rank, world_size, port, train_fn, model, train_loader, args, kwargs, optimizer_spec, state_path, seed):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    # Workers share the random state so that sampled evaluation (e.g. generator latent samples) agrees across ranks
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    torch.set_num_threads(max(1, mp.cpu_count() // world_size))
+    # mp.spawn hands the same shared memory model to every worker, each of them needs its own copy to train
+    model = copy.deepcopy(model)
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        dist.broadcast(tensor.data, src=0)
+    if optimizer_spec is not None:
+        optimizer_class, optimizer_params = optimizer_spec
+        kwargs = dict(kwargs, optimizer=optimizer_class(model.parameters(), **optimizer_params))
+    train_fn(model, shard_loader(train_loader, rank, world_size), *args, **kwargs)
+    if rank == 0:
+        torch.save(model.state_dict(), state_path)
+    dist.barrier()
+    dist.destroy_process_group()
+
+
+def run_data_parallel(train_fn, model, train_loader, *args, n_procs=1, seed=1234, **kwargs):
+    """
+    Data-parallel training over local processes with the gloo backend
+    :param train_fn: Training function with signature train_fn(model, train_loader, ...), e.g. train_model or
+                     train_joint_feature_generator. Each worker trains on its own shard of the training set
+    :param n_procs: Number of worker processes. With a single process train_fn is simply called in place
+    :param kwargs: Keyword arguments of train_fn. An optimizer passed as optimizer=... is not shared with the workers,
+                   each worker builds an optimizer of the same class and hyperparameters over its own copy of the model
+    :return: model, holding the trained weights of rank 0
+    """
+    if n_procs <= 1:
+        train_fn(model, train_loader, *args, **kwargs)
+        return model
+    optimizer_spec = None
+    if 'optimizer' in kwargs.keys():
+        optimizer = kwargs.pop('optimizer')
+        optimizer_spec = (type(optimizer), optimizer.defaults)
+    state_path = os.path.join(tempfile.mkdtemp(), 'model.pt')
+    mp.spawn(_worker, args=(n_procs, _free_port(), train_fn, model, train_loader, args, kwargs, optimizer_spec,
+                            state_path, seed), nprocs=n_procs, join=True)
+    model.load_state_dict(torch.load(state_path))
+    os.remove(state_path)
+    return model
@@ -3,7 +3,11 @@ import os, glob
 from abc import ABC, abstractmethod
 from TSX.utils import train_model, train_model_rt, train_model_rt_rg, plot_importance, logistic, test_model_rt, test, replace_and_predict
 from TSX.models import EncoderRNN, LR, AttentionModel
-from TSX.generator import FeatureGenerator, train_joint_feature_generator, train_feature_generator, CarryForwardGenerator, DLMGenerator, JointFeatureGenerator
+from TSX.sample_store import CounterfactualStore
+from TSX.array_store import load_array
+from TSX.loaders import dataset_signals, dataset_labels
+from TSX.generator import FeatureGenerator, train_joint_feature_generator, train_feature_generator, CarryForwardGenerator, DLMGenerator, JointFeatureGenerator, \
+    MultiHeadFeatureGenerator, train_multihead_feature_generator
 import seaborn as sns
 sns.set()
 import matplotlib.colors as mcolors
@@ -232,8 +236,7 @@ class BaselineExplainer(Experiment):
 
     def run(self, train, n_epochs, samples_to_analyze):
         self.train(n_epochs=n_epochs, learn_rt=self.data=='ghg')
-        testset = list(self.test_loader.dataset)
-        test_signals = torch.stack(([x[0] for x in testset])).to(self.device)
+        test_signals = dataset_signals(self.test_loader.dataset).to(self.device)
         matrix_test_dataset = test_signals.cpu().numpy()
         explanation = []
         exec_time = []
@@ -250,8 +253,7 @@ class BaselineExplainer(Experiment):
         return explanation
 
     def train(self, n_epochs, learn_rt=False):
-        trainset = list(self.train_loader.dataset)
-        signals = torch.stack(([x[0] for x in trainset])).to(self.device)
+        signals = dataset_signals(self.train_loader.dataset).to(self.device)
         matrix_train_dataset = signals.mean(dim=2).cpu().numpy()
         if self.baseline_method == 'lime':
             self.explainer = lime.lime_tabular.LimeTabularExplainer(matrix_train_dataset, feature_names=self.feature_map+['gender', 'age', 'ethnicity', 'first_icu_stay'], discretize_continuous=True)
@@ -263,9 +265,14 @@ class FeatureGeneratorExplainer(Experiment):
     def __init__(self,  train_loader, valid_loader, test_loader, feature_size, patient_data, output_path, generator_hidden_size=80, prediction_size=1, generator_type='RNN_generator', predictor_model='RNN', experiment='feature_generator_explainer', data='mimic', conditional=True,**kwargs):
         super(FeatureGeneratorExplainer, self).__init__(train_loader, valid_loader, test_loader, data)
         self.generator_type = generator_type
+        self.historical = kwargs['historical'] if 'historical' in kwargs.keys() else True
+        self.cv = kwargs['cv'] if 'cv' in kwargs.keys() else 0
         if self.generator_type == 'RNN_generator':
             self.generator = FeatureGenerator(feature_size, hidden_size=generator_hidden_size, prediction_size=prediction_size,data=data,conditional=conditional).to(self.device)
             self.conditional=conditional
+        elif self.generator_type == 'multihead_RNN_generator':
+            self.generator = MultiHeadFeatureGenerator(feature_size, hist=self.historical, hidden_size=generator_hidden_size, prediction_size=prediction_size,data=data,conditional=conditional).to(self.device)
+            self.conditional=conditional
         elif self.generator_type == 'carry_forward_generator':
             self.generator = CarryForwardGenerator(feature_size).to(self.device)
         elif 'joint_RNN_generator' in self.generator_type :
@@ -290,16 +297,16 @@ class FeatureGeneratorExplainer(Experiment):
         self.output_path = os.path.join(output_path, data)
         if not os.path.exists(self.output_path):
             os.mkdir(self.output_path)
-        if self.generator_type!='RNN_generator':
+        if self.generator_type!='RNN_generator' and self.generator_type!='multihead_RNN_generator':
             self.conditional=None
 
         #this is used to see the difference between true risk vs learned risk for simulations
         self.learned_risk = True
-        trainset = list(self.train_loader.dataset)
-        self.feature_dist = torch.stack([x[0] for x in trainset])
+        self.feature_dist = dataset_signals(self.train_loader.dataset)
         if self.data == 'mimic':
-            self.feature_dist_0 = torch.stack([x[0] for x in trainset if x[1]==0])
-            self.feature_dist_1 = torch.stack([x[0] for x in trainset if x[1]==1])
+            train_labels = dataset_labels(self.train_loader.dataset).reshape(len(self.feature_dist), -1)[:, 0]
+            self.feature_dist_0 = self.feature_dist[train_labels==0]
+            self.feature_dist_1 = self.feature_dist[train_labels==1]
         else:
             self.feature_dist_0=self.feature_dist
             self.feature_dist_1=self.feature_dist
@@ -357,7 +364,7 @@ class FeatureGeneratorExplainer(Experiment):
                 _, _, _, auc,  _ = test_model_rt(self.risk_predictor, self.test_loader)
         print("\n ** Risk predictor model AUC:%.2f"%(auc))
 
-        testset = list(self.test_loader.dataset)
+        testset = self.test_loader.dataset
         if 'simulation' in self.data:
             if self.data=='simulation_spike':
                 with open(os.path.join('./data/simulated_spike_data/thresholds_test.pkl'), 'rb') as f:
@@ -365,17 +372,16 @@ class FeatureGeneratorExplainer(Experiment):
                 with open(os.path.join('./data/simulated_spike_data/gt_test.pkl'), 'rb') as f:
                     gt_importance = pkl.load(f)
             else:
-                with open(os.path.join('./data/simulated_data/state_dataset_importance_test.pkl'),'rb') as f:
-                    gt_importance = pkl.load(f)
+                gt_importance = load_array('./data/simulated_data', 'importance_test', prefix='state_dataset_')
 
             #For simulated data this is the last entry - end of 48 hours that's the actual outcome
-            label = np.array([x[1][-1] for x in testset])
+            label = dataset_labels(testset)[:, -1].numpy()
             high_risk = np.where(label==1)[0]
             if len(samples_to_analyze)==0:
                 samples_to_analyze = np.random.choice(range(len(label)), len(label), replace=False)
         else:
             if self.data=='ghg':
-                label = np.array([x[1][-1] for x in testset])
+                label = dataset_labels(testset)[:, -1].numpy()
                 high_risk = np.arange(label.shape[0])
                 samples_to_analyze = np.random.choice(high_risk, len(high_risk), replace=False)
 
@@ -400,12 +406,11 @@ class FeatureGeneratorExplainer(Experiment):
                 if not os.path.exists(os.path.join('./examples',self.data)):
                     os.mkdir(os.path.join('./examples',self.data))
 
-                testset = list(self.test_loader.dataset)
+                testset = self.test_loader.dataset
                 signals, label_o = testset[sample_ID]
                 if self.data=='mimic':
                     print('Did this patient die? ', {1: 'yes', 0: 'no'}[label_o.item()])
-                self.generator.load_state_dict(
-                    torch.load(os.path.join('./ckpt/%s/%s.pt' % (self.data, self.generator_type))))
+                self.generator.load_state_dict(torch.load(os.path.join(self.ckpt_path, self.generator_ckpt_name())))
 
                 tvec = range(1, signals.shape[-1])
                 imps= np.zeros((len(sub_features), signals.shape[-1]-1))#[]
@@ -428,7 +433,7 @@ class FeatureGeneratorExplainer(Experiment):
 
         """
         print('running for ', len(samples_to_analyze))
-        testset = list(self.test_loader.dataset)
+        testset = self.test_loader.dataset
         cv = kwargs['cv'] if 'cv' in kwargs.keys() else 0
         if train and self.generator_type!='carry_forward_generator':
            self.train(n_features=self.timeseries_feature_size, n_epochs=n_epochs)
@@ -466,12 +471,11 @@ class FeatureGeneratorExplainer(Experiment):
                         gt_importance = pkl.load(f)#Type dmesg and check the last few lines of output. If the disc or the connection to it is failing, it'll be noted there.load(f)
                         #print(gt_importance)
                 else:
-                    with open(os.path.join('./data/simulated_data/state_dataset_importance_test.pkl'),'rb') as f:
-                        gt_importance = pkl.load(f)
+                    gt_importance = load_array('./data/simulated_data', 'importance_test', prefix='state_dataset_')
 
 
                 #For simulated data this is the last entry - end of 48 hours that's the actual outcome
-                label = np.array([x[1][-1] for x in testset])
+                label = dataset_labels(testset)[:, -1].numpy()
                 #print(label)
                 high_risk = np.where(label==1)[0]
                 if len(samples_to_analyze)==0:
@@ -482,16 +486,16 @@ class FeatureGeneratorExplainer(Experiment):
                 # if self.data=='mimic':
                     # samples_to_analyse = MIMIC_TEST_SAMPLES
                 if self.data=='ghg':
-                    label = np.array([x[1][-1] for x in testset])
+                    label = dataset_labels(testset)[:, -1].numpy()
                     high_risk = np.arange(label.shape[0])
                     samples_to_analyze = np.random.choice(high_risk, len(high_risk), replace=False)
 
             ## Sensitivity analysis as a baseline
-            signal = torch.stack([testset[sample][0] for sample in samples_to_analyze])
+            signal = dataset_signals(testset)[np.asarray(samples_to_analyze)]
 
             #Some setting up for ghg data
             if self.data=='ghg':
-                label_tch = torch.stack([testset[sample][1] for sample in samples_to_analyze])
+                label_tch = dataset_labels(testset)[np.asarray(samples_to_analyze)]
                 signal_scaled = self.patient_data.scaler_x.inverse_transform(np.reshape(signal.cpu().detach().numpy(),[len(samples_to_analyze),-1]))
                 tvec = list(range(1,signal.shape[2]+1,50))
             else:
@@ -618,11 +622,22 @@ class FeatureGeneratorExplainer(Experiment):
                         json.dump(importance_labels, f)
         return np.array(all_FIT_importance), np.array(all_AFO_importance), np.array(all_FO_importance), np.array(all_lime_importance), sensitivity_analysis
 
+    def generator_ckpt_name(self):
+        """ File name of the checkpoint of a generator that models every feature. Joint generators are saved per cv
+        fold as <generator_type>_<cv>.pt, and multi-head generators without history as <generator_type>_nohist.pt
+        """
+        if 'joint' in self.generator_type:
+            return '%s_%d.pt' % (self.generator_type, self.cv)
+        return '%s%s.pt' % (self.generator_type, '' if getattr(self.generator, 'hist', True) else '_nohist')
+
     def train(self, n_epochs, n_features):
         train_start_time = time.time()
         if 'joint' in self.generator_type:
             train_joint_feature_generator(self.generator, self.train_loader, self.valid_loader,
-                                          generator_type=self.generator_type, n_epochs=n_epochs)
+                                          generator_type=self.generator_type, n_epochs=n_epochs, cv=self.cv)
+        elif 'multihead' in self.generator_type:
+            train_multihead_feature_generator(self.generator, self.train_loader, self.valid_loader,
+                                              generator_type=self.generator_type, n_epochs=n_epochs)
         else:
             for feature_to_predict in range(0, n_features):
                 print('**** training to sample feature: ', feature_to_predict)
@@ -647,7 +662,7 @@ class FeatureGeneratorExplainer(Experiment):
         if not os.path.exists(os.path.join('./examples',data)):
             os.mkdir(os.path.join('./examples',data))
 
-        testset = list(self.test_loader.dataset)
+        testset = self.test_loader.dataset
         signals, label_o = testset[subject]
         if data=='mimic':
             print('Did this patient die? ', {1: 'yes', 0: 'no'}[label_o.item()])
@@ -668,25 +683,26 @@ class FeatureGeneratorExplainer(Experiment):
         FO_exe_time = []
         FIT_exe_time = []
 
+        # Generators that model every feature are loaded once, per-feature generators are loaded in the loop
+        single_ckpt = 'joint' in self.generator_type or 'multihead' in self.generator_type
+        if single_ckpt:
+            self.generator.load_state_dict(torch.load(os.path.join(self.ckpt_path, self.generator_ckpt_name())))
+
         for i, sig_ind in enumerate(signals_to_analyze):
 
-            if not self.generator_type=='carry_forward_generator':
-                if 'joint' in self.generator_type:
+            if not self.generator_type=='carry_forward_generator' and not single_ckpt:
+                if data=='mimic':
                     self.generator.load_state_dict(
-                        torch.load(os.path.join('./ckpt/%s/%s.pt'%(self.data, self.generator_type))))
-                else:
-                    if data=='mimic':
-                        self.generator.load_state_dict(
-                        torch.load(os.path.join(self.ckpt_path,'%s_%s.pt' % (feature_map_mimic[sig_ind], self.generator_type))))
-                    elif data=='simulation':
-                        self.generator.load_state_dict(
-                        torch.load(os.path.join(self.ckpt_path,'%s_%s.pt' % (str(sig_ind), self.generator_type))))
-                    elif data=='ghg':
-                        self.generator.load_state_dict(
-                        torch.load(os.path.join(self.ckpt_path,'%s_%s.pt' % (str(sig_ind),self.generator_type))))
+                    torch.load(os.path.join(self.ckpt_path,'%s_%s.pt' % (feature_map_mimic[sig_ind], self.generator_type))))
+                elif data=='simulation':
+                    self.generator.load_state_dict(
+                    torch.load(os.path.join(self.ckpt_path,'%s_%s.pt' % (str(sig_ind), self.generator_type))))
+                elif data=='ghg':
+                    self.generator.load_state_dict(
+                    torch.load(os.path.join(self.ckpt_path,'%s_%s.pt' % (str(sig_ind),self.generator_type))))
 
             t0 = time.time()
-            label, importance[i,:] = self._get_feature_importance_FIT( signals, sig_ind=[sig_ind], n_samples=10, learned_risk=self.learned_risk)
+            label, importance[i,:] = self._get_feature_importance_FIT( signals, sig_ind=[sig_ind], n_samples=10, learned_risk=self.learned_risk, sample_id=subject)
             t1 = time.time()
             FIT_exe_time.append(t1-t0)
 
@@ -749,7 +765,43 @@ class FeatureGeneratorExplainer(Experiment):
                         data, gt_importance_subj, os.path.join(self.output_path,self.predictor_model), self.patient_data)
         return max_imp_FCC, importance, max_imp_occ, importance_occ, max_imp_occ_aug, importance_occ_aug, max_imp_sen, sensitivity_analysis_importance
 
-    def _get_feature_importance_FIT(self, signal, sig_ind, n_samples=10, learned_risk=True, tvec=None, at_time=None, conditional=False):
+    def enable_sample_store(self, seed, root='./ckpt/counterfactuals'):
+        """ Reuse generator samples across runs through a CounterfactualStore keyed by the generator checkpoint and seed
+        """
+        self.store_config = {'seed': seed, 'root': root}
+        self.sample_stores = {}
+
+    def _generator_samples(self, signal, t, sig_ind, n_samples, conditional, sample_id=None):
+        """ n_samples draws of the observation at t for a single signal [features, time]. Shape:[n_samples, features]
+        """
+        store = None
+        store_config = getattr(self, 'store_config', None)
+        if store_config is not None and sample_id is not None and len(sig_ind) == 1:
+            key = (n_samples, conditional)
+            if key not in self.sample_stores:
+                self.sample_stores[key] = CounterfactualStore(self.generator, store_config['seed'], n_samples,
+                                                              root=store_config['root'],
+                                                              tag='conditional' if conditional else 'joint')
+            store = self.sample_stores[key]
+            stored = store.get([sample_id], t, sig_ind[0])
+            if stored is not None:
+                return torch.Tensor(stored[:, 0])
+        samples = []
+        for _ in range(n_samples):
+            if conditional:
+                x_hat_t = self.generator.forward_conditional(signal[:, :t].unsqueeze(0), signal[:, t], [i for i in range(len(signal)) if i!=sig_ind])
+                if isinstance(x_hat_t, tuple):
+                    x_hat_t = x_hat_t[0]
+            else:
+                x_hat_t = self.generator.forward_joint(signal[:, max(0,t-5):t].unsqueeze(0))
+            samples.append(x_hat_t.view(-1).detach().cpu())
+        samples = torch.stack(samples)
+        if store is not None:
+            store.put([sample_id], t, sig_ind[0], samples.numpy()[:, None], t_len=signal.shape[-1])
+            store.flush()
+        return samples
+
+    def _get_feature_importance_FIT(self, signal, sig_ind, n_samples=10, learned_risk=True, tvec=None, at_time=None, conditional=False, sample_id=None):
         self.generator.eval()
         risks = []
         importance_FIT = []
@@ -767,14 +819,13 @@ class FeatureGeneratorExplainer(Experiment):
                     risk = self.risk_predictor(signal[:,0:t+self.generator.prediction_size].view(1, signal.shape[0], t+self.generator.prediction_size)).item()
 
                 generator_predicted_risks = []
-                for _ in range(n_samples):
+                x_hat_ts = self._generator_samples(signal, t, sig_ind, n_samples, conditional, sample_id)
+                for x_hat_t in x_hat_ts:
                     predicted_signal_FIT = signal[:,0:t+1].clone()
                     if conditional:
-                        x_hat_t = self.generator.forward_conditional(signal[:, :t].unsqueeze(0), signal[:, t], [i for i in range(len(signal)) if i!=sig_ind])
                         predicted_signal_FIT[:, t] = x_hat_t
                     else:
-                        x_hat_t = self.generator.forward_joint(signal[:, max(0,t-5):t].unsqueeze(0))
-                        predicted_signal_FIT[:,t][sig_ind] = x_hat_t[0, sig_ind].detach().cpu()
+                        predicted_signal_FIT[:,t][sig_ind] = x_hat_t[sig_ind]
 
                     if 'simulation' in self.data and not learned_risk:
                         predicted_risk_FIT = self.risk_predictor(predicted_signal_FIT.cpu().detach().numpy(), t)
@@ -11,6 +11,9 @@ from sklearn.metrics import roc_auc_score, average_precision_score
 from tqdm import tnrange, tqdm_notebook
 import matplotlib.pyplot as plt
 from TSX.generator import train_joint_feature_generator, JointDistributionGenerator
+from TSX.distributed import run_data_parallel
+from TSX.sample_store import CounterfactualStore
+from TSX.loaders import dataset_signals
 from captum.attr import IntegratedGradients, DeepLift, GradientShap, Saliency
 import lime
 import lime.lime_tabular
@@ -34,6 +37,43 @@ def kl_multilabel(p1,p2,reduction='none'):
     return total_kl
 
 
+def _fit_divergence(p_y_t, p_tm1, y_hat_t, activation, distance_metric='kl'):
+    """ Per-sample FIT divergence of a counterfactual prediction y_hat_t, as computed in FITExplainer.attribute
+    """
+    if distance_metric == 'kl':
+        if type(activation).__name__==type(torch.nn.Softmax(-1)).__name__:
+            div = torch.sum(torch.nn.KLDivLoss(reduction='none')(torch.log(p_tm1), p_y_t), -1) - \
+                  torch.sum(torch.nn.KLDivLoss(reduction='none')(torch.log(y_hat_t), p_y_t), -1)
+        else:
+            div, _ = torch.max(kl_multilabel(p_y_t, p_tm1) - kl_multilabel(p_y_t, y_hat_t), dim=1)
+        return div.cpu().detach().numpy()
+    elif distance_metric == 'mean_divergence':
+        return np.mean(torch.abs(y_hat_t - p_y_t).detach().cpu().numpy(), -1)
+    raise ValueError('%s distance metric not supported for streaming' % distance_metric)
+
+
+def _fit_score(E_div, distance_metric='kl'):
+    if distance_metric == 'kl':
+        return 2./(1+np.exp(-5*E_div)) - 1
+    return 1-E_div
+
+
+def _map_state(fn, state):
+    """ Apply fn to every tensor of a (possibly nested) recurrent state, e.g. the (h, c) tuple of an LSTM
+    """
+    if isinstance(state, (tuple, list)):
+        return tuple(_map_state(fn, s) for s in state)
+    return fn(state)
+
+
+def _zip_state(fn, state, other):
+    if isinstance(state, (tuple, list)):
+        for s, o in zip(state, other):
+            _zip_state(fn, s, o)
+    else:
+        fn(state, other)
+
+
 class FITExplainer:
     def __init__(self, model, generator=None,activation=torch.nn.Softmax(-1),n_classes=2):
         self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -41,17 +81,50 @@ class FITExplainer:
         self.base_model = model.to(self.device)
         self.activation = activation
         self.n_classes=n_classes
+        self.store_config = None
+        self.sample_stores = {}
 
-    def fit_generator(self, generator_model, train_loader, test_loader, n_epochs=300,cv=0):
-        train_joint_feature_generator(generator_model, train_loader, test_loader, generator_type='joint_generator',
-                                      n_epochs=300, lr=0.001, weight_decay=0,cv=cv)
+    def enable_sample_store(self, seed, root='./ckpt/counterfactuals'):
+        """ Read and write generator samples from a CounterfactualStore keyed by the generator checkpoint and seed.
+        Only used when attribute is given the test set indices of the batch. The caller seeds torch with seed
+        before drawing the samples
+        """
+        self.store_config = {'seed': seed, 'root': root}
+        self.sample_stores = {}
+
+    def _conditional_samples(self, x, t, i, n_samples, sample_ids=None):
+        """ n_samples draws of x_t from the generator, conditioned on x_{i,t} and the history. Shape:[n_samples, batch, features]
+        """
+        store = None
+        if self.store_config is not None and sample_ids is not None:
+            if n_samples not in self.sample_stores:
+                self.sample_stores[n_samples] = CounterfactualStore(self.generator, self.store_config['seed'], n_samples,
+                                                                    root=self.store_config['root'], tag='fit')
+            store = self.sample_stores[n_samples]
+            stored = store.get(sample_ids, t, i)
+            if stored is not None:
+                return torch.Tensor(stored).to(self.device)
+        samples = torch.stack([self.generator.forward_conditional(x[:, :, :t], x[:, :, t], [i])[0]
+                               for _ in range(n_samples)])
+        if store is not None:
+            store.put(sample_ids, t, i, samples.detach().cpu().numpy(), t_len=x.shape[-1])
+        return samples
+
+    def fit_generator(self, generator_model, train_loader, test_loader, n_epochs=300,cv=0,teacher_forcing=False,
+                      patience=20, eval_every=1, train_eval_fraction=0.2, n_procs=1):
+        run_data_parallel(train_joint_feature_generator, generator_model, train_loader, test_loader,
+                          generator_type='joint_generator', n_epochs=n_epochs, lr=0.001, weight_decay=0,cv=cv,
+                          teacher_forcing=teacher_forcing, patience=patience, eval_every=eval_every,
+                          train_eval_fraction=train_eval_fraction, n_procs=n_procs)
         self.generator = generator_model.to(self.device)
+        self.sample_stores = {}
 
-    def attribute(self, x, y, n_samples=10, retrospective=False, distance_metric='kl',subsets=None):
+    def attribute(self, x, y, n_samples=10, retrospective=False, distance_metric='kl',subsets=None, sample_ids=None):
         """
         Compute importance score for a sample x, over time and features
         :param x: Sample instance to evaluate score for. Shape:[batch, features, time]
         :param n_samples: number of Monte-Carlo samples
+        :param sample_ids: Test set indices of the batch, used to reuse stored generator samples (see enable_sample_store)
         :return: Importance score matrix of shape:[batch, features, time]
         """
         self.generator.eval()
@@ -72,8 +145,8 @@ class FITExplainer:
                 div_all=[]
                 t1_all=[]
                 t2_all=[]
-                for _ in range(n_samples):
-                    x_hat_t, _ = self.generator.forward_conditional(x[:, :, :t], x[:, :, t], [i])
+                x_hat_ts = self._conditional_samples(x, t, i, n_samples, sample_ids)
+                for x_hat_t in x_hat_ts:
                     x_hat[:, :, t] = x_hat_t
                     y_hat_t = self.activation(self.base_model(x_hat))
                     if distance_metric == 'kl':
@@ -106,6 +179,167 @@ class FITExplainer:
                     score[:, i, t] = 1-E_div
                 else:
                     score[:, i, t] = E_div
+        for store in self.sample_stores.values():
+            store.flush()
+        return score
+
+
+class StreamingFIT:
+    def __init__(self, model, generator, activation=torch.nn.Softmax(-1), n_samples=10, distance_metric='kl'):
+        """
+        Online version of FITExplainer.attribute for streams that receive one observation at a time. The classifier
+        state, the generator GRU state and the previous predictive distribution are kept between updates, so the
+        cost of an update does not grow with the length of the stream.
+        :param model: Black-box model exposing forward_step(x_t, past_state)
+        :param generator: JointFeatureGenerator exposing forward_step and forward_conditional_step
+        """
+        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.base_model = model.to(self.device)
+        self.generator = generator.to(self.device)
+        self.activation = activation
+        self.n_samples = n_samples
+        self.distance_metric = distance_metric
+        self.reset()
+
+    def reset(self):
+        """ Start a new stream (e.g. a new batch of patients)
+        """
+        self.model_state = None
+        self.generator_state = None
+        self.p_prev = None
+        self.t = 0
+
+    def update(self, x_t):
+        """
+        Add the observation at the next time step and compute its importance
+        :param x_t: New observation. Shape:[batch, features]
+        :return: Importance of each feature of the new observation. Shape:[batch, features]
+        """
+        self.base_model.eval()
+        self.generator.eval()
+        x_t = x_t.to(self.device)
+        score = np.zeros(list(x_t.shape))
+        with torch.no_grad():
+            logits, model_state = self.base_model.forward_step(x_t, self.model_state)
+            p_y_t = self.activation(logits)
+            if self.t > 0:
+                for i in range(x_t.shape[1]):
+                    div_all = []
+                    for _ in range(self.n_samples):
+                        x_hat_t, _ = self.generator.forward_conditional_step(self.generator_state, x_t, [i])
+                        y_hat_t = self.activation(self.base_model.forward_step(x_hat_t, self.model_state)[0])
+                        div_all.append(_fit_divergence(p_y_t, self.p_prev, y_hat_t, self.activation,
+                                                       self.distance_metric))
+                    score[:, i] = _fit_score(np.mean(np.array(div_all), axis=0), self.distance_metric)
+            self.generator_state = self.generator.forward_step(x_t, self.generator_state)
+        self.model_state = model_state
+        self.p_prev = p_y_t
+        self.t += 1
+        return score
+
+
+class FITSessionManager:
+    def __init__(self, model, generator, capacity, activation=torch.nn.Softmax(-1), n_samples=10, distance_metric='kl'):
+        """
+        Streaming FIT for many concurrent streams (e.g. all patients of an ICU). The recurrent states of the black-box
+        model and of the generator, and the previous predictive distribution of every admitted patient, live in
+        preallocated tensor pools indexed by slot. All patients that received an observation in a tick are advanced
+        together in one batched step.
+        :param model: Recurrent black-box model exposing forward_step (e.g. StateClassifier)
+        :param generator: JointFeatureGenerator
+        :param capacity: Maximum number of concurrent streams
+        """
+        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.base_model = model.to(self.device)
+        self.generator = generator.to(self.device)
+        self.activation = activation
+        self.n_samples = n_samples
+        self.distance_metric = distance_metric
+        self.capacity = capacity
+        self.slots = {}
+        self.free_slots = list(range(capacity))[::-1]
+        self.n_observed = torch.zeros(capacity, dtype=torch.long).to(self.device)
+        # Pools are allocated on the first tick, once the shape of the states is known
+        self.model_pool = None
+        self.generator_pool = None
+        self.p_prev = None
+
+    def admit(self, patient_id):
+        if patient_id in self.slots:
+            return self.slots[patient_id]
+        if len(self.free_slots) == 0:
+            raise RuntimeError('No free slot left in the session pool (capacity: %d)' % self.capacity)
+        slot = self.free_slots.pop()
+        self.slots[patient_id] = slot
+        return slot
+
+    def discharge(self, patient_id):
+        """ Evict a patient and reset its slot so it can be reused
+        """
+        slot = self.slots.pop(patient_id)
+        if self.model_pool is not None:
+            _map_state(lambda s: s[:, slot].zero_(), self.model_pool)
+            self.generator_pool[:, slot].zero_()
+            self.p_prev[slot].zero_()
+        self.n_observed[slot] = 0
+        self.free_slots.append(slot)
+
+    def _allocate(self, model_state, generator_state, p_y_t):
+        self.model_pool = _map_state(lambda s: torch.zeros([s.shape[0], self.capacity] + list(s.shape[2:])).to(self.device),
+                                     model_state)
+        self.generator_pool = torch.zeros([generator_state.shape[0], self.capacity] +
+                                          list(generator_state.shape[2:])).to(self.device)
+        self.p_prev = torch.zeros([self.capacity] + list(p_y_t.shape[1:])).to(self.device)
+
+    def tick(self, patient_ids, x_t):
+        """
+        Advance the streams of the patients that received a new observation. Unknown patients are admitted
+        :param patient_ids: Patients with a new observation in this tick, each at most once
+        :param x_t: New observations, in the order of patient_ids. Shape:[len(patient_ids), features]
+        :return: Importance of each feature of the new observations. Shape:[len(patient_ids), features]
+        """
+        # The states of all the patients are advanced in one step, so a patient can only be observed once per tick
+        if len(set(patient_ids)) != len(patient_ids):
+            duplicates = sorted(set(p for p in patient_ids if list(patient_ids).count(p) > 1), key=str)
+            raise ValueError('Patients observed more than once in a tick: %s' % ', '.join(str(p) for p in duplicates))
+        self.base_model.eval()
+        self.generator.eval()
+        x_t = x_t.to(self.device)
+        slots = torch.LongTensor([self.admit(p) for p in patient_ids]).to(self.device)
+        score = np.zeros(list(x_t.shape))
+        with torch.no_grad():
+            if self.model_pool is None:
+                model_past, generator_past = None, None
+            else:
+                model_past = _map_state(lambda s: s.index_select(1, slots), self.model_pool)
+                generator_past = self.generator_pool.index_select(1, slots)
+            logits, model_state = self.base_model.forward_step(x_t, model_past)
+            p_y_t = self.activation(logits)
+
+            active = (self.n_observed[slots] > 0).nonzero().view(-1)
+            if len(active) > 0:
+                # Counterfactuals of all active patients and Monte-Carlo samples go through the models in one batch
+                n_active = len(active)
+                repeat = lambda s: s.index_select(1, active).repeat(*([1, self.n_samples] + [1]*(s.dim()-2)))
+                model_past_rep = _map_state(repeat, model_past)
+                generator_past_rep = repeat(generator_past)
+                x_rep = x_t[active].repeat(self.n_samples, 1)
+                p_y_rep = p_y_t[active].repeat(self.n_samples, 1)
+                p_tm1_rep = self.p_prev[slots[active]].repeat(self.n_samples, 1)
+                for i in range(x_t.shape[1]):
+                    x_hat_t, _ = self.generator.forward_conditional_step(generator_past_rep, x_rep, [i])
+                    y_hat_t = self.activation(self.base_model.forward_step(x_hat_t, model_past_rep)[0])
+                    div = _fit_divergence(p_y_rep, p_tm1_rep, y_hat_t, self.activation, self.distance_metric)
+                    E_div = div.reshape(self.n_samples, n_active).mean(0)
+                    score[active.cpu().numpy(), i] = _fit_score(E_div, self.distance_metric)
+
+            generator_state = self.generator.forward_step(x_t, generator_past)
+            if self.model_pool is None:
+                self._allocate(model_state, generator_state, p_y_t)
+            _zip_state(lambda pool, s: pool.index_copy_(1, slots, s), self.model_pool, model_state)
+            self.generator_pool.index_copy_(1, slots, generator_state)
+            self.p_prev.index_copy_(0, slots, p_y_t)
+            self.n_observed[slots] += 1
         return score
 
 
@@ -116,8 +350,9 @@ class FFCExplainer:
         self.base_model = model.to(self.device)
         self.activation = activation
 
-    def fit_generator(self, generator_model, train_loader, test_loader, n_epochs=300):
-        train_joint_feature_generator(generator_model, train_loader, test_loader, generator_type='joint_generator', n_epochs=n_epochs)
+    def fit_generator(self, generator_model, train_loader, test_loader, n_epochs=300, patience=20, cv=0):
+        train_joint_feature_generator(generator_model, train_loader, test_loader, generator_type='joint_generator',
+                                      n_epochs=n_epochs, patience=patience, cv=cv)
         self.generator = generator_model.to(self.device)
 
     def attribute(self, x, y, n_samples=10, retrospective=False):
@@ -197,8 +432,7 @@ class AFOExplainer:
     def __init__(self, model, train_loader,activation=torch.nn.Softmax(-1)):
         self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
         self.base_model = model.to(self.device)
-        trainset = list(train_loader.dataset)
-        self.data_distribution = torch.stack([x[0] for x in trainset])
+        self.data_distribution = dataset_signals(train_loader.dataset)
         self.activation = activation
 
     def attribute(self, x, y, retrospective=False):
@@ -238,8 +472,7 @@ class MeanImpExplainer:
     def __init__(self, model, train_loader):
         self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
         self.base_model = model.to(self.device)
-        trainset = list(train_loader.dataset)
-        self.data_distribution = torch.stack([x[0] for x in trainset])
+        self.data_distribution = dataset_signals(train_loader.dataset)
 
     def attribute(self, x, y, retrospective=False):
         """
@@ -274,7 +507,6 @@ class CarryForwardExplainer:
     def __init__(self, model, train_loader):
         self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
         self.base_model = model.to(self.device)
-        trainset = list(train_loader.dataset)
 
     def attribute(self, x, y, retrospective=False):
         """
@@ -638,8 +870,7 @@ class SHAPExplainer:
         model.to(self.device)
         self.base_model = model
         self.base_model.device=self.device
-        trainset = list(train_loader.dataset)
-        x_train = torch.stack([x[0] for x in trainset])
+        x_train = dataset_signals(train_loader.dataset)
         background = x_train[np.random.choice(np.arange(len(x_train)), 100, replace=False)]
         self.explainer = shap.DeepExplainer(self.base_model, background.to(self.device))
 
@@ -660,9 +891,8 @@ class LIMExplainer:
         self.device = 'cuda' #if torch.cuda.is_available() else 'cpu'
         self.base_model = model
         self.base_model.device = self.device
-        trainset = list(train_loader.dataset)
         self.activation = activation
-        x_train = torch.stack([x[0] for x in trainset]).to(self.device)
+        x_train = dataset_signals(train_loader.dataset).to(self.device)
         x_train = x_train[torch.arange(len(x_train)), :, torch.randint(5,x_train.shape[-1], (len(x_train),))]
         self.explainer = lime.lime_tabular.LimeTabularExplainer(x_train.cpu().numpy(), feature_names = ['f%d'%c for c in range(x_train.shape[1])],
                                                                 discretize_continuous=True)
@@ -712,9 +942,9 @@ class FITSubGroupExplainer:
         self.base_model = model.to(self.device)
         self.activation = activation
 
-    def fit_generator(self, generator_model, train_loader, test_loader, n_epochs=300):
+    def fit_generator(self, generator_model, train_loader, test_loader, n_epochs=300, patience=20, cv=0):
         train_joint_feature_generator(generator_model, train_loader, test_loader, generator_type='joint_generator',
-                                      n_epochs=300, lr=0.001, weight_decay=0)
+                                      n_epochs=n_epochs, lr=0.001, weight_decay=0, patience=patience, cv=cv)
         self.generator = generator_model.to(self.device)
 
     def attribute(self, x, y, n_samples=10, retrospective=False, distance_metric='kl'):
@@ -1,6 +1,8 @@
 import random
 import torch
 import os
+import hashlib
+import pickle as pkl
 import matplotlib.pyplot as plt
 import numpy as np
 # from pyro.distributions import MultivariateNormal
@@ -8,6 +10,9 @@ import numpy as np
 
 from torch.distributions.multivariate_normal import MultivariateNormal
 from sklearn.mixture import GaussianMixture
+from TSX.distributed import distributed_optimizer, is_main_process
+from TSX.loaders import make_loader, batch_size_of, FirstBatches
+from torch.utils.data import IterableDataset
 
 #from pydlm import dlm, autoReg
 
@@ -104,6 +109,125 @@ class FeatureGenerator(torch.nn.Module):
         return full_sample, mu
 
 
+class MultiHeadFeatureGenerator(torch.nn.Module):
+    def __init__(self, feature_size, hist=True, hidden_size=100, prediction_size=1, conditional=True, seed=random.seed('2019'), **kwargs):
+        """ Conditional generator for every feature in a single model. The history encoder is shared and each feature
+        has its own prediction head, so all F conditionals are trained in one pass and saved in one checkpoint.
+        Drop-in replacement for a set of per-feature FeatureGenerator models
+        :param feature_size: Number of features in the input
+        :param hist: (boolean) If True, use previous observations in the time series to generate next observation.
+                            If False, generate the sample given other dimensions at that time point
+        :param hidden_size: Size of hidden units for the recurrent structure
+        :param prediction_size: Number of time steps to generate
+        :param conditional: (boolean) If True, use both other observations at time t as well as the history to
+                            generate future observations
+        :param seed: Random seed
+        """
+        super(MultiHeadFeatureGenerator, self).__init__()
+        self.seed = seed
+        self.hist = hist
+        self.feature_size = feature_size
+        self.hidden_size = hidden_size
+        self.conditional = conditional
+        self.prediction_size = prediction_size
+        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        non_lin = kwargs["non_linearity"] if "non_linearity" in kwargs.keys() else torch.nn.ReLU()
+        self.data=kwargs['data'] if 'data' in kwargs.keys() else 'mimic'
+
+        f_size = 0
+        if self.hist:
+            self.rnn = torch.nn.GRU(self.feature_size, self.hidden_size)
+            f_size = self.hidden_size
+        if conditional or not self.hist:
+            f_size = f_size + self.feature_size-1
+
+        if self.data=='mimic' or self.data=='ghg':
+            self.n_hidden, self.head_non_lin = 200, non_lin
+        else:
+            self.n_hidden, self.head_non_lin = 50, torch.nn.Tanh()
+        # Each head is Linear -> non-linearity -> BatchNorm1d -> Linear. The weights of all the heads are stacked along
+        # a first feature dimension, so that the heads are applied together with batched matrix products
+        in_layers = [torch.nn.Linear(f_size, self.n_hidden) for _ in range(self.feature_size)]
+        out_layers = [torch.nn.Linear(self.n_hidden, self.prediction_size*2) for _ in range(self.feature_size)]
+        self.head_w1 = torch.nn.Parameter(torch.stack([l.weight.data.t() for l in in_layers]))
+        self.head_b1 = torch.nn.Parameter(torch.stack([l.bias.data for l in in_layers]))
+        self.head_norm = torch.nn.BatchNorm1d(num_features=self.feature_size*self.n_hidden)
+        self.head_w2 = torch.nn.Parameter(torch.stack([l.weight.data.t() for l in out_layers]))
+        self.head_b2 = torch.nn.Parameter(torch.stack([l.bias.data for l in out_layers]))
+        # Row i holds the indices of the features known to head i, i.e. all the features but i
+        self.register_buffer('known_index', torch.LongTensor([[j for j in range(self.feature_size) if j != i]
+                                                              for i in range(self.feature_size)]))
+
+    def _encode(self, past):
+        encoding = None
+        if self.hist:
+            past = past.permute(2, 0, 1)
+            prev_state = torch.zeros([1, past.shape[1], self.hidden_size]).to(self.device)
+            _, encoding = self.rnn(past.to(self.device), prev_state)
+            encoding = encoding.view(encoding.size(1), -1)
+        return encoding
+
+    def _heads(self, x, encoding, sig_ind=None):
+        """ Means and stds of the head of feature sig_ind, or of all the heads if sig_ind is None
+        :return: mu and std of shape [batch, heads, prediction_size]
+        """
+        first, last = (0, self.feature_size) if sig_ind is None else (sig_ind, sig_ind + 1)
+        heads = slice(first, last)
+        known_signal = x[:, self.known_index[heads]].transpose(0, 1)
+        if encoding is not None:
+            encoding = encoding.unsqueeze(0).expand(last - first, -1, -1)
+        if encoding is None:
+            inp = known_signal
+        elif self.conditional:
+            inp = torch.cat((encoding, known_signal), 2)
+        else:
+            inp = encoding
+        h = self.head_non_lin(torch.baddbmm(self.head_b1[heads].unsqueeze(1), inp, self.head_w1[heads]))
+        # Every head is normalized with its own slice of the batch norm parameters and running statistics
+        units = slice(first*self.n_hidden, last*self.n_hidden)
+        batch_size = h.shape[1]
+        h = torch.nn.functional.batch_norm(h.transpose(0, 1).reshape(batch_size, -1), self.head_norm.running_mean[units],
+                                           self.head_norm.running_var[units], self.head_norm.weight[units],
+                                           self.head_norm.bias[units], self.training, self.head_norm.momentum,
+                                           self.head_norm.eps)
+        h = h.view(batch_size, last - first, self.n_hidden).transpose(0, 1)
+        mu_std = torch.baddbmm(self.head_b2[heads].unsqueeze(1), h, self.head_w2[heads]).transpose(0, 1)
+        mu = mu_std[:, :, 0:mu_std.shape[2]//2]
+        std = mu_std[:, :, mu_std.shape[2]//2:]
+        return mu, std
+
+    def forward(self, x, past, sig_ind=0, *args):
+        """
+        Sample full observation at t, given past information
+        :param x: observation at time t
+        :param past: All observations upto time t
+        :param sig_ind: Index of the feature to investigate
+        :return: full sample at time t
+        """
+        if len(x.shape) == 1:
+            x = x.unsqueeze(0)
+        x = x.to(self.device)
+        mu, std = self._heads(x, self._encode(past), sig_ind)
+        mu, std = mu[:, 0], std[:, 0]
+        reparam_samples = mu + std*torch.randn_like(mu).to(self.device)
+        full_sample = torch.cat([x[:, 0:sig_ind], reparam_samples, x[:, sig_ind+1:]], 1)
+        return full_sample, mu
+
+    def forward_all(self, x, past):
+        """
+        Sample every feature at t from its own conditional, encoding the history only once
+        :param x: observation at time t
+        :param past: All observations upto time t
+        :return: samples and means of shape [batch, features, prediction_size]
+        """
+        if len(x.shape) == 1:
+            x = x.unsqueeze(0)
+        x = x.to(self.device)
+        mu, std = self._heads(x, self._encode(past))
+        reparam_samples = mu + std*torch.randn_like(mu).to(self.device)
+        return reparam_samples, mu
+
+
 class JointFeatureGenerator(torch.nn.Module):
     def __init__(self, feature_size, latent_size=100, prediction_size=1, seed=random.seed('2019'), **kwargs):
         """ Conditional generator model to predict future observations
@@ -126,6 +250,8 @@ class JointFeatureGenerator(torch.nn.Module):
         non_lin = kwargs["non_linearity"] if "non_linearity" in kwargs.keys() else torch.nn.Tanh()
         self.data=kwargs['data'] if 'data' in kwargs.keys() else 'mimic'
         self.diag = kwargs['diag'] if 'diag' in kwargs.keys() else False
+        # Rank of the low-rank plus diagonal covariance, None for a full (or diagonal, with diag=True) covariance
+        self.rank = kwargs['rank'] if 'rank' in kwargs.keys() else None
 
         # Generates the parameters of the distribution
         self.rnn = torch.nn.GRU(self.feature_size, self.hidden_size)
@@ -147,7 +273,17 @@ class JointFeatureGenerator(torch.nn.Module):
                                                  #torch.nn.Dropout(0.5),
                                                  torch.nn.Linear(10, self.latent_size*2), non_lin)
 
-        if not self.diag:
+        if self.rank is not None:
+            # Covariance = W W^T + diag(d^2), W is feature_size x rank
+            self.cov_generator = torch.nn.Sequential(torch.nn.Linear(self.latent_size, 10),
+                                                 non_lin,
+                                                 torch.nn.BatchNorm1d(num_features=10),
+                                                 torch.nn.Linear(10, self.feature_size*self.rank))
+            self.diag_generator = torch.nn.Sequential(torch.nn.Linear(self.latent_size, 10),
+                                                 non_lin,
+                                                 torch.nn.BatchNorm1d(num_features=10),
+                                                 torch.nn.Linear(10, self.feature_size),torch.nn.ReLU())
+        elif not self.diag:
             self.cov_generator = torch.nn.Sequential(torch.nn.Linear(self.latent_size, 10),#+self.hidden_size, 100),
                                                  non_lin,
                                                  torch.nn.BatchNorm1d(num_features=10),
@@ -173,6 +309,7 @@ class JointFeatureGenerator(torch.nn.Module):
         :return: full sample at time t
         """
         mean, covariance = self.likelihood_distribution(past)  # P(X_t|X_0:t-1)
+        covariance = self.dense_covariance(covariance)
         if len(x.shape) is 1:
             x = x.unsqueeze(0)
         if method=='c1':  # c1 method: P(x_{-i,t}|X_{0:t-1}, x_{i,t})
@@ -214,6 +351,21 @@ class JointFeatureGenerator(torch.nn.Module):
     def likelihood_distribution(self, past):
         past = past.permute(2, 0, 1)
         all_encoding, encoding = self.rnn(past.to(self.device))
+        return self.likelihood_distribution_from_state(encoding)
+
+    def likelihood_distribution_all(self, past):
+        """ P(X_t|X_0:t-1) for every time step of past from a single pass of the GRU
+        :param past: Shape:[batch, features, time]
+        :return: mean and covariance of the next observation after each prefix, time-major. Shape:[time*batch, ...]
+        """
+        past = past.permute(2, 0, 1)
+        all_encoding, encoding = self.rnn(past.to(self.device))
+        return self.likelihood_distribution_from_state(all_encoding.reshape(1, -1, self.hidden_size))
+
+    def likelihood_distribution_from_state(self, encoding):
+        """ P(X_t|X_0:t-1) given the GRU hidden state after observing X_0:t-1. Shape:[1, batch, hidden_size]
+        With a low-rank covariance, covariance is the pair (cov_factor [batch, features, rank], cov_diag [batch, features])
+        """
         H = encoding.view(encoding.size(1),-1)
         # Find the distribution of the latent variable Z
         mu_std = self.dist_predictor(H)
@@ -224,6 +376,10 @@ class JointFeatureGenerator(torch.nn.Module):
         # Z_H = torch.cat((Z, H), 1)
         # Generate the distribution P(X|H,Z)
         mean = self.mean_generator(Z)
+        if self.rank is not None:
+            cov_factor = self.cov_generator(Z).view(-1, self.feature_size, self.rank)
+            cov_diag = self.diag_generator(Z)**2 + 1e-5
+            return mean, (cov_factor, cov_diag)
         cov_noise = (torch.eye(self.feature_size).unsqueeze(0).repeat(len(Z), 1, 1) * 1e-5).to(self.device)
         if not self.diag:
             A = self.cov_generator(Z).view(-1, self.feature_size, self.feature_size)
@@ -233,20 +389,59 @@ class JointFeatureGenerator(torch.nn.Module):
             covariance = torch.diag_embed(A**2) + cov_noise
         return mean, covariance
 
+    def distribution(self, mean, covariance):
+        """ Distribution object for the output of likelihood_distribution. The low-rank form is evaluated and sampled
+        in O(features*rank^2) without building the full covariance
+        """
+        if isinstance(covariance, tuple):
+            return torch.distributions.LowRankMultivariateNormal(loc=mean, cov_factor=covariance[0],
+                                                                 cov_diag=covariance[1])
+        return MultivariateNormal(loc=mean, covariance_matrix=covariance)
+
+    @staticmethod
+    def dense_covariance(covariance):
+        if isinstance(covariance, tuple):
+            cov_factor, cov_diag = covariance
+            return torch.bmm(cov_factor, torch.transpose(cov_factor, 1, 2)) + torch.diag_embed(cov_diag)
+        return covariance
+
     def forward_joint(self, past):
         mean, covariance = self.likelihood_distribution(past)
-        likelihood = torch.distributions.multivariate_normal.MultivariateNormal(loc=mean, covariance_matrix=covariance)
+        likelihood = self.distribution(mean, covariance)
         return likelihood.rsample()
 
+    def forward_step(self, x_t, past_state=None):
+        """
+        Advance the generator GRU by a single observation
+        :param x_t: observation at time t. Shape:[batch, features]
+        :param past_state: Hidden state after observing X_0:t-1 (None at the start of the sequence)
+        :return: Hidden state after observing X_0:t
+        """
+        _, state = self.rnn(x_t.unsqueeze(0).to(self.device), past_state)
+        return state
+
     def forward_conditional(self, past, current, sig_inds):
         if current.shape[-1]==len(sig_inds):
             return current, current
         past = past.to(self.device)
+        mean, covariance = self.likelihood_distribution(past)  # P(X_t|X_0:t-1)
+        return self._conditional_sample(mean, covariance, current, sig_inds)
+
+    def forward_conditional_step(self, past_state, current, sig_inds):
+        """ Same as forward_conditional, with the history summarized by the GRU state returned by forward_step
+        """
+        if current.shape[-1]==len(sig_inds):
+            return current, current
+        mean, covariance = self.likelihood_distribution_from_state(past_state)  # P(X_t|X_0:t-1)
+        return self._conditional_sample(mean, covariance, current, sig_inds)
+
+    def _conditional_sample(self, mean, covariance, current, sig_inds):
         current = current.to(self.device)
         if len(current.shape) is 1:
             current = current.unsqueeze(0)
-        mean, covariance = self.likelihood_distribution(past)  # P(X_t|X_0:t-1)
-        sig_inds_comp = list(set(range(past.shape[-2]))-set(sig_inds))
+        if isinstance(covariance, tuple):
+            return self._conditional_sample_lowrank(mean, covariance[0], covariance[1], current, sig_inds)
+        sig_inds_comp = list(set(range(current.shape[-1]))-set(sig_inds))
         ind_len = len(sig_inds)
         ind_len_not = len(sig_inds_comp)
         x_ind = current[:, sig_inds].view(-1,ind_len)
@@ -263,83 +458,145 @@ class JointFeatureGenerator(torch.nn.Module):
         full_sample = current.clone()
         full_sample[:,sig_inds_comp] = sample
         return full_sample, mean[:,sig_inds_comp]
-    
+
+    def _conditional_sample_lowrank(self, mean, cov_factor, cov_diag, current, sig_inds):
+        """ Conditional sampling for covariance W W^T + D. With M = I + W_S^T D_S^-1 W_S (rank x rank), Woodbury gives
+            mean_c|s = mean_c + W_c M^-1 W_S^T D_S^-1 (x_S - mean_S)
+            cov_c|s = D_c + W_c M^-1 W_c^T
+        so the conditional is again low-rank plus diagonal and is sampled without any features x features matrix
+        """
+        sig_inds_comp = list(set(range(current.shape[-1]))-set(sig_inds))
+        W_s = cov_factor[:, sig_inds, :]
+        W_c = cov_factor[:, sig_inds_comp, :]
+        Dinv_W_s = W_s / cov_diag[:, sig_inds].unsqueeze(-1)
+        M = torch.eye(cov_factor.shape[-1], device=cov_factor.device) + torch.bmm(torch.transpose(W_s, 1, 2), Dinv_W_s)
+        M_inv = torch.inverse(M)
+        x_ind = (current[:, sig_inds] - mean[:, sig_inds]).unsqueeze(-1)
+        g = torch.bmm(M_inv, torch.bmm(torch.transpose(Dinv_W_s, 1, 2), x_ind))
+        mean_cond = mean[:, sig_inds_comp] + torch.bmm(W_c, g).squeeze(-1)
+        L = torch.cholesky(M_inv)
+        eps_r = torch.randn(L.shape[0], L.shape[-1], 1, device=L.device)
+        sample = mean_cond + torch.bmm(W_c, torch.bmm(L, eps_r)).squeeze(-1) + \
+                 cov_diag[:, sig_inds_comp].sqrt()*torch.randn_like(mean_cond)
+        full_sample = current.clone()
+        full_sample[:,sig_inds_comp] = sample
+        return full_sample, mean[:,sig_inds_comp]
+
 
 class JointDistributionGenerator(torch.nn.Module):
-    def __init__(self, n_components, train_loader, seed=random.seed('2019')):
+    def __init__(self, n_components, train_loader, seed=random.seed('2019'), max_samples=None, cache_dir='./ckpt/gmm'):
+        """ Gaussian mixture over the observations at single time steps, used for the no-history variant of FIT
+        :param n_components: Number of mixture components
+        :param train_loader: Loader over the training set. Every (sample, time step) pair is one observation
+        :param max_samples: If set, the mixture is fit on a uniform reservoir sample of this many observations
+        :param cache_dir: Directory where fitted mixtures are cached, keyed by a hash of the fit data and n_components.
+                          None disables the cache
+        """
         super(JointDistributionGenerator, self).__init__()
         self.seed = seed
         self.n_components = n_components
-        trainset = list(train_loader.dataset)
-        x_train = torch.stack([x[0] for x in trainset]).cpu().numpy()
-        x_train = [x_train[i,:,j] for i in range(x_train.shape[0]) for j in range(x_train.shape[-1])]
-        self.gmm = GaussianMixture(n_components=n_components, covariance_type='full')
-        print('Fitting the distribution ...')
-        self.gmm.fit(np.array(x_train))
+        x_train = self._observations(train_loader, max_samples)
+        key = hashlib.sha1(np.ascontiguousarray(x_train).tobytes()).hexdigest()
+        cache_file = None if cache_dir is None else os.path.join(cache_dir, 'gmm_%s_%d.pkl' % (key, n_components))
+        if cache_file is not None and os.path.exists(cache_file):
+            print('Loading the fitted distribution from ', cache_file)
+            with open(cache_file, 'rb') as f:
+                self.gmm = pkl.load(f)
+        else:
+            self.gmm = GaussianMixture(n_components=n_components, covariance_type='full')
+            print('Fitting the distribution on %d observations ...' % len(x_train))
+            self.gmm.fit(x_train)
+            if cache_file is not None:
+                if not os.path.exists(cache_dir):
+                    os.makedirs(cache_dir)
+                with open(cache_file, 'wb') as f:
+                    pkl.dump(self.gmm, f)
         # print('Cluster means: ', self.gmm.means_)
-        print('Loglike scores: ', self.gmm.score(np.array(x_train)))
+        print('Loglike scores: ', self.gmm.score(x_train))
+        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self._conditionals = {}
+        # Single feature conditioning is what FIT uses, precompute it for every feature
+        self.precompute_conditionals([[i] for i in range(x_train.shape[1])])
+
+    @staticmethod
+    def _observations(train_loader, max_samples=None):
+        """ All the (sample, time step) observations in the loader as a [N*T, features] array, or a uniform reservoir
+        sample of max_samples of them, collected batch by batch
+        """
+        rng = np.random.RandomState(1234)
+        chunks = []
+        reservoir = None
+        n_seen = 0
+        for signals, _ in train_loader:
+            x = signals.permute(0, 2, 1).reshape(-1, signals.shape[1]).cpu().numpy()
+            if max_samples is None:
+                chunks.append(x)
+                continue
+            if reservoir is None:
+                reservoir = np.empty((max_samples, x.shape[1]), dtype=x.dtype)
+            n_fill = max(0, min(max_samples - n_seen, len(x)))
+            reservoir[n_seen:n_seen + n_fill] = x[:n_fill]
+            # Algorithm R: observation number i replaces a random slot with probability max_samples/(i+1)
+            rest = x[n_fill:]
+            if len(rest):
+                slots = rng.randint(0, n_seen + n_fill + np.arange(len(rest)) + 1)
+                keep = slots < max_samples
+                reservoir[slots[keep]] = rest[keep]
+            n_seen += len(x)
+        if max_samples is None:
+            return np.concatenate(chunks, 0)
+        return reservoir[:min(n_seen, max_samples)]
+
+    def precompute_conditionals(self, subsets):
+        """ Precompute, for every conditioning subset, the per-component terms of the conditional Gaussians
+        :param subsets: List of lists of the feature indices that are conditioned on
+        """
+        means = torch.Tensor(self.gmm.means_).double()
+        covariances = torch.Tensor(self.gmm.covariances_).double()
+        for sig_inds in subsets:
+            sig_inds = sorted(sig_inds)
+            sig_inds_comp = [i for i in range(means.shape[1]) if i not in sig_inds]
+            cov_1_2 = covariances[:, sig_inds_comp, :][:, :, sig_inds]
+            cov_2_2 = covariances[:, sig_inds, :][:, :, sig_inds]
+            cov_1_1 = covariances[:, sig_inds_comp, :][:, :, sig_inds_comp]
+            gain = torch.bmm(cov_1_2, torch.inverse(cov_2_2))
+            cond_covariance = cov_1_1 - torch.bmm(gain, torch.transpose(cov_1_2, 2, 1))
+            self._conditionals[tuple(sig_inds)] = {
+                'sig_inds_comp': sig_inds_comp,
+                'mean_1': means[:, sig_inds_comp].float().to(self.device),
+                'mean_2': means[:, sig_inds].float().to(self.device),
+                'gain': gain.float().to(self.device),
+                'cond_scale_tril': torch.cholesky(cond_covariance).float().to(self.device),
+                # Marginal of the conditioning features under each component, for the responsibilities
+                'marginal': MultivariateNormal(loc=means[:, sig_inds].float().to(self.device),
+                                               scale_tril=torch.cholesky(cov_2_2).float().to(self.device)),
+                'log_weights': torch.Tensor(np.log(self.gmm.weights_)).to(self.device)}
 
     def forward_conditional(self, past, current, sig_inds):
-        # print(current.shape)
-        cond_samples = []
-        for sample in current:
-            mean = torch.Tensor(self.gmm.means_).to('cuda')
-            covariance = torch.Tensor(self.gmm.covariances_).to('cuda')
-            sig_inds_comp = list(set(range(current.shape[1])) - set(sig_inds))
-            ind_len = len(sig_inds)
-            ind_len_not = len(sig_inds_comp)
-            x_ind = sample[sig_inds].view(-1, ind_len)
-            mean_1 = mean[:, sig_inds_comp].view(-1, ind_len_not)
-            cov_1_2 = covariance[:, sig_inds_comp, :][:, :, sig_inds].view(-1, ind_len_not, ind_len)
-            cov_2_2 = covariance[:, sig_inds, :][:, :, sig_inds].view(-1, ind_len, ind_len)
-            cov_1_1 = covariance[:, sig_inds_comp, :][:, :, sig_inds_comp].view(-1, ind_len_not, ind_len_not)
-            cond_means = mean_1 + torch.bmm((torch.bmm(cov_1_2, torch.inverse(cov_2_2))),
-                                           (x_ind - mean[:, sig_inds]).view(-1, ind_len, 1)).squeeze(-1)
-            cond_covariance = cov_1_1 - torch.bmm(torch.bmm(cov_1_2, torch.inverse(cov_2_2)),
-                                                  torch.transpose(cov_1_2, 2, 1))
-            marginal_dist = MultivariateNormal(loc=mean_1, covariance_matrix=cov_1_1)
-            # print(torch.exp(marginal_dist.log_prob(sample[sig_inds])))
-            cond_pi = torch.Tensor(self.gmm.weights_).to('cuda') * \
-                      torch.exp(marginal_dist.log_prob(sample[sig_inds]))
-            # print(self.gmm.weights_)
-            # print(cond_pi)
-            cond_pi = torch.nn.Softmax()(cond_pi)
-            m = torch.multinomial(input=cond_pi, num_samples=1)
-
-            # for i in range(self.n_components):
-                # mean = torch.Tensor(self.gmm.means_[i]).unsqueeze(0).to('cuda')
-                # covariance = torch.Tensor(self.gmm.covariances_[i]).unsqueeze(0).to('cuda')
-                # sig_inds_comp = list(set(range(current.shape[1])) - set(sig_inds))
-                # ind_len = len(sig_inds)
-                # ind_len_not = len(sig_inds_comp)
-                # x_ind = sample[sig_inds].view(-1, ind_len)
-                # mean_1 = mean[:,sig_inds_comp].view(-1, ind_len_not)
-                # cov_1_2 = covariance[:, sig_inds_comp, :][:, :, sig_inds].view(-1, ind_len_not, ind_len)
-                # cov_2_2 = covariance[:, sig_inds, :][:, :, sig_inds].view(-1, ind_len, ind_len)
-                # cov_1_1 = covariance[:, sig_inds_comp, :][:, :, sig_inds_comp].view(-1, ind_len_not, ind_len_not)
-                # mean_cond = mean_1 + torch.bmm((torch.bmm(cov_1_2, torch.inverse(cov_2_2))),
-                #                                (x_ind - mean[:, sig_inds]).view(-1, ind_len, 1)).squeeze(-1)
-                # covariance_cond = cov_1_1 - torch.bmm(torch.bmm(cov_1_2, torch.inverse(cov_2_2)),
-                #                                       torch.transpose(cov_1_2, 2, 1))
-                # cond_means.append(mean_cond[0])
-                # cond_covariance.append(covariance_cond[0])
-                # marginal_dist =  MultivariateNormal(loc=mean_1[0], covariance_matrix=cov_1_1[0])
-                # cond_dist = MultivariateNormal(loc=mean_cond[0].squeeze(-1),
-                #                           covariance_matrix=covariance_cond[0])
-                # print(mean_1[0].shape, cov_1_1[0].shape, sample[sig_inds])
-                # cond_pi.append(self.gmm.weights_[i] * torch.exp(marginal_dist.log_prob(sample[sig_inds])))
-
-            # m = torch.multinomial(input=torch.stack(cond_pi), num_samples=1)
-            # print(torch.stack(cond_pi), m)
-            dist = MultivariateNormal(loc=cond_means[m], covariance_matrix=cond_covariance[m])
-            x = dist.rsample()
-            # print('sample:', sample)
-            full_sample = sample.clone()
-            full_sample[sig_inds_comp] = x
-            # print('Conditional', full_sample)
-            cond_samples.append(full_sample)
-        # print('%%%%%%%%%%%%%%', len(cond_samples))
-        return torch.stack(cond_samples), None
+        """
+        Sample the unobserved features at t given the observed ones, for the whole batch at once
+        :param past: Unused, the mixture has no history
+        :param current: Observations at time t [batch, features]
+        :param sig_inds: Indices of the features that are conditioned on
+        :return: full samples at time t
+        """
+        key = tuple(sorted(sig_inds))
+        if key not in self._conditionals:
+            self.precompute_conditionals([key])
+        cond = self._conditionals[key]
+        current = current.to(self.device)
+        if len(current.shape) == 1:
+            current = current.unsqueeze(0)
+        x_ind = current[:, list(key)]
+        # Component responsibilities p(k|x_S) and one component draw per sample
+        log_resp = cond['log_weights'] + cond['marginal'].log_prob(x_ind.unsqueeze(1))
+        m = torch.multinomial(torch.softmax(log_resp, -1), num_samples=1).squeeze(-1)
+        cond_means = cond['mean_1'][m] + torch.bmm(cond['gain'][m], (x_ind - cond['mean_2'][m]).unsqueeze(-1)).squeeze(-1)
+        noise = torch.randn(cond_means.shape + (1,), device=self.device)
+        x = cond_means + torch.bmm(cond['cond_scale_tril'][m], noise).squeeze(-1)
+        full_sample = current.clone()
+        full_sample[:, cond['sig_inds_comp']] = x
+        return full_sample, None
 
 
 class DLMGenerator(torch.nn.Module):
@@ -394,13 +651,13 @@ class CarryForwardGenerator(torch.nn.Module):
         return next_obs, mu
 
 
-def save_ckpt(generator_model, fname, data):
+def save_ckpt(generator_model, fname, data, state_dict=None):
     # Save model and results
     if not os.path.exists('./ckpt'):
         os.mkdir('./ckpt')
     if not os.path.exists(os.path.join('./ckpt',data)):
         os.mkdir(os.path.join('./ckpt',data))
-    torch.save(generator_model.state_dict(), fname)
+    torch.save(generator_model.state_dict() if state_dict is None else state_dict, fname)
 
 
 def train_feature_generator(generator_model, train_loader, valid_loader, generator_type, feature_to_predict=1, n_epochs=30, **kwargs):
@@ -507,6 +764,107 @@ def test_feature_generator(model, test_loader, feature_to_predict):
     return test_loss
 
 
+def train_multihead_feature_generator(generator_model, train_loader, valid_loader, generator_type, n_epochs=30, **kwargs):
+    """ Train all the heads of a MultiHeadFeatureGenerator together and save the best model in a single checkpoint
+    """
+    train_loss_trend = []
+    test_loss_trend = []
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    generator_model.to(device)
+    data=generator_model.data
+
+    # Overwrite default learning parameters if values are passed
+    default_params = {'lr':0.0001, 'weight_decay':1e-3}
+    for k,v in kwargs.items():
+        if k in default_params.keys():
+            default_params[k] = v
+
+    parameters = generator_model.parameters()
+    optimizer = torch.optim.Adam(parameters, lr=default_params['lr'], weight_decay=default_params['weight_decay'])
+    optimizer = distributed_optimizer(optimizer, generator_model)
+    loss_criterion = torch.nn.MSELoss()
+
+    num = 1
+    best_loss=1000000
+    best_epoch = 0
+    # Generators without history are saved as <generator_type>_nohist.pt
+    fname=os.path.join('./ckpt', data, '%s%s.pt'%(generator_type, '' if generator_model.hist else '_nohist'))
+    for epoch in range(n_epochs + 1):
+        generator_model.train()
+        epoch_loss = 0
+        for i, (signals, _) in enumerate(train_loader):
+            for t in [int(tt) for tt in np.logspace(1.2,np.log10(signals.shape[2]),num=num)]:
+                label = signals[:, :, t:t+generator_model.prediction_size]
+                if label.shape[-1] < generator_model.prediction_size:
+                    continue
+                signal = torch.Tensor(signals[:, :, t].float()).to(device)
+                past = signals[:,:,:t]
+                optimizer.zero_grad()
+                prediction, mus = generator_model.forward_all(signal, past)
+                reconstruction_loss = loss_criterion(prediction, label.to(device))
+                epoch_loss = epoch_loss + reconstruction_loss.item()
+                reconstruction_loss.backward()
+                optimizer.step()
+
+        test_loss = test_multihead_feature_generator(generator_model, valid_loader)
+        train_loss_trend.append(epoch_loss/((i+1)*num))
+        test_loss_trend.append(test_loss)
+
+        if test_loss<best_loss:
+            best_loss = test_loss
+            best_epoch = epoch
+            if is_main_process():
+                save_ckpt(generator_model, fname,data)
+                print('saved ckpt:in epoch', epoch)
+
+        if epoch % 10 == 0:
+            print('\nEpoch %d' % (epoch))
+            print('Training ===>loss: ', epoch_loss/((i+1)*num))
+            print('Test ===>loss: ', test_loss)
+    print('***** Training all features *****')
+    print('Test loss: ', test_loss)
+    if not is_main_process():
+        return
+
+    plt.figure()
+    plt.plot(train_loss_trend[:best_epoch+1], label='Train loss')
+    plt.plot(test_loss_trend[:best_epoch+1], label='Validation loss')
+    if not os.path.exists('./plots'):
+        os.mkdir('./plots')
+    if not os.path.exists('./plots/'+ data):
+        os.mkdir('./plots/' + data)
+    plt.title('Multi-head Generator Loss',fontweight='bold',fontsize=12)
+    plt.legend()
+    plt.savefig('./plots/%s/%s_loss.pdf'%(data, generator_type))
+
+
+def test_multihead_feature_generator(model, test_loader):
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    data = model.data
+    model.eval()
+    _, n_features, signel_len = next(iter(test_loader))[0].shape
+    test_loss = 0
+    n_terms = 0
+    if data == 'mimic':
+        tvec = [24]
+    else:
+        num = 1
+        tvec = [int(tt) for tt in np.logspace(1.0,np.log10(signel_len), num=num)]
+    with torch.no_grad():
+        for i, (signals, labels) in enumerate(test_loader):
+            for t in tvec:
+                label = signals[:, :, t:t+model.prediction_size]
+                if label.shape[-1] < model.prediction_size:
+                    continue
+                signal = torch.Tensor(signals[:, :, t].float()).to(device)
+                past = signals[:, :, :t]
+                prediction, mus = model.forward_all(signal, past)
+                test_loss = test_loss + torch.nn.MSELoss()(prediction, label.to(device)).item()
+                n_terms += 1
+    test_loss = test_loss/max(n_terms, 1)
+    return test_loss
+
+
 def train_joint_feature_generator(generator_model, train_loader, valid_loader, generator_type, feature_to_predict=1, n_epochs=30, **kwargs):
     train_loss_trend = []
     test_loss_trend = []
@@ -520,13 +878,17 @@ def train_joint_feature_generator(generator_model, train_loader, valid_loader, g
         feature_map = ['0','1','2']
 
     # Overwrite default learning parameters if values are passed
-    default_params = {'lr':0.0001, 'weight_decay':1e-3, 'cv': 0}
+    # eval_every: number of epochs between evaluations, train_eval_fraction: fraction of the train set used to track
+    # the train loss, patience: number of epochs without validation improvement before stopping (None to disable)
+    default_params = {'lr':0.0001, 'weight_decay':1e-3, 'cv': 0, 'teacher_forcing': False, 'eval_every': 1,
+                      'train_eval_fraction': 1., 'patience': None}
     for k,v in kwargs.items():
         if k in default_params.keys():
             default_params[k] = v
 
     parameters = generator_model.parameters()
     optimizer = torch.optim.Adam(parameters, lr=default_params['lr'], weight_decay=default_params['weight_decay'])
+    optimizer = distributed_optimizer(optimizer, generator_model)
     loss_criterion = torch.nn.MSELoss()
 
     if data=='mimic' or data=='mimic_int':
@@ -537,7 +899,19 @@ def train_joint_feature_generator(generator_model, train_loader, valid_loader, g
     best_loss = 1000000
     print('data name in generator:', data)
     
-    fname=os.path.join('./ckpt/', data, '%s.pt'%(generator_type))
+    best_state = None
+    best_epoch = 0
+
+    if default_params['train_eval_fraction'] < 1. and isinstance(train_loader.dataset, IterableDataset):
+        # Streamed datasets cannot be sampled, their first (shuffled) batches are used instead
+        n_batches = int(default_params['train_eval_fraction'] * len(train_loader.dataset) / batch_size_of(train_loader))
+        train_eval_loader = FirstBatches(train_loader, max(1, n_batches))
+    elif default_params['train_eval_fraction'] < 1.:
+        n_eval = max(1, int(default_params['train_eval_fraction'] * len(train_loader.dataset)))
+        eval_ind = np.random.RandomState(1234).choice(len(train_loader.dataset), n_eval, replace=False)
+        train_eval_loader = make_loader(train_loader.dataset, batch_size_of(train_loader), sampler=np.sort(eval_ind).tolist())
+    else:
+        train_eval_loader = train_loader
 
     for epoch in range(n_epochs + 1):
         generator_model.train()
@@ -547,6 +921,18 @@ def train_joint_feature_generator(generator_model, train_loader, valid_loader, g
             # for t in [np.random.randint(low=24, high=45)]:
             #for t in [int(tt) for tt in np.logspace(1.2, np.log10(signals.shape[2]-1), num=num)]:
 
+            if default_params['teacher_forcing']:
+                # NLL of every observation given its history, from a single pass over the sequence
+                optimizer.zero_grad()
+                mean, covariance = generator_model.likelihood_distribution_all(signals[:, :, :-1])
+                target = signals[:, :, 1:].permute(2, 0, 1).reshape(-1, signals.shape[1])
+                dist = generator_model.distribution(mean, covariance)
+                reconstruction_loss = -dist.log_prob(target.to(device)).mean()
+                epoch_loss = epoch_loss + reconstruction_loss.item()
+                reconstruction_loss.backward()
+                optimizer.step()
+                continue
+
             if num == 1:
                 timepoints=[signals.shape[2]-1]
             else:
@@ -556,7 +942,7 @@ def train_joint_feature_generator(generator_model, train_loader, valid_loader, g
                 optimizer.zero_grad()
                 mean, covariance = generator_model.likelihood_distribution(signals[:, :, :t])
                 # dist = OMTMultivariateNormal(mean, torch.cholesky(covariance))
-                dist = MultivariateNormal(loc=mean, covariance_matrix=covariance)
+                dist = generator_model.distribution(mean, covariance)
                 reconstruction_loss = -dist.log_prob(signals[:, :, t].to(device)).mean()
                 epoch_loss = epoch_loss + reconstruction_loss.item()
                 reconstruction_loss.backward(retain_graph=True)
@@ -570,31 +956,38 @@ def train_joint_feature_generator(generator_model, train_loader, valid_loader, g
                 # reconstruction_loss.backward(retain_graph=True)
                 # optimizer.step()
 
+        if epoch % default_params['eval_every'] != 0 and epoch != n_epochs:
+            continue
         test_loss = test_joint_feature_generator(generator_model, valid_loader)
         # train_loss_trend.append(epoch_loss / ((i + 1) * num))
-        train_loss = test_joint_feature_generator(generator_model, train_loader)
+        train_loss = test_joint_feature_generator(generator_model, train_eval_loader)
         train_loss_trend.append(train_loss)
 
         test_loss_trend.append(test_loss)
         if test_loss<best_loss:
             best_loss = test_loss
             best_epoch = epoch
-            print('saving ckpt')
-            save_ckpt(generator_model, fname, data)
+            # Keep the best weights in memory, they are written to disk once training is over
+            best_state = {k: v.detach().clone() for k, v in generator_model.state_dict().items()}
 
         if epoch % 10 == 0:
             print('\nEpoch %d' % (epoch))
             print('Training ===>loss: ', train_loss)
             print('Test ===>loss: ', test_loss)
+
+        if default_params['patience'] is not None and epoch - best_epoch >= default_params['patience']:
+            print('Early stopping at epoch %d, best epoch: %d' % (epoch, best_epoch))
+            break
     print('***** Joint generator test loss *****', test_loss)
-    #save_ckpt(generator_model,fname,data)
+    # Continue with the best weights (every rank restores them, so that rank 0 returns them from data-parallel runs)
+    if best_state is not None:
+        print('Restoring weights of epoch', best_epoch)
+        generator_model.load_state_dict(best_state)
+    if not is_main_process():
+        return
 
     # Save model and results
-    if not os.path.exists('./ckpt'):
-        os.mkdir('./ckpt')
-    if not os.path.exists('./ckpt/'+ data):
-        os.mkdir('./ckpt/' + data)
-    torch.save(generator_model.state_dict(), './ckpt/%s/%s_%d.pt'%(data, generator_type,default_params['cv']))
+    save_ckpt(generator_model, './ckpt/%s/%s_%d.pt'%(data, generator_type,default_params['cv']), data)
 
 
     plt.figure(feature_to_predict)
@@ -626,13 +1019,14 @@ def test_joint_feature_generator(model, test_loader):
     else:
         num = 1
         tvec = [int(tt) for tt in np.logspace(1.0,np.log10(signel_len), num=num)]
-    for i, (signals, labels) in enumerate(test_loader):
-        for t in tvec:
-            mean, covariance = model.likelihood_distribution(signals[:, :, :t])
-            # dist = OMTMultivariateNormal(mean, torch.cholesky(covariance))
-            dist = MultivariateNormal(loc=mean, covariance_matrix=covariance)
-            reconstruction_loss = -dist.log_prob(signals[:, :, t].to(device)).mean()
-            test_loss = test_loss + reconstruction_loss.item()
+    with torch.no_grad():
+        for i, (signals, labels) in enumerate(test_loader):
+            for t in tvec:
+                mean, covariance = model.likelihood_distribution(signals[:, :, :t])
+                # dist = OMTMultivariateNormal(mean, torch.cholesky(covariance))
+                dist = model.distribution(mean, covariance)
+                reconstruction_loss = -dist.log_prob(signals[:, :, t].to(device)).mean()
+                test_loss = test_loss + reconstruction_loss.item()
 
             # label = signals[:, :, t:t+model.prediction_size].contiguous().view(signals.shape[0], signals.shape[1])
             # prediction = model.forward_joint(signals[:, :, :t])
@@ -0,0 +1,131 @@
+import os
+import json
+import itertools
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, BatchSampler, SequentialSampler, TensorDataset, Subset, IterableDataset
+
+
+def loader_params(config_path='config.json', **kwargs):
+    """
+    DataLoader options, read from the "data_loader" section of config.json and overridden by kwargs
+    :param num_workers: Number of loading processes (0 loads in the main process)
+    :param pin_memory: Page-locked host batches for faster (asynchronous) copies to the GPU. Ignored without CUDA
+    :param persistent_workers: Keep the workers alive between epochs. Only used with num_workers > 0
+    :param prefetch_factor: Batches loaded in advance by each worker. Only used with num_workers > 0
+    :param test_batch_size: Batch size of the test loaders. None loads the whole test set as a single batch
+    """
+    default_params = {'num_workers': 0, 'pin_memory': True, 'persistent_workers': True, 'prefetch_factor': 2,
+                      'test_batch_size': None}
+    if os.path.exists(config_path):
+        with open(config_path) as config_file:
+            default_params.update(json.load(config_file).get('data_loader', {}))
+    for k, v in kwargs.items():
+        if k in default_params.keys():
+            default_params[k] = v
+    return default_params
+
+
+def as_float_tensor(x):
+    """ Contiguous float32 tensor sharing memory with x when it already is a contiguous float32 array
+    """
+    return torch.from_numpy(np.ascontiguousarray(x, dtype=np.float32))
+
+
+def make_loader(dataset, batch_size, sampler=None, **kwargs):
+    """
+    DataLoader that yields whole batches from a single indexing of the dataset, instead of collating batch_size
+    individual samples. The dataset must support indexing with a list of indices (e.g. TensorDataset). Iterable
+    datasets that batch themselves (e.g. ShardedDataset, see batched()) stream whole batches, other iterable datasets
+    are batched as they stream
+    :param sampler: Sampler over the dataset indices (sequential by default). Not supported by iterable datasets
+    :param kwargs: Overrides of loader_params
+    """
+    params = loader_params(**kwargs)
+    worker_params = {}
+    if params['num_workers'] > 0:
+        worker_params = {'persistent_workers': params['persistent_workers'],
+                         'prefetch_factor': params['prefetch_factor']}
+    pin_memory = params['pin_memory'] and torch.cuda.is_available()
+    if isinstance(dataset, IterableDataset):
+        if sampler is not None:
+            raise ValueError('Iterable datasets cannot be sampled, use FirstBatches to read a part of them')
+        if hasattr(dataset, 'batched'):
+            return DataLoader(dataset.batched(batch_size), batch_size=None, num_workers=params['num_workers'],
+                              pin_memory=pin_memory, **worker_params)
+        return DataLoader(dataset, batch_size=batch_size, num_workers=params['num_workers'], pin_memory=pin_memory,
+                          **worker_params)
+    if sampler is None:
+        sampler = SequentialSampler(dataset)
+    batch_sampler = BatchSampler(sampler, batch_size=batch_size, drop_last=False)
+    return DataLoader(dataset, sampler=batch_sampler, batch_size=None, num_workers=params['num_workers'],
+                      pin_memory=pin_memory, **worker_params)
+
+
+def batch_size_of(loader):
+    """ Batch size of a regular DataLoader or of one built by make_loader
+    """
+    if loader.batch_size is None and isinstance(loader.sampler, BatchSampler):
+        return loader.sampler.batch_size
+    if loader.batch_size is None and isinstance(loader.dataset, IterableDataset):
+        return getattr(loader.dataset, 'batch_size', None)
+    return loader.batch_size
+
+
+def is_sequential(loader):
+    """ Whether a regular DataLoader or one built by make_loader yields all the samples of its dataset in index order
+    """
+    if isinstance(loader.dataset, IterableDataset):
+        return (not getattr(loader.dataset, 'shuffle', False) and getattr(loader.dataset, 'world_size', 1) == 1
+                and loader.num_workers == 0)
+    sampler = loader.sampler.sampler if isinstance(loader.sampler, BatchSampler) else loader.sampler
+    return isinstance(sampler, SequentialSampler)
+
+
+class FirstBatches:
+    """ The first n_batches batches of a loader, e.g. to evaluate on a part of a streamed dataset. Every iteration
+    starts a new pass over the loader
+    """
+
+    def __init__(self, loader, n_batches):
+        self.loader = loader
+        self.n_batches = n_batches
+
+    def __iter__(self):
+        return itertools.islice(iter(self.loader), self.n_batches)
+
+    def __len__(self):
+        return self.n_batches
+
+
+class ArrayDataset(TensorDataset):
+    """TensorDataset of (signals, labels) that exposes the whole arrays, so that code that needs all the samples at
+    once does not have to go through a Python tuple per sample
+    """
+
+    def signals(self):
+        return self.tensors[0]
+
+    def labels(self):
+        return self.tensors[1]
+
+
+def dataset_tensors(dataset):
+    """ All the (signals, labels, ...) of a dataset as stacked tensors. Tensor datasets return their own tensors,
+    without any copy, and sharded datasets read all their shards. Other datasets are stacked sample by sample
+    """
+    if hasattr(dataset, 'tensors'):
+        return dataset.tensors
+    if isinstance(dataset, Subset):
+        indices = torch.as_tensor(np.asarray(dataset.indices), dtype=torch.long)
+        return tuple(t[indices] for t in dataset_tensors(dataset.dataset))
+    samples = [dataset[i] for i in range(len(dataset))]
+    return tuple(torch.stack([torch.as_tensor(s[k]) for s in samples]) for k in range(len(samples[0])))
+
+
+def dataset_signals(dataset):
+    return dataset_tensors(dataset)[0]
+
+
+def dataset_labels(dataset):
+    return dataset_tensors(dataset)[1]
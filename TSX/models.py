@@ -3,12 +3,15 @@ import pickle
 import random
 import torch
 import os
+import hashlib
 import torch.nn.functional as F
 from torch import nn
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 from torch.autograd import Variable
 from sklearn.preprocessing import OneHotEncoder
 from sklearn.model_selection import StratifiedShuffleSplit
+from TSX.array_store import save_arrays, load_array, has_arrays
+from TSX.sample_store import checkpoint_hash
 
 intervention_list = ['vent', 'vaso', 'adenosine', 'dobutamine', 'dopamine', 'epinephrine', 'isuprel', 'milrinone',
                      'norepinephrine', 'phenylephrine', 'vasopressin', 'colloid_bolus', 'crystalloid_bolus',
@@ -23,9 +26,12 @@ class PatientData():
         train_ratio: train/test ratio
         shuffle: Shuffle dataset before separating train/test
         transform: Preprocessing transformation on the dataset
+        cache: Keep the preprocessed arrays under root/cache, keyed by the hash of the source files and the arguments,
+               and memory-map them on later runs instead of rebuilding them from the pickled dataset
     """
 
-    def __init__(self, root, train_ratio=0.8, shuffle=False, random_seed='1234', transform="normalize", task='mortality'):
+    def __init__(self, root, train_ratio=0.8, shuffle=False, random_seed='1234', transform="normalize", task='mortality',
+                 cache=True):
         self.data_dir = os.path.join(root, 'patient_vital_preprocessed.pkl')
         self.train_ratio = train_ratio
         self.random_seed = random.seed(random_seed)
@@ -34,6 +40,12 @@ class PatientData():
 
         if not os.path.exists(self.data_dir):
             raise RuntimeError('Dataset not found')
+        self.data = None
+        cache_dir = os.path.join(root, 'cache')
+        cache_prefix = self._cache_prefix(root, train_ratio, shuffle, random_seed, transform)
+        if cache and has_arrays(cache_dir, cache_prefix):
+            self._load_cache(cache_dir, cache_prefix)
+            return
         with open(self.data_dir, 'rb') as f:
             self.data = pickle.load(f)
 
@@ -96,13 +108,59 @@ class PatientData():
         self.len_of_stay = self.train_data.shape[-1]
         if transform == "normalize":
             self.normalize()
+        if cache:
+            self._save_cache(cache_dir, cache_prefix)
 
     def __getitem__(self, index):
         signals, target = self.data[index]
         return signals, target
 
     def __len__(self):
-        return len(self.data)
+        return self.n_train + self.n_test
+
+    def _cache_prefix(self, root, train_ratio, shuffle, random_seed, transform):
+        h = hashlib.sha1()
+        for fname in ['patient_vital_preprocessed.pkl', 'patient_interventions.pkl']:
+            if os.path.exists(os.path.join(root, fname)):
+                with open(os.path.join(root, fname), 'rb') as f:
+                    for block in iter(lambda: f.read(1 << 20), b''):
+                        h.update(block)
+        h.update(str((self.task, train_ratio, shuffle, random_seed, transform)).encode())
+        return 'patient_data_%s_' % h.hexdigest()[:16]
+
+    def _save_cache(self, cache_dir, cache_prefix):
+        arrays = {'train_data': self.train_data, 'test_data': self.test_data,
+                  'train_label': self.train_label, 'test_label': self.test_label,
+                  'train_missing': self.train_missing, 'test_missing': self.test_missing}
+        if hasattr(self, 'feature_means'):
+            arrays.update({'feature_means': self.feature_means[:, 0], 'feature_std': self.feature_std[:, 0],
+                           'feature_max': self.feature_max[:, 0], 'feature_min': self.feature_min[:, 0]})
+        if self.pos_weight is not None:
+            arrays['pos_weight'] = np.asarray(self.pos_weight)
+        save_arrays(cache_dir, arrays, prefix=cache_prefix)
+
+    def _load_cache(self, cache_dir, cache_prefix):
+        for name in ['train_data', 'test_data', 'train_label', 'test_label', 'train_missing', 'test_missing']:
+            setattr(self, name, load_array(cache_dir, name, prefix=cache_prefix))
+        if self.task == 'intervention':
+            self.train_intervention, self.test_intervention = self.train_label, self.test_label
+            self.pos_weight = load_array(cache_dir, 'pos_weight', prefix=cache_prefix)
+        self.n_train = self.train_data.shape[0]
+        self.n_test = self.test_data.shape[0]
+        self.feature_size = self.train_data.shape[1]
+        self.time = self.train_data.shape[-1]
+        self.len_of_stay = self.train_data.shape[-1]
+        if os.path.exists(os.path.join(cache_dir, cache_prefix + 'feature_means.npy')):
+            self._set_statistics(*[load_array(cache_dir, name, prefix=cache_prefix)
+                                   for name in ['feature_max', 'feature_min', 'feature_means', 'feature_std']])
+
+    def _set_statistics(self, feature_max, feature_min, feature_means, feature_std):
+        # Per-feature statistics, broadcast (without copy) to the [feature, time] shape of a sample
+        shape = (self.feature_size, self.train_data.shape[-1])
+        self.feature_max = np.broadcast_to(feature_max[:, None], shape)
+        self.feature_min = np.broadcast_to(feature_min[:, None], shape)
+        self.feature_means = np.broadcast_to(feature_means[:, None], shape)
+        self.feature_std = np.broadcast_to(feature_std[:, None], shape)
 
     def __preprocess_predict_int__(self):
         "This replicates preprocessing of suresh et al for intervention prediction"
@@ -147,21 +205,20 @@ class PatientData():
 
 
     def normalize(self): # TODO: Have multiple normalization option or possibly take in a function for the transform
-        """ Calculate the mean and std of each feature from the training set
+        """ Calculate the mean and std of each feature from the training set, and standardize train and test data (in
+        float32). Features with a constant value are only centered
         """
-        d = [x.T for x in self.train_data]
-        d = np.stack(d, axis=0)
-        self.feature_max = np.tile(np.max(d.reshape(-1, self.feature_size), axis=0), (self.len_of_stay, 1)).T
-        self.feature_min = np.tile(np.min(d.reshape(-1, self.feature_size), axis=0), (self.len_of_stay, 1)).T
-        self.feature_means = np.tile(np.mean(d.reshape(-1, self.feature_size), axis=0), (self.len_of_stay, 1)).T
-        self.feature_std = np.tile(np.std(d.reshape(-1, self.feature_size), axis=0), (self.len_of_stay, 1)).T
-        np.seterr(divide='ignore', invalid='ignore')
-        self.train_data = np.array(
-           [np.where(self.feature_std == 0, (x - self.feature_means), (x - self.feature_means) / self.feature_std) for
-            x in self.train_data])
-        self.test_data = np.array(
-           [np.where(self.feature_std == 0, (x - self.feature_means), (x - self.feature_means) / self.feature_std) for
-            x in self.test_data])
+        self._set_statistics(np.max(self.train_data, axis=(0, 2)), np.min(self.train_data, axis=(0, 2)),
+                             np.mean(self.train_data, axis=(0, 2), dtype=np.float64),
+                             np.std(self.train_data, axis=(0, 2), dtype=np.float64))
+        means = self.feature_means[:, :1].astype(np.float32)
+        scale = np.where(self.feature_std[:, :1] == 0, 1, self.feature_std[:, :1]).astype(np.float32)
+        self.train_data = np.array(self.train_data, dtype=np.float32)
+        self.train_data -= means
+        self.train_data /= scale
+        self.test_data = np.array(self.test_data, dtype=np.float32)
+        self.test_data -= means
+        self.test_data /= scale
         #self.train_data = np.array([ np.where(self.feature_min==self.feature_max,(x-self.feature_min),(x-self.feature_min)/(self.feature_max-self.feature_min) ) for x in self.train_data])
         #self.test_data = np.array([ np.where(self.feature_min==self.feature_max,(x-self.feature_min),(x-self.feature_min)/(self.feature_max-self.feature_min) ) for x in self.test_data])
 '''
@@ -347,7 +404,82 @@ class ConvClassifier(nn.Module):
                                        torch.nn.Conv1d(in_channels=self.hidden_size, out_channels=self.n_state, kernel_size=1,padding=0))
 
     def forward(self, input, **kwargs):
-        return self.regressor(input)[:,:,-1]
+        # All convolutions are 1x1, so the prediction at the last time step only depends on the last observation
+        if self.return_all:
+            return self.regressor(input)
+        return self.regressor(input[:,:,-1:])[:,:,-1]
+
+
+class CausalConvClassifier(nn.Module):
+    def __init__(self, feature_size, n_state, hidden_size, kernel_size=2, n_layers=4, regres=True, return_all=False,
+                 seed=random.seed('2019'),data='simulation'):
+        """ Causal dilated convolutional classifier. The prediction at time t only depends on observations up to t
+        :param feature_size: Number of features in the input
+        :param n_state: Number of output classes
+        :param hidden_size: Number of channels of the hidden convolution layers
+        :param kernel_size: Kernel size of the dilated convolutions
+        :param n_layers: Number of dilated convolutions. Layer l has a dilation of 2**l
+        """
+        super(CausalConvClassifier, self).__init__()
+        self.hidden_size = hidden_size
+        self.n_state = n_state
+        self.seed = seed
+        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.regres = regres
+        self.return_all = return_all
+        self.data = data
+        self.kernel_size = kernel_size
+        self.dilations = [2**l for l in range(n_layers)]
+        # Number of past observations (including the current one) that the last output depends on
+        self.receptive_field = 1 + (kernel_size-1)*sum(self.dilations)
+
+        self.convs = nn.ModuleList()
+        in_channels = feature_size
+        for dilation in self.dilations:
+            self.convs.append(nn.Conv1d(in_channels=in_channels, out_channels=self.hidden_size,
+                                        kernel_size=kernel_size, dilation=dilation))
+            in_channels = self.hidden_size
+        self.regressor = nn.Conv1d(in_channels=self.hidden_size, out_channels=self.n_state, kernel_size=1)
+
+    def forward(self, input, **kwargs):
+        input = input.to(self.device)
+        if not self.return_all:
+            # Only the last output is kept, anything before its receptive field can be dropped
+            input = input[:, :, -self.receptive_field:]
+        encodings = input
+        for conv, dilation in zip(self.convs, self.dilations):
+            encodings = F.relu(conv(F.pad(encodings, ((self.kernel_size-1)*dilation, 0))))
+        if not self.regres:
+            return encodings[:, :, -1]
+        if self.return_all:
+            return self.regressor(encodings)
+        return self.regressor(encodings[:, :, -1:])[:, :, -1]
+
+    def init_state(self, batch_size):
+        """ Empty receptive field buffers, equivalent to the zero padding of the full forward pass
+        """
+        return [torch.zeros([batch_size, conv.in_channels, (self.kernel_size-1)*dilation]).to(self.device)
+                for conv, dilation in zip(self.convs, self.dilations)]
+
+    def forward_step(self, x_t, past_state=None):
+        """
+        Append a single observation to the stream and predict for it, only computing one new column per layer
+        :param x_t: observation at time t. Shape:[batch, features]
+        :param past_state: Receptive field buffers returned by the previous step (or init_state)
+        :return: prediction at time t and the updated buffers
+        """
+        x_t = x_t.to(self.device)
+        if past_state is None:
+            past_state = self.init_state(len(x_t))
+        state = []
+        encoding = x_t.unsqueeze(-1)
+        for conv, buffer in zip(self.convs, past_state):
+            window = torch.cat((buffer, encoding), -1)
+            state.append(window[:, :, 1:])
+            encoding = F.relu(conv(window))
+        if not self.regres:
+            return encoding[:, :, -1], state
+        return self.regressor(encoding)[:, :, -1], state
 
 
 class StateClassifierMIMIC(nn.Module):
@@ -402,6 +534,24 @@ class StateClassifierMIMIC(nn.Module):
         else:
             return encoding.view(encoding.shape[1], -1)
 
+    def forward_step(self, x_t, past_state=None):
+        """
+        Advance both recurrent layers by a single observation and predict at that time step
+        :param x_t: observation at time t. Shape:[batch, features]
+        :param past_state: Pair of layer states returned by the previous step (None at the start of the sequence)
+        :return: prediction at time t and the updated recurrent states
+        """
+        x_t = x_t.unsqueeze(0).to(self.device)
+        if past_state is None:
+            zeros = torch.zeros([1, x_t.shape[1], self.hidden_size]).to(self.device)
+            past_state = (zeros, zeros) if self.rnn_type == 'GRU' else ((zeros, zeros), (zeros, zeros))
+        encoding_1, state_1 = self.rnn1(x_t, past_state[0])
+        _, state_2 = self.rnn2(encoding_1, past_state[1])
+        encoding = state_2 if self.rnn_type == 'GRU' else state_2[0]
+        if self.regres:
+            return self.regressor(encoding.view(encoding.shape[1], -1)), (state_1, state_2)
+        return encoding.view(encoding.shape[1], -1), (state_1, state_2)
+
 
 
 class StateClassifier(nn.Module):
@@ -448,6 +598,24 @@ class StateClassifier(nn.Module):
         else:
             return encoding.view(encoding.shape[1], -1)
 
+    def forward_step(self, x_t, past_state=None):
+        """
+        Advance the recurrent state by a single observation and predict at that time step
+        :param x_t: observation at time t. Shape:[batch, features]
+        :param past_state: Recurrent state returned by the previous step (None at the start of the sequence)
+        :return: prediction at time t and the updated recurrent state
+        """
+        x_t = x_t.unsqueeze(0).to(self.device)
+        if past_state is None:
+            past_state = torch.zeros([1, x_t.shape[1], self.hidden_size]).to(self.device)
+            if self.rnn_type != 'GRU':
+                past_state = (past_state, past_state)
+        _, state = self.rnn(x_t, past_state)
+        encoding = state if self.rnn_type == 'GRU' else state[0]
+        if self.regres:
+            return self.regressor(encoding.view(encoding.shape[1], -1)), state
+        return encoding.view(encoding.shape[1], -1), state
+
 
 class EncoderRNN(nn.Module):
     def __init__(self, feature_size, hidden_size, rnn="GRU", regres=True, bidirectional=False, return_all=False,
@@ -514,6 +682,24 @@ class EncoderRNN(nn.Module):
         else:
             return encoding.view(encoding.shape[1], -1)
 
+    def forward_step(self, x_t, past_state=None):
+        """
+        Advance the recurrent state by a single observation and predict at that time step
+        :param x_t: observation at time t. Shape:[batch, features]
+        :param past_state: Recurrent state returned by the previous step (None at the start of the sequence)
+        :return: prediction at time t and the updated recurrent state
+        """
+        x_t = x_t.unsqueeze(0).to(self.device)
+        if past_state is None:
+            past_state = torch.zeros([1, x_t.shape[1], self.hidden_size]).to(self.device)
+            if self.rnn_type != 'GRU':
+                past_state = (past_state, past_state)
+        _, state = self.rnn(x_t, past_state)
+        encoding = state if self.rnn_type == 'GRU' else state[0]
+        if self.regres:
+            return self.regressor(encoding.view(encoding.shape[1], -1)), state
+        return encoding.view(encoding.shape[1], -1), state
+
 
 class RnnVAE(nn.Module):
     def __init__(self, feature_size, hidden_size, bidirectional=False,
@@ -772,3 +958,164 @@ class RETAIN(nn.Module):
 
         return logit, alpha, beta
 
+
+class DeepKnn:
+    """Deep k-nearest neighbours uncertainty scores (Papernot & McDaniel, 2018) over the encoder embeddings of a model
+    The training embeddings are partitioned by a k-means coarse quantizer (IVF index), so a query is only compared
+    against the members of its n_probe closest cells instead of the whole training set.
+    Args:
+        model: Trained encoder (e.g. EncoderRNN). Embeddings are taken from its regres=False output
+        train_data: Training samples. Shape:[n_samples, features, time]
+        train_labels: Training labels. If labels are given over time, the label of the last time step is used
+        device: Device used to compute the embeddings
+        n_lists: Number of cells of the index. Defaults to sqrt(n_samples)
+        n_probe: Number of cells visited per query
+        index_path: If given, the index is loaded from this .npz file when it exists, and saved there otherwise. A hash
+            of the model weights is added to the file name, so that a retrained model gets a new index
+    """
+
+    def __init__(self, model, train_data, train_labels, device, n_lists=None, n_probe=8, index_path=None,
+                 batch_size=500):
+        self.model = model
+        self.device = device
+        self.n_probe = n_probe
+        self.batch_size = batch_size
+        self.calibration_scores = None
+        if index_path is not None:
+            root, ext = os.path.splitext(index_path)
+            index_path = '%s_%s%s' % (root, checkpoint_hash(model)[:10], ext or '.npz')
+        if index_path is not None and os.path.exists(index_path):
+            self.load_index(index_path)
+        else:
+            labels = np.asarray(train_labels).reshape(len(train_labels), -1)[:, -1].astype(int)
+            self._build_index(self.embed(train_data), labels, n_lists)
+            if index_path is not None:
+                self.save_index(index_path)
+        self.n_classes = max(2, int(self.labels.max()) + 1)
+
+    def embed(self, data):
+        regres = self.model.regres
+        self.model.regres = False
+        self.model.to(self.device)
+        self.model.eval()
+        embeddings = []
+        with torch.no_grad():
+            for i in range(0, len(data), self.batch_size):
+                batch = torch.Tensor(np.asarray(data[i:i + self.batch_size])).to(self.device)
+                embeddings.append(self.model(batch).cpu().numpy())
+        self.model.regres = regres
+        return np.concatenate(embeddings, 0).astype(np.float32)
+
+    @staticmethod
+    def _sq_distances(x, y):
+        return np.maximum((x**2).sum(1)[:, None] - 2 * np.matmul(x, y.T) + (y**2).sum(1)[None, :], 0)
+
+    def _build_index(self, embeddings, labels, n_lists=None, n_iter=20):
+        n_lists = min(n_lists or max(1, int(np.sqrt(len(embeddings)))), len(embeddings))
+        rng = np.random.RandomState(1234)
+        centroids = embeddings[rng.choice(len(embeddings), n_lists, replace=False)]
+        for _ in range(n_iter):
+            assignment = np.argmin(self._sq_distances(embeddings, centroids), 1)
+            counts = np.bincount(assignment, minlength=n_lists)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, embeddings)
+            # Empty cells keep their previous centroid
+            centroids = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None], centroids)
+        assignment = np.argmin(self._sq_distances(embeddings, centroids), 1)
+        order = np.argsort(assignment, kind='stable')
+        self.centroids = centroids
+        self.embeddings = embeddings[order]
+        self.labels = labels[order]
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=n_lists))])
+
+    def save_index(self, path):
+        np.savez(path, centroids=self.centroids, embeddings=self.embeddings, labels=self.labels,
+                 list_offsets=self.list_offsets)
+
+    def load_index(self, path):
+        index = np.load(path)
+        self.centroids = index['centroids']
+        self.embeddings = index['embeddings']
+        self.labels = index['labels']
+        self.list_offsets = index['list_offsets']
+
+    def search(self, queries, _nearest_neighbors=10):
+        """
+        Approximate nearest neighbours of a batch of embeddings
+        :return: Indices (into self.embeddings/self.labels) and squared distances. Shape:[n_queries, _nearest_neighbors]
+        """
+        k = _nearest_neighbors
+        cell_order = np.argsort(self._sq_distances(queries, self.centroids), 1)
+        indices = np.zeros((len(queries), k), dtype=int)
+        distances = np.zeros((len(queries), k))
+        for q, query in enumerate(queries):
+            # Visit at least n_probe cells, and more if they do not hold k candidates
+            n_cells = self.n_probe
+            while True:
+                cells = cell_order[q, :n_cells]
+                candidates = np.concatenate([np.arange(self.list_offsets[c], self.list_offsets[c + 1]) for c in cells])
+                if len(candidates) >= k or n_cells >= len(self.centroids):
+                    break
+                n_cells = n_cells * 2
+            d = self._sq_distances(query[None, :], self.embeddings[candidates])[0]
+            nearest = np.argsort(d)[:k]
+            indices[q, :len(nearest)] = candidates[nearest]
+            distances[q, :len(nearest)] = d[nearest]
+        return indices, distances
+
+    def _nonconformity(self, neighbor_labels):
+        # alpha(x, j): number of neighbours that do not agree with label j
+        return np.stack([(neighbor_labels != j).sum(1) for j in range(self.n_classes)], 1)
+
+    def calibrate(self, calibration_data=None, calibration_labels=None, _nearest_neighbors=10, n_calibration=1000):
+        """ Nonconformity scores of the true labels on a calibration set. If no calibration set is given, a random
+        subset of the training samples is used and each sample is excluded from its own neighbourhood
+        """
+        if calibration_data is None:
+            rng = np.random.RandomState(1234)
+            sample_ind = rng.choice(len(self.embeddings), min(n_calibration, len(self.embeddings)), replace=False)
+            indices, _ = self.search(self.embeddings[sample_ind], _nearest_neighbors + 1)
+            indices = np.stack([row[row != i][:_nearest_neighbors] for row, i in zip(indices, sample_ind)])
+            calibration_labels = self.labels[sample_ind]
+        else:
+            indices, _ = self.search(self.embed(calibration_data), _nearest_neighbors)
+            calibration_labels = np.asarray(calibration_labels).reshape(len(calibration_labels), -1)[:, -1].astype(int)
+        alpha = self._nonconformity(self.labels[indices])
+        self.calibration_scores = alpha[np.arange(len(alpha)), calibration_labels]
+
+    def _scores(self, embeddings, _nearest_neighbors):
+        if self.calibration_scores is None:
+            self.calibrate(_nearest_neighbors=_nearest_neighbors)
+        indices, _ = self.search(embeddings, _nearest_neighbors)
+        knn_labels = self.labels[indices]
+        alpha = self._nonconformity(knn_labels)
+        p_values = (self.calibration_scores[None, None, :] >= alpha[:, :, None]).mean(-1)
+        sorted_p = np.sort(p_values, 1)
+        prediction = np.argmax(p_values, 1)
+        confidence = 1 - sorted_p[:, -2]
+        credibility = sorted_p[:, -1]
+        return knn_labels, prediction, confidence, credibility
+
+    def evaluate_confidence(self, sample, sample_label=None, _nearest_neighbors=10, verbose=False):
+        """
+        Deep kNN prediction, confidence and credibility for a batch of samples
+        :param sample: Samples to evaluate. Shape:[batch, features, time]
+        :return: Labels of the nearest training neighbours of each sample
+        """
+        knn_labels, prediction, confidence, credibility = self._scores(self.embed(sample), _nearest_neighbors)
+        if verbose:
+            for i in range(len(knn_labels)):
+                print('Nearest neighbour labels: ', knn_labels[i])
+                print('DkNN prediction: %d, confidence: %.3f, credibility: %.3f' % (prediction[i], confidence[i],
+                                                                                   credibility[i]))
+            if sample_label is not None:
+                print('True label: ', sample_label)
+        return knn_labels
+
+    def evaluate_loader(self, loader, _nearest_neighbors=10):
+        """ Batched Deep kNN scores for every sample of a data loader
+        :return: prediction, confidence and credibility of each sample
+        """
+        embeddings = np.concatenate([self.embed(signals) for signals, _ in loader], 0)
+        _, prediction, confidence, credibility = self._scores(embeddings, _nearest_neighbors)
+        return prediction, confidence, credibility
@@ -0,0 +1,114 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+
+def checkpoint_hash(model):
+    """ Hash of the weights of a model, used to tie stored samples to the generator checkpoint that produced them
+    """
+    h = hashlib.sha1()
+    for k, v in sorted(model.state_dict().items()):
+        h.update(k.encode())
+        h.update(np.ascontiguousarray(v.detach().cpu().numpy()).tobytes())
+    if hasattr(model, 'gmm'):
+        # Mixture generators keep their parameters outside of the state dict
+        for v in (model.gmm.weights_, model.gmm.means_, model.gmm.covariances_):
+            h.update(np.ascontiguousarray(v).tobytes())
+    return h.hexdigest()
+
+
+class CounterfactualStore:
+    """Persistent store of generator samples x_hat_t, indexed by (test sample index, t, feature, sample number)
+    Samples are kept in chunks of memory-mapped arrays under root/<checkpoint hash>_<seed>_<tag>, so repeated explainer
+    runs with the same generator checkpoint and seed read the samples instead of running the generator again.
+    """
+
+    def __init__(self, generator, seed, n_samples, root='./ckpt/counterfactuals', tag='fit', chunk_size=256):
+        """
+        :param generator: Generator model the samples come from
+        :param seed: Random seed of the run, part of the store key
+        :param n_samples: Number of Monte-Carlo samples stored per (sample index, t, feature)
+        :param tag: Identifies how the samples were drawn (e.g. conditional vs joint), part of the store key
+        :param chunk_size: Number of test samples per memory-mapped chunk
+        """
+        self.n_samples = n_samples
+        self.chunk_size = chunk_size
+        self.path = os.path.join(root, '%s_%s_%s' % (checkpoint_hash(generator), str(seed), tag))
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.meta = None
+        meta_file = os.path.join(self.path, 'store.json')
+        if os.path.exists(meta_file):
+            with open(meta_file) as f:
+                self.meta = json.load(f)
+            if self.meta['n_samples'] != n_samples:
+                raise ValueError('Store at %s holds %d samples per entry, %d requested'
+                                 % (self.path, self.meta['n_samples'], n_samples))
+        self._chunks = {}
+
+    def _set_shape(self, t_len, n_features):
+        if self.meta is None:
+            self.meta = {'t_len': int(t_len), 'n_features': int(n_features), 'n_samples': self.n_samples,
+                         'chunk_size': self.chunk_size}
+            with open(os.path.join(self.path, 'store.json'), 'w') as f:
+                json.dump(self.meta, f)
+        elif self.meta['t_len'] != t_len or self.meta['n_features'] != n_features:
+            raise ValueError('Store at %s holds a different data shape' % self.path)
+
+    def _chunk(self, c, create):
+        if c in self._chunks:
+            return self._chunks[c]
+        samples_file = os.path.join(self.path, 'samples_%d.dat' % c)
+        filled_file = os.path.join(self.path, 'filled_%d.dat' % c)
+        cs, t_len, n_features = self.meta['chunk_size'], self.meta['t_len'], self.meta['n_features']
+        if os.path.exists(samples_file):
+            mode = 'r+'
+        elif create:
+            mode = 'w+'
+        else:
+            return None
+        samples = np.memmap(samples_file, dtype=np.float32, mode=mode,
+                            shape=(cs, t_len, n_features, self.n_samples, n_features))
+        filled = np.memmap(filled_file, dtype=np.uint8, mode=mode, shape=(cs, t_len, n_features))
+        self._chunks[c] = (samples, filled)
+        return self._chunks[c]
+
+    def get(self, ids, t, feature):
+        """
+        :param ids: Test set indices of the batch
+        :return: Stored samples of shape [n_samples, batch, features], or None unless all of them are stored
+        """
+        if self.meta is None:
+            return None
+        ids = np.asarray(ids)
+        out = np.empty((self.n_samples, len(ids), self.meta['n_features']), dtype=np.float32)
+        for c in np.unique(ids // self.meta['chunk_size']):
+            chunk = self._chunk(c, create=False)
+            mask = ids // self.meta['chunk_size'] == c
+            if chunk is None:
+                return None
+            offsets = ids[mask] % self.meta['chunk_size']
+            if not chunk[1][offsets, t, feature].all():
+                return None
+            out[:, mask] = np.transpose(chunk[0][offsets, t, feature], (1, 0, 2))
+        return out
+
+    def put(self, ids, t, feature, samples, t_len):
+        """
+        :param samples: Samples of shape [n_samples, batch, features]
+        :param t_len: Length of the time series, needed to allocate the store on the first write
+        """
+        self._set_shape(t_len, samples.shape[-1])
+        ids = np.asarray(ids)
+        for c in np.unique(ids // self.meta['chunk_size']):
+            chunk = self._chunk(c, create=True)
+            mask = ids // self.meta['chunk_size'] == c
+            offsets = ids[mask] % self.meta['chunk_size']
+            chunk[0][offsets, t, feature] = np.transpose(samples[:, mask], (1, 0, 2))
+            chunk[1][offsets, t, feature] = 1
+
+    def flush(self):
+        for samples, filled in self._chunks.values():
+            samples.flush()
+            filled.flush()
@@ -0,0 +1,205 @@
+import os
+import json
+import copy
+import bisect
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+from TSX.array_store import save_arrays, load_array
+
+
+MANIFEST = 'shards.json'
+
+
+def _read_manifest(path):
+    manifest_file = os.path.join(path, MANIFEST)
+    if not os.path.exists(manifest_file):
+        return {'attributes': {}, 'splits': {}}
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+class ShardWriter:
+    """Writes a split of a cohort as fixed-size shards of float32 signals [N, F, T], labels and (optional) missingness
+    masks, without ever holding more than one shard in memory. Each shard is stored with TSX.array_store, and the
+    shards of every split are listed in path/shards.json
+    """
+
+    def __init__(self, path, split, shard_size=4096, attributes=None):
+        """
+        :param split: Name of the split (e.g. 'train', 'valid', 'test')
+        :param shard_size: Number of samples per shard
+        :param attributes: Dataset attributes stored in the manifest (e.g. pos_weight)
+        """
+        self.path = path
+        self.split = split
+        self.shard_size = shard_size
+        self.attributes = attributes or {}
+        self.shards = []
+        self._buffer = {'x': [], 'y': [], 'mask': []}
+        self._n_buffered = 0
+        self._shape = None
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def append(self, signals, labels, masks=None):
+        self._buffer['x'].append(np.asarray(signals, dtype=np.float32))
+        self._buffer['y'].append(np.asarray(labels, dtype=np.float32))
+        if masks is not None:
+            self._buffer['mask'].append(np.asarray(masks, dtype=np.float32))
+        self._n_buffered += len(signals)
+        while self._n_buffered >= self.shard_size:
+            self._write(self.shard_size)
+
+    def _write(self, n):
+        arrays = {name: np.concatenate(chunks) for name, chunks in self._buffer.items() if len(chunks)}
+        prefix = '%s_%05d_' % (self.split, len(self.shards))
+        save_arrays(self.path, {name: array[:n] for name, array in arrays.items()}, prefix=prefix)
+        self.shards.append({'prefix': prefix, 'n_samples': int(n)})
+        self._buffer = {name: [arrays[name][n:]] if name in arrays else [] for name in self._buffer}
+        self._n_buffered -= n
+        self._shape = arrays['x'].shape[1:]
+
+    def close(self):
+        if self._n_buffered > 0:
+            self._write(self._n_buffered)
+        if self._shape is None:
+            raise ValueError('No samples were written to split %s' % self.split)
+        manifest = _read_manifest(self.path)
+        manifest['attributes'].update(self.attributes)
+        manifest['splits'][self.split] = {'shards': self.shards, 'n_samples': sum(s['n_samples'] for s in self.shards),
+                                          'feature_size': int(self._shape[0]), 'time': int(self._shape[1])}
+        with open(os.path.join(self.path, MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+
+def write_shards(path, split, signals, labels, masks=None, shard_size=4096, attributes=None):
+    """ Write in-memory arrays of a split as shards (see ShardWriter)
+    """
+    writer = ShardWriter(path, split, shard_size=shard_size, attributes=attributes)
+    for i in range(0, len(signals), shard_size):
+        writer.append(signals[i:i + shard_size], labels[i:i + shard_size],
+                      None if masks is None else masks[i:i + shard_size])
+    writer.close()
+
+
+def write_loader_shards(path, split, loader, shard_size=4096, attributes=None):
+    """ Write the (signals, labels) batches of a loader as shards, e.g. to convert an existing dataset
+    """
+    writer = ShardWriter(path, split, shard_size=shard_size, attributes=attributes)
+    for signals, labels in loader:
+        writer.append(signals.numpy(), labels.numpy())
+    writer.close()
+
+
+class ShardedDataset(IterableDataset):
+    """Streams a sharded split from disk, as contiguous batches of batch_size samples (see batched()).
+    Shards are memory-mapped one at a time and split between the DataLoader workers. Copies returned by shard() only
+    yield the samples of one data-parallel rank, and all the ranks get the same number of samples. With shuffle, the
+    shards are visited in a random order and the samples of each shard are permuted before being cut into batches.
+    Single samples can also be accessed by index, as with a map-style dataset.
+    """
+
+    def __init__(self, path, split, shuffle=False, batch_size=1, return_mask=False):
+        """
+        :param return_mask: Yield (signals, labels, mask) instead of (signals, labels)
+        """
+        self.path = path
+        self.split = split
+        self.shuffle = shuffle
+        self.batch_size = batch_size
+        self.return_mask = return_mask
+        info = _read_manifest(path)['splits'][split]
+        self.shards = info['shards']
+        self.n_samples = info['n_samples']
+        self.feature_size = info['feature_size']
+        self._offsets = np.cumsum([0] + [s['n_samples'] for s in self.shards])
+        self.rank = 0
+        self.world_size = 1
+
+    def shard(self, rank, world_size):
+        """ Copy of the dataset restricted to the samples of one data-parallel worker
+        """
+        dataset = copy.copy(self)
+        dataset.rank, dataset.world_size = rank, world_size
+        return dataset
+
+    def batched(self, batch_size):
+        """ Copy of the dataset yielding batches of batch_size samples, to be loaded with DataLoader(batch_size=None)
+        """
+        dataset = copy.copy(self)
+        dataset.batch_size = batch_size
+        return dataset
+
+    def __len__(self):
+        return self.n_samples // self.world_size
+
+    def _fields(self):
+        return ['x', 'y', 'mask'] if self.return_mask else ['x', 'y']
+
+    def _load_shard(self, shard):
+        return [load_array(self.path, name, prefix=shard['prefix']) for name in self._fields()]
+
+    def _batches(self, shard_ids, rng):
+        per_rank = self.n_samples // self.world_size
+        pending = None
+        for s in shard_ids:
+            rows = np.arange(self._offsets[s], self._offsets[s + 1])
+            # Strided split over the ranks, dropping the last samples so that every rank gets per_rank of them
+            keep = (rows % self.world_size == self.rank) & (rows < per_rank * self.world_size)
+            local = np.nonzero(keep)[0]
+            if self.shuffle:
+                rng.shuffle(local)
+            # A single copy of the samples of the shard, in the order they are yielded
+            arrays = [np.ascontiguousarray(a[local]) for a in self._load_shard(self.shards[s])]
+            # Samples left over from the previous shard complete the first batch
+            if pending is not None:
+                arrays = [np.concatenate([p, a]) for p, a in zip(pending, arrays)]
+            n_full = len(arrays[0]) // self.batch_size * self.batch_size
+            for i in range(0, n_full, self.batch_size):
+                yield tuple(torch.from_numpy(a[i:i + self.batch_size]) for a in arrays)
+            pending = [a[n_full:] for a in arrays]
+        if pending is not None and len(pending[0]) > 0:
+            yield tuple(torch.from_numpy(a) for a in pending)
+
+    def __iter__(self):
+        worker = get_worker_info()
+        worker_id, n_workers = (0, 1) if worker is None else (worker.id, worker.num_workers)
+        # Drawn from the torch random state, which keeps advancing in persistent workers, so every epoch is shuffled
+        # differently
+        seed = int(torch.randint(2**31 - 1, (1,)))
+        rng = np.random.RandomState(seed % 2**32)
+        shard_ids = list(range(worker_id, len(self.shards), n_workers))
+        if self.shuffle:
+            rng.shuffle(shard_ids)
+        return self._batches(shard_ids, rng)
+
+    def __getitem__(self, index):
+        s = bisect.bisect_right(self._offsets, index) - 1
+        arrays = self._load_shard(self.shards[s])
+        return tuple(torch.from_numpy(np.array(a[index - self._offsets[s]])) for a in arrays)
+
+    @property
+    def tensors(self):
+        """ The whole split in memory, as (signals, labels[, mask]) tensors
+        """
+        arrays = [self._load_shard(shard) for shard in self.shards]
+        return tuple(torch.from_numpy(np.concatenate([a[k] for a in arrays])) for k in range(len(self._fields())))
+
+
+class ShardedData():
+    """Dataset attributes of a sharded cohort, mirroring those of PatientData
+    Args:
+        root: Directory of the shards and of their manifest
+    """
+
+    def __init__(self, root):
+        manifest = _read_manifest(root)
+        if 'train' not in manifest['splits']:
+            raise RuntimeError('Dataset not found')
+        self.root = root
+        self.feature_size = manifest['splits']['train']['feature_size']
+        self.len_of_stay = manifest['splits']['train']['time']
+        self.n_train = manifest['splits']['train']['n_samples']
+        self.n_test = manifest['splits']['test']['n_samples'] if 'test' in manifest['splits'] else 0
+        self.pos_weight = manifest['attributes'].get('pos_weight', None)
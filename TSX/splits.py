@@ -0,0 +1,35 @@
+import numpy as np
+from TSX.array_store import save_arrays, load_array, has_arrays, array_names
+
+
+def cached_splits(path, key, make_splits):
+    """
+    Train/validation split indices of a dataset, computed once and stored alongside the data in
+    path/splits_<key>_*.npy, so that every run (and every parallel cross-validation worker) gets the same folds
+    :param key: Identifies the dataset and the split settings (e.g. task, number of samples)
+    :param make_splits: Function returning a dictionary of split name -> indices, only called when the splits of key
+                        are not stored yet
+    :return: Dictionary of split name -> indices, as slices for contiguous indices (so that indexing gives views)
+    """
+    prefix = 'splits_%s_' % key
+    if not has_arrays(path, prefix):
+        save_arrays(path, {name: np.asarray(idx, dtype=np.int64) for name, idx in make_splits().items()}, prefix=prefix)
+    return {name: index_view(load_array(path, name, prefix=prefix, mmap_mode='r'))
+            for name in array_names(path, prefix)}
+
+
+def index_view(idx):
+    """ Slice equivalent to an array of increasing contiguous indices, or the indices themselves
+    """
+    idx = np.asarray(idx)
+    if len(idx) > 0 and np.all(np.diff(idx) == 1):
+        return slice(int(idx[0]), int(idx[-1]) + 1)
+    return idx
+
+
+def fold(splits, cv=None):
+    """ (train, valid) indices of cross-validation fold cv, or of the default split when cv is None
+    """
+    if cv is None:
+        return splits['train'], splits['valid']
+    return splits['train_%d' % cv], splits['valid_%d' % cv]
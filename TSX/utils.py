@@ -1,10 +1,13 @@
 import numpy as np
 import os, sys
 import torch
-import torch.utils.data as utils
-from torch.utils.data import DataLoader
 from sklearn.metrics import precision_score, roc_auc_score
 from TSX.models import PatientData, NormalPatientData, GHGData
+from TSX.distributed import distributed_optimizer, is_main_process
+from TSX.loaders import make_loader, loader_params, as_float_tensor, ArrayDataset
+from TSX.array_store import load_array
+from TSX.sharded_data import ShardedData, ShardedDataset
+from TSX.splits import cached_splits, fold
 import matplotlib.pyplot as plt
 import matplotlib
 import pickle as pkl
@@ -106,95 +109,147 @@ def evaluate_multiclass(labels, predicted_label, predicted_probability, task='mu
     return auc, recall, precision, correct_label, auc_list
 
 
-def test(test_loader, model, device, criteria=torch.nn.CrossEntropyLoss(), verbose=True):
-    model.to(device)
-    correct_label = 0
-    recall_test, precision_test, auc_test = 0, 0, 0
-    count = 0
-    loss = 0
-    total = 0
-    auc_test = 0
-    model.eval()
-    for i, (x, y) in enumerate(test_loader):
-        x, y = torch.Tensor(x.float()).to(device), torch.Tensor(y.float()).to(device)
-        out = model(x)
-        y = y.view(y.shape[0], )
-
-        risks = torch.nn.Softmax(-1)(out)[:,1]
-
-        label_onehot = torch.zeros(out.shape).to(device)
-        pred_onehot = torch.zeros(out.shape).to(device)
-        _, predicted_label = out.max(1)
-        pred_onehot.scatter_(1, predicted_label.view(-1, 1), 1)
+class MetricAccumulator(object):
+    """Accumulates predicted probabilities, labels and losses on device over an epoch. The metrics are computed once,
+    on the whole epoch, in compute()
+    :param task: 'binary' (probabilities and labels of shape [N]), 'onehot' (class probabilities and label indices),
+                 'multiclass' (class probabilities and one-hot labels) or 'multilabel' (probabilities and binary labels)
+    """
 
-        label_onehot.zero_()
-        label_onehot.scatter_(1, y.long().view(-1, 1), 1)
-
-        auc, recall, precision, correct = evaluate(label_onehot, pred_onehot, torch.nn.Softmax(-1)(out))
+    def __init__(self, task='onehot'):
+        self.task = task
+        self.reset()
 
-        # prediction = (out > 0.5).view(len(y), ).float()
-        # auc, recall, precision, correct = evaluate(y, prediction, out)
-        correct_label += correct
-        auc_test = auc_test + auc
-        recall_test = + recall
-        precision_test = + precision
-        count = + 1
-        loss += criteria(out, y.long()).item()
-        total += len(x)
-    return recall_test, precision_test, auc_test / (i + 1), correct_label, loss
+    def reset(self):
+        self.probabilities = []
+        self.labels = []
+        self.loss = 0
+        self.n_batches = 0
+
+    def update(self, probabilities, labels, loss=None):
+        self.probabilities.append(probabilities.detach())
+        self.labels.append(labels.detach())
+        self.add_loss(loss)
+
+    def add_loss(self, loss):
+        if loss is not None:
+            self.loss = self.loss + loss.detach()
+            self.n_batches += 1
+
+    def loss_sum(self):
+        return float(self.loss)
+
+    def n_samples(self):
+        return sum(len(p) for p in self.probabilities)
+
+    def compute(self):
+        """ :return: auc, recall, precision, number of correct predictions (and the per-class AUC for multiclass and
+        multilabel tasks)
+        """
+        probabilities = torch.cat(self.probabilities, 0)
+        labels = torch.cat(self.labels, 0)
+        if self.task == 'binary':
+            return evaluate_binary(labels.view(-1), (probabilities > 0.5).float().view(-1), probabilities.view(-1))
+        if self.task == 'onehot':
+            n_classes = probabilities.shape[-1]
+            label_onehot = torch.nn.functional.one_hot(labels.long().view(-1), n_classes).float()
+            pred_onehot = torch.nn.functional.one_hot(probabilities.argmax(-1), n_classes).float()
+            return evaluate(label_onehot, pred_onehot, probabilities)
+        if self.task == 'multiclass':
+            pred_onehot = torch.nn.functional.one_hot(probabilities.argmax(-1), probabilities.shape[-1]).float()
+        else:
+            pred_onehot = (probabilities > 0.5).float()
+        return evaluate_multiclass(labels, pred_onehot, probabilities, task=self.task)
+
+
+def predict_all_timesteps(model, signals):
+    """ Predictions of a classifier at every time step of signals, from a single forward pass (using return_all)
+    :return: Predictions of shape [batch, n_classes, time]
+    """
+    return_all = model.return_all
+    model.return_all = True
+    predictions = model(signals)
+    model.return_all = return_all
+    return predictions.reshape(signals.shape[0], -1, signals.shape[-1])
+
+
+def select_timesteps(x, time_points=None):
+    """ Flatten the time steps of a batch into the batch dimension, keeping only time_points (all of them if None)
+    :param x: Tensor of shape [batch, classes, time] or [batch, time]
+    :return: Tensor of shape [batch*len(time_points), classes] or [batch*len(time_points)]
+    """
+    if time_points is not None:
+        x = x[..., list(time_points)]
+    if len(x.shape) == 2:
+        return x.reshape(-1)
+    return x.permute(0, 2, 1).reshape(-1, x.shape[1])
+
+
+def test(test_loader, model, device, criteria=torch.nn.CrossEntropyLoss(), verbose=True, compute_metrics=True):
+    model.to(device)
+    model.eval()
+    metrics = MetricAccumulator('onehot')
+    with torch.no_grad():
+        for i, (x, y) in enumerate(test_loader):
+            x, y = torch.Tensor(x.float()).to(device), torch.Tensor(y.float()).to(device)
+            out = model(x)
+            y = y.view(y.shape[0], )
+            loss = criteria(out, y.long())
+            if compute_metrics:
+                metrics.update(torch.nn.Softmax(-1)(out), y, loss)
+            else:
+                metrics.add_loss(loss)
+    loss = metrics.loss_sum()
+    if not compute_metrics:
+        return 0, 0, 0, 0, loss
+    auc_test, recall_test, precision_test, correct_label = metrics.compute()
+    return recall_test, precision_test, auc_test, correct_label, loss
 
 
-def train(train_loader, model, device, optimizer, loss_criterion=torch.nn.CrossEntropyLoss()):
+def train(train_loader, model, device, optimizer, loss_criterion=torch.nn.CrossEntropyLoss(), compute_metrics=True):
     model = model.to(device)
     model.train()
-    auc_train = 0
-    recall_train, precision_train, auc_train, correct_label, epoch_loss = 0, 0, 0, 0, 0
+    metrics = MetricAccumulator('onehot')
     for i, (signals, labels) in enumerate(train_loader):
         optimizer.zero_grad()
         signals, labels = torch.Tensor(signals.float()).to(device), torch.Tensor(labels.float()).to(device)
         labels = labels.view(labels.shape[0], )
-        labels = labels.view(labels.shape[0], )
         logits = model(signals)
-        risks = torch.nn.Softmax(-1)(logits)[:,1]
-
-        label_onehot = torch.zeros(logits.shape).to(device)
-        pred_onehot = torch.zeros(logits.shape).to(device)
-        _, predicted_label = logits.max(1)
-        pred_onehot.scatter_(1, predicted_label.view(-1, 1), 1)
-
-        # labels_th = (labels[:,t]>0.5).float()
-        label_onehot.zero_()
-        label_onehot.scatter_(1, labels.long().view(-1, 1), 1)
-
-        # auc, recall, precision, correct = evaluate(labels_th.contiguous().view(-1), predicted_label.contiguous().view(-1), predictions.contiguous().view(-1))
-        auc, recall, precision, correct = evaluate(label_onehot, pred_onehot, torch.nn.Softmax(-1)(logits))
-
-        # auc, recall, precision, correct = evaluate(label_onehot, predicted_label, risks)
-        correct_label += correct
-        auc_train = auc_train + auc
-        recall_train = + recall
-        precision_train = + precision
 
         loss = loss_criterion(logits, labels.long())
-        epoch_loss = + loss.item()
+        if compute_metrics:
+            metrics.update(torch.nn.Softmax(-1)(logits), labels, loss)
+        else:
+            metrics.add_loss(loss)
         loss.backward()
         optimizer.step()
-    return recall_train, precision_train, auc_train / (i + 1), correct_label, epoch_loss, i + 1
-
-
-def train_model(model, train_loader, valid_loader, optimizer, n_epochs, device, experiment, data='mimic',cv=0):
+    epoch_loss = metrics.loss_sum() / (i + 1)
+    if not compute_metrics:
+        return 0, 0, 0, 0, epoch_loss, i + 1
+    auc_train, recall_train, precision_train, correct_label = metrics.compute()
+    return recall_train, precision_train, auc_train, correct_label, epoch_loss, i + 1
+
+
+def train_model(model, train_loader, valid_loader, optimizer, n_epochs, device, experiment, data='mimic',cv=0,
+                metric_every=10):
+    """
+    :param metric_every: AUC, accuracy, precision and recall are only computed (and printed) every metric_every epochs
+    """
+    optimizer = distributed_optimizer(optimizer, model)
     train_loss_trend = []
     test_loss_trend = []
 
     for epoch in range(n_epochs + 1):
+        compute_metrics = epoch % metric_every == 0
         recall_train, precision_train, auc_train, correct_label_train, epoch_loss, n_batches = train(train_loader,
                                                                                                      model,
-                                                                                                     device, optimizer)
+                                                                                                     device, optimizer,
+                                                                                                     compute_metrics=compute_metrics)
         recall_test, precision_test, auc_test, correct_label_test, test_loss = test(valid_loader, model,
-                                                                                    device)
+                                                                                    device, compute_metrics=compute_metrics)
         train_loss_trend.append(epoch_loss)
         test_loss_trend.append(test_loss)
-        if epoch % 10 == 0:
+        if compute_metrics:
             print('\nEpoch %d' % (epoch))
             print('Training ===>loss: ', epoch_loss,
                   ' Accuracy: %.2f percent' % (100 * correct_label_train / (len(train_loader.dataset))),
@@ -204,6 +259,8 @@ def train_model(model, train_loader, valid_loader, optimizer, n_epochs, device,
                   ' AUC: %.2f' % (auc_test))
 
     # Save model and results
+    if not is_main_process():
+        return
     if not os.path.exists(os.path.join("./ckpt/", data)):
         os.mkdir(os.path.join("./ckpt/", data))
     if not os.path.exists(os.path.join("./plots/", data)):
@@ -215,16 +272,26 @@ def train_model(model, train_loader, valid_loader, optimizer, n_epochs, device,
     plt.savefig(os.path.join('./plots', data, 'train_loss.pdf'))
 
 
-def train_model_multiclass(model, train_loader, valid_loader, optimizer, n_epochs, device, experiment, data='ddg',num=5, loss_criterion=torch.nn.CrossEntropyLoss(),cv=0):
+def train_model_multiclass(model, train_loader, valid_loader, optimizer, n_epochs, device, experiment, data='ddg',num=5, loss_criterion=torch.nn.CrossEntropyLoss(),cv=0,
+                           metric_every=1, single_pass=False, supervise_all=False):
+    """
+    :param single_pass: Get the predictions at every time step from one forward pass of the whole sequence (return_all)
+                        and take one optimizer step per batch on the loss over the sampled time points, instead of a
+                        forward pass and an optimizer step per time point
+    :param supervise_all: With single_pass, the loss is taken over all time steps instead of the sampled time points
+    """
+    optimizer = distributed_optimizer(optimizer, model)
     print('Training black-box model on ', data)
     train_loss_trend = []
     test_loss_trend = []
 
     model.to(device)
+    multiclass = type(loss_criterion).__name__==type(torch.nn.CrossEntropyLoss()).__name__
 
     for epoch in range(n_epochs):
         model.train()
-        recall_train, precision_train, auc_train, correct_label_train, epoch_loss, count = 0, 0, 0, 0, 0, 0
+        compute_metrics = epoch % metric_every == 0
+        metrics = MetricAccumulator('multiclass' if multiclass else 'multilabel')
         for i, (signals, labels) in enumerate(train_loader):
             signals, labels = signals.to(device), labels.to(device)
             if num>1:
@@ -235,6 +302,29 @@ def train_model_multiclass(model, train_loader, valid_loader, optimizer, n_epoch
             else:
                 time_points = [signals.shape[-1]-1]
 
+            if single_pass:
+                optimizer.zero_grad()
+                predictions = predict_all_timesteps(model, signals)
+                if len(labels.shape)==3: #has labels over time
+                    label = labels
+                else:
+                    label = labels.unsqueeze(-1).expand(-1, -1, signals.shape[-1])
+                steps = None if supervise_all else time_points
+                predictions, label_onehot = select_timesteps(predictions, steps), select_timesteps(label, steps)
+                if multiclass:
+                    _, targets = label_onehot.max(1)
+                    targets = targets.long()
+                else: #multilabel
+                    targets = label_onehot
+                reconstruction_loss = loss_criterion(predictions, targets)
+                if compute_metrics:
+                    metrics.update(torch.sigmoid(predictions), label_onehot, reconstruction_loss)
+                else:
+                    metrics.add_loss(reconstruction_loss)
+                reconstruction_loss.backward()
+                optimizer.step()
+                continue
+
             for t in time_points:
                 input_signal = signals[:,:,:(t+1)]
 
@@ -245,45 +335,34 @@ def train_model_multiclass(model, train_loader, valid_loader, optimizer, n_epoch
                     label = labels[:, :, t]
                 else:
                     label = labels
-                
+
                 label_onehot = label # assumed already one-hot encoded
-                if type(loss_criterion).__name__==type(torch.nn.CrossEntropyLoss()).__name__:
-                    pred_onehot = torch.zeros(predictions.shape).to(device)
-                    _, predicted_label = predictions.max(1)
-                    pred_onehot.scatter_(1, predicted_label.view(-1, 1), 1)
-                    task='multiclass'
-                else:
-                    pred_onehot  = (torch.sigmoid(predictions) > 0.5).float()
-                    task='multilabel'
-
-                auc, recall, precision, correct,auc_list = evaluate_multiclass(label_onehot, pred_onehot, predictions,task=task)
-                correct_label_train += correct
-                auc_train += auc
-                recall_train += recall
-                precision_train += precision
-                count += 1
-
-                if type(loss_criterion).__name__==type(torch.nn.CrossEntropyLoss()).__name__:#multiclass
-                    #print('here')
+                if multiclass:
                     _, targets = label.max(1)
                     targets = targets.long()
                 else: #multilabel
                     targets = label_onehot
                 reconstruction_loss = loss_criterion(predictions, targets)
-                epoch_loss += reconstruction_loss.item()
+                if compute_metrics:
+                    metrics.update(torch.sigmoid(predictions), label_onehot, reconstruction_loss)
+                else:
+                    metrics.add_loss(reconstruction_loss)
                 reconstruction_loss.backward()
                 optimizer.step()
 
-        test_loss, recall_test, precision_test, auc_test, correct_label_test = test_model_multiclass(model, valid_loader,num=num,loss_criterion=loss_criterion)
+        test_loss, recall_test, precision_test, auc_test, correct_label_test = test_model_multiclass(model, valid_loader,num=num,loss_criterion=loss_criterion,
+                                                                                                     compute_metrics=compute_metrics)
 
-        train_loss_trend.append(epoch_loss / ((i + 1) *num))
+        epoch_loss = metrics.loss_sum() / metrics.n_batches
+        train_loss_trend.append(epoch_loss)
         test_loss_trend.append(test_loss)
 
-        if epoch % 1 == 0:
+        if compute_metrics:
+            auc_train, recall_train, precision_train, correct_label_train, _ = metrics.compute()
             print('\nEpoch %d' % (epoch))
-            print('Training ===>loss: ', epoch_loss / ((i + 1)*num),
-                  ' Accuracy: %.2f percent' % (100 * correct_label_train / (len(train_loader.dataset) *num)),
-                  ' AUC: %.2f' % (auc_train / ((i + 1) * num)))
+            print('Training ===>loss: ', epoch_loss,
+                  ' Accuracy: %.2f percent' % (100 * correct_label_train / metrics.n_samples()),
+                  ' AUC: %.2f' % (auc_train))
             print('Test ===>loss: ', test_loss,
                   ' Accuracy: %.2f percent' % (100 * correct_label_test / (len(valid_loader.dataset)* num)),
                   ' AUC: %.2f' % (auc_test))
@@ -292,6 +371,8 @@ def train_model_multiclass(model, train_loader, valid_loader, optimizer, n_epoch
     print('Test AUC: ', auc_test)
 
     # Save model and results
+    if not is_main_process():
+        return
     if not os.path.exists(os.path.join("./ckpt/", data)):
         os.mkdir(os.path.join("./ckpt/", data))
     torch.save(model.state_dict(), './ckpt/' + data + '/' + str(experiment) + '_'+ str(cv) + '.pt')
@@ -302,7 +383,14 @@ def train_model_multiclass(model, train_loader, valid_loader, optimizer, n_epoch
 
 
 def train_model_rt(model, train_loader, valid_loader, optimizer, n_epochs, device, experiment, data='simulation',
-                   num=5,cv=0):
+                   num=5,cv=0,metric_every=10, single_pass=False, supervise_all=False):
+    """
+    :param single_pass: Get the predictions at every time step from one forward pass of the whole sequence (return_all)
+                        and take one optimizer step per batch on the loss over the selected time points, instead of a
+                        forward pass and an optimizer step per time point
+    :param supervise_all: With single_pass, the loss is taken over all time steps instead of the selected time points
+    """
+    optimizer = distributed_optimizer(optimizer, model)
     print('Training black-box model on ', data)
     train_loss_trend = []
     test_loss_trend = []
@@ -311,7 +399,8 @@ def train_model_rt(model, train_loader, valid_loader, optimizer, n_epochs, devic
     loss_criterion = torch.nn.CrossEntropyLoss()
     for epoch in range(n_epochs):
         model.train()
-        recall_train, precision_train, auc_train, correct_label_train, epoch_loss, count = 0, 0, 0, 0, 0, 0
+        compute_metrics = epoch % metric_every == 0
+        metrics = MetricAccumulator('onehot')
         for i, (signals, labels) in enumerate(train_loader):
             # signals, labels = torch.Tensor(signals.float()).to(device), torch.Tensor(labels.float()).to(device)
             signals, labels = signals.to(device), labels.to(device)
@@ -320,6 +409,19 @@ def train_model_rt(model, train_loader, valid_loader, optimizer, n_epochs, devic
                 time_points = [int(tt) for tt in np.linspace(1, signals.shape[-1] - 2, num=num)]
             else:
                 time_points = [int(tt) for tt in np.logspace(1, np.log10(signals.shape[2] - 1), num=num)]
+            if single_pass:
+                optimizer.zero_grad()
+                steps = None if supervise_all else time_points
+                predictions = select_timesteps(predict_all_timesteps(model, signals), steps)
+                label = select_timesteps(labels, steps)
+                reconstruction_loss = loss_criterion(predictions, label.long())
+                if compute_metrics:
+                    metrics.update(torch.nn.Softmax(-1)(predictions), label, reconstruction_loss)
+                else:
+                    metrics.add_loss(reconstruction_loss)
+                reconstruction_loss.backward()
+                optimizer.step()
+                continue
             for t in time_points:
                 input_signal = signals[:, :, :t + 1]
                 label = labels[:, t]
@@ -327,38 +429,29 @@ def train_model_rt(model, train_loader, valid_loader, optimizer, n_epochs, devic
                 optimizer.zero_grad()
                 predictions = model(input_signal)
 
-                label_onehot = torch.zeros(predictions.shape).to(device)
-                pred_onehot = torch.zeros(predictions.shape).to(device)
-                _, predicted_label = predictions.max(1)
-                pred_onehot.scatter_(1, predicted_label.view(-1, 1), 1)
-
-                label_onehot.zero_()
-                label_onehot.scatter_(1, label.long().view(-1, 1), 1)
-
-                auc, recall, precision, correct,_ = evaluate_multiclass(label_onehot, pred_onehot, predictions)
-                correct_label_train += correct
-                auc_train += auc
-                recall_train += recall
-                precision_train += precision
-                count += 1
-
                 reconstruction_loss = loss_criterion(predictions, label.long())
-                epoch_loss += reconstruction_loss.item()
+                if compute_metrics:
+                    metrics.update(torch.nn.Softmax(-1)(predictions), label, reconstruction_loss)
+                else:
+                    metrics.add_loss(reconstruction_loss)
                 reconstruction_loss.backward()
                 optimizer.step()
 
         test_num = num
         test_loss, recall_test, precision_test, auc_test, correct_label_test = test_model_rt(model, valid_loader,
-                                                                                             num=test_num)
+                                                                                             num=test_num,
+                                                                                             compute_metrics=compute_metrics)
 
-        train_loss_trend.append(epoch_loss / ((i + 1) * num))
+        epoch_loss = metrics.loss_sum() / metrics.n_batches
+        train_loss_trend.append(epoch_loss)
         test_loss_trend.append(test_loss)
 
-        if epoch % 10 == 0:
+        if compute_metrics:
+            auc_train, recall_train, precision_train, correct_label_train = metrics.compute()
             print('\nEpoch %d' % (epoch))
-            print('Training ===>loss: ', epoch_loss / ((i + 1) * num),
-                  ' Accuracy: %.2f percent' % (100 * correct_label_train / (len(train_loader.dataset) * num)),
-                  ' AUC: %.2f' % (auc_train / ((i + 1) * num)))
+            print('Training ===>loss: ', epoch_loss,
+                  ' Accuracy: %.2f percent' % (100 * correct_label_train / metrics.n_samples()),
+                  ' AUC: %.2f' % (auc_train))
             print('Test ===>loss: ', test_loss,
                   ' Accuracy: %.2f percent' % (100 * correct_label_test / (len(valid_loader.dataset) * test_num)),
                   ' AUC: %.2f' % (auc_test))
@@ -367,6 +460,8 @@ def train_model_rt(model, train_loader, valid_loader, optimizer, n_epochs, devic
     print('Test AUC: ', auc_test)
 
     # Save model and results
+    if not is_main_process():
+        return
     if not os.path.exists(os.path.join("./ckpt/", data)):
         os.mkdir(os.path.join("./ckpt/", data))
     torch.save(model.state_dict(), './ckpt/' + data + '/' + str(experiment) + '_'+ str(cv) + '.pt')
@@ -375,7 +470,9 @@ def train_model_rt(model, train_loader, valid_loader, optimizer, n_epochs, devic
     plt.legend()
     plt.savefig(os.path.join('./plots', data, 'train_loss.pdf'))
 
-def train_model_rt_binary(model, train_loader, valid_loader, optimizer, n_epochs, device, experiment, data='simulation',num=5,cv=0):
+def train_model_rt_binary(model, train_loader, valid_loader, optimizer, n_epochs, device, experiment, data='simulation',num=5,cv=0,
+                          metric_every=10):
+    optimizer = distributed_optimizer(optimizer, model)
     train_loss_trend = []
     test_loss_trend = []
 
@@ -383,7 +480,8 @@ def train_model_rt_binary(model, train_loader, valid_loader, optimizer, n_epochs
     loss_criterion = torch.nn.BCEWithLogitsLoss()
     for epoch in range(n_epochs):
         model.train()
-        recall_train, precision_train, auc_train, correct_label_train, epoch_loss, count = 0, 0, 0, 0, 0, 0
+        compute_metrics = epoch % metric_every == 0
+        metrics = MetricAccumulator('binary')
         for i, (signals,labels) in enumerate(train_loader):
             signals, labels = torch.Tensor(signals.float()).to(device), torch.Tensor(labels.float()).to(device)
             if data=='simulation':
@@ -393,32 +491,29 @@ def train_model_rt_binary(model, train_loader, valid_loader, optimizer, n_epochs
 
             for t in time_points:
                 predictions_logits = model(signals[:,:,:t+1])
-                predictions = torch.sigmoid(predictions_logits)
-                predicted_label = (predictions > 0.5).float()
-                labels_th = labels[:,t].float()
-                auc, recall, precision, correct = evaluate_binary(labels_th.contiguous().view(-1), predicted_label.contiguous().view(-1), predictions.contiguous().view(-1))
-                correct_label_train += correct
-                auc_train += auc
-                recall_train += recall
-                precision_train += precision
-                count += 1
                 optimizer.zero_grad()
                 reconstruction_loss = loss_criterion(predictions_logits, labels[:,t].view(-1,1).to(device))
-                epoch_loss += reconstruction_loss.item()
+                if compute_metrics:
+                    metrics.update(torch.sigmoid(predictions_logits).view(-1), labels[:,t].view(-1), reconstruction_loss)
+                else:
+                    metrics.add_loss(reconstruction_loss)
                 reconstruction_loss.backward()
                 optimizer.step()
 
         test_num=num
-        test_loss, recall_test, precision_test, auc_test, correct_label_test = test_model_rt_binary(model,valid_loader,num=test_num)
+        test_loss, recall_test, precision_test, auc_test, correct_label_test = test_model_rt_binary(model,valid_loader,num=test_num,
+                                                                                                    compute_metrics=compute_metrics)
 
+        epoch_loss = metrics.loss_sum()
         train_loss_trend.append(epoch_loss/((i+1)*num))
         test_loss_trend.append(test_loss)
 
-        if epoch % 10 == 0:
+        if compute_metrics:
+            auc_train, recall_train, precision_train, correct_label_train = metrics.compute()
             print('\nEpoch %d' % (epoch))
             print('Training ===>loss: ', epoch_loss/((i+1)*num),
                   ' Accuracy: %.2f percent' % (100 * correct_label_train / (len(train_loader.dataset)*num)),
-                  ' AUC: %.2f' % (auc_train/((i+1)*num)))
+                  ' AUC: %.2f' % (auc_train))
             print('Test ===>loss: ', test_loss,
                   ' Accuracy: %.2f percent' % (100 * correct_label_test / (len(valid_loader.dataset)*test_num)),
                   ' AUC: %.2f' % (auc_test))
@@ -427,6 +522,8 @@ def train_model_rt_binary(model, train_loader, valid_loader, optimizer, n_epochs
     print('Test loss: ', test_loss)
 
     # Save model and results
+    if not is_main_process():
+        return
     if not os.path.exists(os.path.join("./ckpt/", data)):
         os.mkdir(os.path.join("./ckpt/", data))
     torch.save(model.state_dict(), './ckpt/' + data + '/' + str(experiment)  + '_' + str(cv) + '.pt')
@@ -436,6 +533,7 @@ def train_model_rt_binary(model, train_loader, valid_loader, optimizer, n_epochs
     plt.savefig(os.path.join('./plots', data, 'train_loss.pdf'))
 
 
+
 def train_model_rt_rg(model, train_loader, valid_loader, optimizer, n_epochs, device, experiment, data='ghg'):
     print('training data: ', data)
     train_loss_trend = []
@@ -482,74 +580,51 @@ def train_model_rt_rg(model, train_loader, valid_loader, optimizer, n_epochs, de
     plt.savefig(os.path.join('./plots', data, 'train_loss.png'))
 
 
-def test_model_rt(model, test_loader, num=1):
+def test_model_rt(model, test_loader, num=1, compute_metrics=True):
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
     model.to(device)
     model.eval()
-    correct_label_test = 0
-    recall_test, precision_test, auc_test = 0, 0, 0
-    count = 0
-    test_loss = 0
-    for i, (signals, labels) in enumerate(test_loader):
-        signals, labels = torch.Tensor(signals.float()).to(device), torch.Tensor(labels.float()).to(device)
-        for t in [int(tt) for tt in np.linspace(0, signals.shape[2] - 2, num=num)]:
-            label = labels[:,t].view(-1,1)
-            label_onehot = torch.FloatTensor(label.shape[0], 2).to(device)
-            pred_onehot = torch.FloatTensor(label.shape[0], 2).to(device)
-            preds = model(signals[:, :, :t + 1])
-
-            if preds.shape[1]==1 and 0:
-                predictions = torch.cuda.FloatTensor(preds.shape[0], 2).fill_(0)
-                predictions[:,1] = preds[:,0]
-                predictions[:,0] = 1-preds[:,0]
-            else:
-                predictions = preds
-
-            _, predicted_label = predictions.max(1)
-            pred_onehot.zero_()
-            pred_onehot.scatter_(1, predicted_label.view(-1, 1), 1)
-            label_onehot.zero_()
-            label_onehot.scatter_(1, labels[:, t].long().view(-1, 1), 1)
-            auc, recall, precision, correct,_ = evaluate_multiclass(label_onehot, pred_onehot, predictions)
-            correct_label_test += correct
-            auc_test += auc
-            recall_test += recall
-            precision_test += precision
-            count += 1
-            loss_criterion = torch.nn.CrossEntropyLoss()
-            loss = loss_criterion(predictions, labels[:, t].long().to(device))
-            test_loss += loss.item()
+    metrics = MetricAccumulator('onehot')
+    loss_criterion = torch.nn.CrossEntropyLoss()
+    with torch.no_grad():
+        for i, (signals, labels) in enumerate(test_loader):
+            signals, labels = torch.Tensor(signals.float()).to(device), torch.Tensor(labels.float()).to(device)
+            for t in [int(tt) for tt in np.linspace(0, signals.shape[2] - 2, num=num)]:
+                predictions = model(signals[:, :, :t + 1])
+                loss = loss_criterion(predictions, labels[:, t].long().to(device))
+                if compute_metrics:
+                    metrics.update(torch.nn.Softmax(-1)(predictions), labels[:, t], loss)
+                else:
+                    metrics.add_loss(loss)
 
-    test_loss = test_loss / ((i + 1) * num)
-    return test_loss, recall_test, precision_test, auc_test / ((i + 1) * num), correct_label_test
+    test_loss = metrics.loss_sum() / ((i + 1) * num)
+    if not compute_metrics:
+        return test_loss, 0, 0, 0, 0
+    auc_test, recall_test, precision_test, correct_label_test = metrics.compute()
+    return test_loss, recall_test, precision_test, auc_test, correct_label_test
 
-def test_model_rt_binary(model,test_loader,num=1):
+def test_model_rt_binary(model,test_loader,num=1, compute_metrics=True):
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
     model.to(device)
     model.eval()
-    correct_label_test = 0
-    recall_test, precision_test, auc_test = 0, 0, 0
-    count = 0
-    test_loss = 0
-    for i, (signals,labels) in enumerate(test_loader):
-        signals, labels = torch.Tensor(signals.float()).to(device), torch.Tensor(labels.float()).to(device)
-        for t in [int(tt) for tt in np.linspace(0,signals.shape[2]-2,num=num)]:
-        #for t in [24]:
-            prediction_logits = model(signals[:,:,:t+1])
-            prediction = torch.sigmoid(prediction_logits)
-            predicted_label = (prediction > 0.5).float()
-            labels_th = labels[:,t].float()
-            auc, recall, precision, correct = evaluate_binary(labels_th.contiguous().view(-1), predicted_label.contiguous().view(-1), prediction.contiguous().view(-1))
-            correct_label_test += correct
-            auc_test += auc
-            recall_test +=  recall
-            precision_test +=  precision
-            count +=  1
-            loss = torch.nn.BCEWithLogitsLoss()(prediction_logits, labels[:,t].view(-1,1).to(device))
-            test_loss += loss.item()
+    metrics = MetricAccumulator('binary')
+    with torch.no_grad():
+        for i, (signals,labels) in enumerate(test_loader):
+            signals, labels = torch.Tensor(signals.float()).to(device), torch.Tensor(labels.float()).to(device)
+            for t in [int(tt) for tt in np.linspace(0,signals.shape[2]-2,num=num)]:
+            #for t in [24]:
+                prediction_logits = model(signals[:,:,:t+1])
+                loss = torch.nn.BCEWithLogitsLoss()(prediction_logits, labels[:,t].view(-1,1).to(device))
+                if compute_metrics:
+                    metrics.update(torch.sigmoid(prediction_logits).view(-1), labels[:,t].view(-1), loss)
+                else:
+                    metrics.add_loss(loss)
 
-    test_loss = test_loss/((i+1)*num)
-    return test_loss, recall_test, precision_test, auc_test/((i+1)*num), correct_label_test
+    test_loss = metrics.loss_sum()/((i+1)*num)
+    if not compute_metrics:
+        return test_loss, 0, 0, 0, 0
+    auc_test, recall_test, precision_test, correct_label_test = metrics.compute()
+    return test_loss, recall_test, precision_test, auc_test, correct_label_test
 
 
 def test_model_rt_rg(model, test_loader):
@@ -567,62 +642,46 @@ def test_model_rt_rg(model, test_loader):
     test_loss = test_loss / (num * (i + 1))
     return test_loss
 
-def test_model_multiclass(model, test_loader,num=5, loss_criterion=torch.nn.CrossEntropyLoss()):
+def test_model_multiclass(model, test_loader,num=5, loss_criterion=torch.nn.CrossEntropyLoss(), compute_metrics=True):
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
     model.to(device)
     model.eval()
-    correct_label_test = 0
-    recall_test, precision_test, auc_test = 0, 0, 0
-    count = 0
-    test_loss = 0
-    auc_class_list=[]
-    for i, (signals, labels) in enumerate(test_loader):
-        signals, labels = torch.Tensor(signals.float()).to(device), torch.Tensor(labels.float()).to(device)
-        if num>1:
-            time_points = [int(tt) for tt in np.linspace(20, signals.shape[-1] - 2, num=num)]
-        else:
-            time_points = [signals.shape[2] - 1]
-        for t in time_points:
-            if len(labels.shape)==3: #has labels over time
-                label = labels[:, :, t]
-            else:
-                label = labels
-
-            label_onehot = label
-            predictions = model(signals)
-
-            #print(loss_criterion)
-            if type(loss_criterion).__name__==type(torch.nn.CrossEntropyLoss()).__name__:
-                pred_onehot = torch.FloatTensor(labels.shape[0], labels.shape[1]).to(device)
-                _, predicted_label = predictions.max(1)
-                pred_onehot.zero_()
-                pred_onehot.scatter_(1, predicted_label.view(-1, 1), 1)
-                task='multiclass'
-            else:
-                pred_onehot = (torch.sigmoid(predictions) >0.5).float()
-                task='multilabel'
- 
-
-            auc, recall, precision, correct,auc_list = evaluate_multiclass(label_onehot, pred_onehot, 
-                torch.sigmoid(predictions),task=task)
-            auc_class_list.append(auc_list)
-            correct_label_test += correct
-            auc_test += auc
-            recall_test += recall
-            precision_test += precision
-            count += 1
-            if type(loss_criterion).__name__==type(torch.nn.CrossEntropyLoss()).__name__:
-                _, targets = label.max(1)
-                targets = targets.long()
+    multiclass = type(loss_criterion).__name__==type(torch.nn.CrossEntropyLoss()).__name__
+    metrics = MetricAccumulator('multiclass' if multiclass else 'multilabel')
+    with torch.no_grad():
+        for i, (signals, labels) in enumerate(test_loader):
+            signals, labels = torch.Tensor(signals.float()).to(device), torch.Tensor(labels.float()).to(device)
+            if num>1:
+                time_points = [int(tt) for tt in np.linspace(20, signals.shape[-1] - 2, num=num)]
             else:
-                targets = label
-            loss = loss_criterion(predictions, targets)
-            test_loss += loss.item()
+                time_points = [signals.shape[2] - 1]
+            for t in time_points:
+                if len(labels.shape)==3: #has labels over time
+                    label = labels[:, :, t]
+                else:
+                    label = labels
+
+                label_onehot = label
+                predictions = model(signals)
+
+                if multiclass:
+                    _, targets = label.max(1)
+                    targets = targets.long()
+                else:
+                    targets = label
+                loss = loss_criterion(predictions, targets)
+                if compute_metrics:
+                    metrics.update(torch.sigmoid(predictions), label_onehot, loss)
+                else:
+                    metrics.add_loss(loss)
+
+    test_loss = metrics.loss_sum() /((i + 1)* num)
+    if not compute_metrics:
+        return test_loss, 0, 0, 0, 0
+    auc_test, recall_test, precision_test, correct_label_test, auc_class_list = metrics.compute()
+    print('class auc:', auc_class_list)
+    return test_loss, recall_test, precision_test, auc_test, correct_label_test
 
-    test_loss = test_loss /((i + 1)* num)
-    auc_class_list = np.array(auc_class_list).sum(0)
-    print('class auc:', auc_class_list/((i+1)*num))
-    return test_loss, recall_test, precision_test, auc_test / ((i + 1)*num), correct_label_test
 
 
 def train_reconstruction(model, train_loader, valid_loader, n_epochs, device, experiment):
@@ -683,7 +742,7 @@ def load_data(batch_size, path='./data/', **kwargs):
     transform = kwargs['transform'] if 'transform' in kwargs.keys() else 'normalize'
     task = kwargs['task'] if 'task' in kwargs.keys() else 'mortality'
     p_data = PatientData(path, task = task,shuffle=False,transform=transform)
-    test_bs = kwargs['test_bs'] if 'test_bs' in kwargs.keys() else None
+    test_bs = kwargs['test_bs'] if 'test_bs' in kwargs.keys() else loader_params(**kwargs)['test_batch_size']
     train_pc = kwargs['train_pc'] if 'train_pc' in kwargs.keys() else 1.
 
     features = kwargs['features'] if 'features' in kwargs.keys() else range(p_data.train_data.shape[1])
@@ -692,35 +751,39 @@ def load_data(batch_size, path='./data/', **kwargs):
 
     p_data.feature_size = len(features)
     n_train = int(0.9 * p_data.train_data.shape[0])
-    if 'cv' in kwargs.keys():
-        if task=='mortality':
-            kf = KFold(n_splits=5, random_state=42)
-            train_idx, valid_idx = list(kf.split(p_data.train_data))[kwargs['cv']]
-        else:
-            sss = StratifiedShuffleSplit(n_splits=5, test_size=0.2, random_state=88)
-            train_idx, valid_idx = list(sss.split(p_data.train_data[:,:,-1], p_data.train_label[:,:,-1]))[kwargs['cv']]
-    else:
+
+    def make_splits():
         if task=='mortality':
-            train_idx = range(n_train)
-            valid_idx = range(n_train, p_data.n_train)
+            splits = {'train': np.arange(n_train), 'valid': np.arange(n_train, p_data.n_train)}
+            kf = KFold(n_splits=5)
+            cv_splits = kf.split(p_data.train_data)
         else:
             sss = StratifiedShuffleSplit(n_splits=1, test_size=0.2, random_state=88)
             train_idx, valid_idx = list(sss.split(p_data.train_data[:,:,-1], p_data.train_label[:,:,-1]))[0]
+            splits = {'train': train_idx, 'valid': valid_idx}
+            sss = StratifiedShuffleSplit(n_splits=5, test_size=0.2, random_state=88)
+            cv_splits = sss.split(p_data.train_data[:,:,-1], p_data.train_label[:,:,-1])
+        for k, (train_idx, valid_idx) in enumerate(cv_splits):
+            splits['train_%d' % k], splits['valid_%d' % k] = train_idx, valid_idx
+        return splits
+
+    splits = cached_splits(path, '%s_%d' % (task, p_data.n_train), make_splits)
+    train_idx, valid_idx = fold(splits, kwargs['cv'] if 'cv' in kwargs.keys() else None)
 
-    train_dataset = utils.TensorDataset(torch.Tensor(p_data.train_data[train_idx, :, :]),
-                                        torch.Tensor(p_data.train_label[train_idx]))
+    train_dataset = ArrayDataset(as_float_tensor(p_data.train_data[train_idx, :, :]),
+                                 as_float_tensor(p_data.train_label[train_idx]))
 
-    valid_dataset = utils.TensorDataset(torch.Tensor(p_data.train_data[valid_idx, :, :]),
-                                        torch.Tensor(p_data.train_label[valid_idx]))
-    test_dataset = utils.TensorDataset(torch.Tensor(p_data.test_data), torch.Tensor(p_data.test_label))
+    valid_dataset = ArrayDataset(as_float_tensor(p_data.train_data[valid_idx, :, :]),
+                                 as_float_tensor(p_data.train_label[valid_idx]))
+    test_dataset = ArrayDataset(as_float_tensor(p_data.test_data), as_float_tensor(p_data.test_label))
     
-    train_loader = DataLoader(train_dataset, batch_size=batch_size)
-    valid_loader = DataLoader(valid_dataset, batch_size=batch_size) #p_data.n_train - int(0.8 * p_data.n_train))
+    train_loader = make_loader(train_dataset, batch_size, **kwargs)
+    valid_loader = make_loader(valid_dataset, batch_size, **kwargs) #p_data.n_train - int(0.8 * p_data.n_train))
 
     if test_bs is not None:
-        test_loader = DataLoader(test_dataset, batch_size=test_bs)
+        test_loader = make_loader(test_dataset, test_bs, **kwargs)
     else:
-        test_loader = DataLoader(test_dataset, batch_size=len(p_data.test_data))
+        test_loader = make_loader(test_dataset, len(p_data.test_data), **kwargs)
 
     if task=='mortality':
         print('Train set: ', np.count_nonzero(p_data.train_label[0:int(0.8 * p_data.n_train)]),
@@ -735,6 +798,22 @@ def load_data(batch_size, path='./data/', **kwargs):
     return p_data, train_loader, valid_loader, test_loader
 
 
+def load_sharded_data(batch_size, path, **kwargs):
+    """
+    Loaders over a cohort stored as shards (see TSX.sharded_data), streamed from disk instead of loaded in memory.
+    The shards hold fixed train, valid and test splits
+    """
+    p_data = ShardedData(path)
+    test_bs = kwargs['test_bs'] if 'test_bs' in kwargs.keys() else loader_params(**kwargs)['test_batch_size']
+    train_loader = make_loader(ShardedDataset(path, 'train', shuffle=True), batch_size, **kwargs)
+    # Workers would interleave the shards of the unshuffled splits, so these are read in order by the main process
+    eval_kwargs = dict(kwargs, num_workers=0)
+    valid_loader = make_loader(ShardedDataset(path, 'valid'), batch_size, **eval_kwargs)
+    test_loader = make_loader(ShardedDataset(path, 'test'), test_bs if test_bs is not None else batch_size,
+                              **eval_kwargs)
+    return p_data, train_loader, valid_loader, test_loader
+
+
 def load_ghg_data(batch_size, path='./data_generator/data', **kwargs):
     p_data = GHGData(path, transform=None)  # data already normalized zero mean 1 std
     # print('ghg label stats', np.mean(p_data.train_label),np.std(p_data.train_label))
@@ -742,22 +821,26 @@ def load_ghg_data(batch_size, path='./data_generator/data', **kwargs):
     p_data.train_data = p_data.train_data[:, features, :]
     p_data.test_data = p_data.test_data[:, features, :]
 
-    n_train = int(0.8 * len(x_train))
-    if 'cv' in kwargs.keys():
-        kf = KFold(n_splits=5, random_state=42)
-        train_idx, valid_idx = list(kf.split(x_train))[kwargs['cv']]
-    else:
-        train_idx = range(n_train)
-        valid_idx = range(ntrain.len(x_train))
-
-    train_dataset = utils.TensorDataset(torch.Tensor(p_data.train_data[train_idx, :, :]),
-                                        torch.Tensor(p_data.train_label[train_idx]))
-    valid_dataset = utils.TensorDataset(torch.Tensor(p_data.train_data[train_idx, :, :]),
-                                        torch.Tensor(p_data.train_label[train_idx]))
-    test_dataset = utils.TensorDataset(torch.Tensor(p_data.test_data[:, :, :]), torch.Tensor(p_data.test_label))
-    train_loader = DataLoader(train_dataset, batch_size=batch_size)
-    valid_loader = DataLoader(valid_dataset, batch_size=p_data.n_train - int(0.8 * p_data.n_train))
-    test_loader = DataLoader(test_dataset, batch_size=p_data.n_test)
+    n_train = int(0.8 * p_data.n_train)
+
+    def make_splits():
+        splits = {'train': np.arange(n_train), 'valid': np.arange(n_train, p_data.n_train)}
+        for k, (train_idx, valid_idx) in enumerate(KFold(n_splits=5).split(p_data.train_data)):
+            splits['train_%d' % k], splits['valid_%d' % k] = train_idx, valid_idx
+        return splits
+
+    splits = cached_splits(path, 'ghg_%d' % p_data.n_train, make_splits)
+    train_idx, valid_idx = fold(splits, kwargs['cv'] if 'cv' in kwargs.keys() else None)
+
+    train_dataset = ArrayDataset(as_float_tensor(p_data.train_data[train_idx, :, :]),
+                                 as_float_tensor(p_data.train_label[train_idx]))
+    valid_dataset = ArrayDataset(as_float_tensor(p_data.train_data[valid_idx, :, :]),
+                                 as_float_tensor(p_data.train_label[valid_idx]))
+    test_dataset = ArrayDataset(as_float_tensor(p_data.test_data[:, :, :]), as_float_tensor(p_data.test_label))
+    test_bs = kwargs['test_bs'] if 'test_bs' in kwargs.keys() else loader_params(**kwargs)['test_batch_size']
+    train_loader = make_loader(train_dataset, batch_size, **kwargs)
+    valid_loader = make_loader(valid_dataset, p_data.n_train - int(0.8 * p_data.n_train), **kwargs)
+    test_loader = make_loader(test_dataset, test_bs if test_bs is not None else p_data.n_test, **kwargs)
     # print('Train set: ', p_data.train_data.shape)
     # print('Valid set: ', p_data.train_data.shape)
     # print('Test set: ', p_data.test_data.shape)
@@ -766,59 +849,60 @@ def load_ghg_data(batch_size, path='./data_generator/data', **kwargs):
 
 
 def load_simulated_data(batch_size=100, datapath='./data/simulated_data', data_type='state', percentage=1., **kwargs):
+    """
+    Arrays are memory-mapped from the .npy store written by the data generators (see TSX.array_store), and only the
+    selected samples are ever copied in memory
+    :return: The memory-mapped training signals of all the features, and the train, valid and test loaders
+    """
     if data_type == 'state':
-        with open(os.path.join(datapath, 'state_dataset_importance_train.pkl'), 'rb') as f:
-            importance_score_train = pkl.load(f)
-        with open(os.path.join(datapath, 'state_dataset_importance_test.pkl'), 'rb') as f:
-            importance_score_train_test = pkl.load(f)
         file_name = 'state_dataset_'
     else:
         file_name = ''
-    with open(os.path.join(datapath, file_name + 'x_train.pkl'), 'rb') as f:
-        x_train = pkl.load(f)
-    with open(os.path.join(datapath, file_name + 'y_train.pkl'), 'rb') as f:
-        y_train = pkl.load(f)
-    with open(os.path.join(datapath, file_name + 'x_test.pkl'), 'rb') as f:
-        x_test = pkl.load(f)
-    with open(os.path.join(datapath, file_name + 'y_test.pkl'), 'rb') as f:
-        y_test = pkl.load(f)
+    x_train = load_array(datapath, 'x_train', prefix=file_name)
+    y_train = load_array(datapath, 'y_train', prefix=file_name)
+    x_test = load_array(datapath, 'x_test', prefix=file_name)
+    y_test = load_array(datapath, 'y_test', prefix=file_name)
 
     features = kwargs['features'] if 'features' in kwargs.keys() else list(range(x_test.shape[1]))
-    test_bs = kwargs['test_bs'] if 'test_bs' in kwargs.keys() else None
-
-    perm = np.random.permutation(x_train.shape[0])
-    x_train = x_train[perm]
-    y_train = y_train[perm]
-
-    total_sample_n = int(len(x_train) * percentage)
-    x_train = x_train[:total_sample_n]
-    y_train = y_train[:total_sample_n]
-    n_train = int(0.8 * len(x_train))
-    x_train = x_train[:, features, :]
-    x_test = x_test[:, features, :]
+    test_bs = kwargs['test_bs'] if 'test_bs' in kwargs.keys() else loader_params(**kwargs)['test_batch_size']
+    all_features = list(features) == list(range(x_test.shape[1]))
+
+    # Shuffle and subsample indices rather than the arrays themselves
+    def make_splits():
+        perm = np.random.RandomState(1234).permutation(x_train.shape[0])
+        perm = perm[:int(len(x_train) * percentage)]
+        n_train = int(0.8 * len(perm))
+        splits = {'perm': perm, 'train': perm[:n_train], 'valid': perm[n_train:]}
+        kf = KFold(n_splits=5, random_state=88, shuffle=True)
+        for k, (train_idx, valid_idx) in enumerate(kf.split(perm)):
+            splits['train_%d' % k], splits['valid_%d' % k] = perm[train_idx], perm[valid_idx]
+        return splits
 
-    n_train = int(0.8 * len(x_train))
+    splits = cached_splits(datapath, '%s%d_%s' % (file_name, len(x_train), percentage), make_splits)
+    n_samples = int(len(x_train) * percentage)
+    n_train = int(0.8 * n_samples)
     if 'cv' in kwargs.keys():
         print('cv : ', kwargs['cv'])
-        kf = KFold(n_splits=5, random_state=88, shuffle=True)
-        train_idx, valid_idx = list(kf.split(x_train))[kwargs['cv']]
-    else:
-        train_idx = range(n_train)
-        valid_idx = range(n_train, len(x_train))
+    train_idx, valid_idx = fold(splits, kwargs['cv'] if 'cv' in kwargs.keys() else None)
+
+    def select(x, idx=None):
+        x = x if idx is None else x[idx]
+        return x if all_features else x[:, features, :]
 
-    train_dataset = utils.TensorDataset(torch.Tensor(x_train[train_idx, :, :]),
-                                        torch.Tensor(y_train[train_idx, :]))
-    valid_dataset = utils.TensorDataset(torch.Tensor(x_train[valid_idx, :, :]),
-                                        torch.Tensor(y_train[valid_idx, :]))
+    train_dataset = ArrayDataset(as_float_tensor(select(x_train, train_idx)),
+                                 as_float_tensor(y_train[train_idx, :]))
+    valid_dataset = ArrayDataset(as_float_tensor(select(x_train, valid_idx)),
+                                 as_float_tensor(y_train[valid_idx, :]))
 
-    test_dataset = utils.TensorDataset(torch.Tensor(x_test[:, :, :]), torch.Tensor(y_test))
-    train_loader = DataLoader(train_dataset, batch_size=batch_size)
-    valid_loader = DataLoader(valid_dataset, batch_size=len(x_train) - int(0.8 * n_train))
+    # Without feature selection, the test tensors are views of the memory-mapped arrays
+    test_dataset = ArrayDataset(as_float_tensor(select(x_test)), as_float_tensor(y_test))
+    train_loader = make_loader(train_dataset, batch_size, **kwargs)
+    valid_loader = make_loader(valid_dataset, n_samples - int(0.8 * n_train), **kwargs)
     if test_bs is not None:
-        test_loader = DataLoader(test_dataset, batch_size=test_bs)
+        test_loader = make_loader(test_dataset, test_bs, **kwargs)
     else:
-        test_loader = DataLoader(test_dataset, batch_size=len(x_test))
-    return np.concatenate([x_train, x_test]), train_loader, valid_loader, test_loader
+        test_loader = make_loader(test_dataset, len(x_test), **kwargs)
+    return x_train, train_loader, valid_loader, test_loader
 
 
 def logistic(x):
@@ -828,8 +912,7 @@ def logistic(x):
 def top_risk_change(exp):
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
     span = []
-    testset = list(exp.test_loader.dataset)
-    for i, (signal, label) in enumerate(testset):
+    for i, (signal, label) in enumerate(exp.test_loader.dataset):
         exp.risk_predictor.load_state_dict(torch.load('./ckpt/mimic/risk_predictor.pt'))
         exp.risk_predictor.to(device)
         exp.risk_predictor.eval()
@@ -1013,7 +1096,7 @@ def replace_and_predict(self, signals_to_analyze, sensitivity_analysis_importanc
     mse_vec_sens = []
     nt = len(tvec)
 
-    testset = list(self.test_loader.dataset)
+    testset = self.test_loader.dataset
     for sub_ind, subject in enumerate(signals_to_analyze):  # range(30):
         signals, label_o = testset[subject]
         label_o_o = label_o[-1]
@@ -1051,19 +1134,19 @@ def replace_and_predict(self, signals_to_analyze, sensitivity_analysis_importanc
         legend_elements = []
 
         # ckpt_path='./ckpt_pathckpt/' + data + '/'
+        # Generators that model every feature are loaded once, per-feature generators are loaded in the loop
+        single_ckpt = 'joint' in self.generator_type or 'multihead' in self.generator_type
+        if single_ckpt:
+            self.generator.load_state_dict(torch.load(os.path.join(self.ckpt_path, self.generator_ckpt_name())))
         for i, sig_ind in enumerate(range(0, self.feature_size)):
-            print('loading feature from:', self.ckpt_path)
-            if not self.generator_type == 'carry_forward_generator':
-                if 'joint' in self.generator_type:
+            if not self.generator_type == 'carry_forward_generator' and not single_ckpt:
+                print('loading feature from:', self.ckpt_path)
+                if self.historical:
                     self.generator.load_state_dict(
-                        torch.load(os.path.join(self.ckpt_path, '%s.pt' % self.generator_type)))
+                        torch.load(os.path.join(self.ckpt_path, '%d_%s.pt' % (sig_ind, self.generator_type))))
                 else:
-                    if self.historical:
-                        self.generator.load_state_dict(
-                            torch.load(os.path.join(self.ckpt_path, '%d_%s.pt' % (sig_ind, self.generator_type))))
-                    else:
-                        self.generator.load_state_dict(torch.load(
-                            os.path.join(self.ckpt_path, '%d_%s_nohist.pt' % (sig_ind, self.generator_type))))
+                    self.generator.load_state_dict(torch.load(
+                        os.path.join(self.ckpt_path, '%d_%s_nohist.pt' % (sig_ind, self.generator_type))))
 
             label, importance[i, :], mean_predicted_risk[i, :], std_predicted_risk[i, :] = self._get_feature_importance(
                 signals, sig_ind=sig_ind, n_samples=10, mode='generator', tvec=tvec)
@@ -1,7 +1,9 @@
+import os
+import argparse
 import numpy as np
 import pandas as pd
 #import matplotlib.pyplot as plt
-from datetime import timedelta, datetime
+from multiprocessing import Pool
 import pickle
 from sklearn.impute import SimpleImputer
 import warnings
@@ -12,171 +14,192 @@ lab_IDs = ['ANION GAP', 'ALBUMIN', 'BICARBONATE', 'BILIRUBIN', 'CREATININE', 'CH
           'LACTATE', 'MAGNESIUM', 'PHOSPHATE', 'PLATELET', 'POTASSIUM', 'PTT', 'INR', 'PT', 'SODIUM', 'BUN', 'WBC']
 eth_list = ['white', 'black', 'hispanic', 'asian', 'other']
 
-eth_coder = lambda eth:0 if eth=='0' else eth_list.index(patient_data['ethnicity'].iloc[0])+1
+eth_coder = lambda eth:0 if eth=='0' else eth_list.index(eth)+1
+
+
+def time_bins(charttime, start, step_size, n_steps):
+    """
+    Window of each measurement, with n_steps windows of step_size hours starting at start. Windows are open intervals,
+    so measurements that fall on a window boundary are not part of any window
+    :return: Array of window indices, -1 for the measurements outside of all the windows
+    """
+    step = pd.Timedelta(hours=step_size).value
+    start = pd.Timestamp(start).to_datetime64().astype('datetime64[ns]')
+    # Missing times (NaT) become the smallest int64, i.e. a negative offset
+    offset = (np.asarray(charttime, dtype='datetime64[ns]') - start).astype(np.int64)
+    steps, remainder = np.divmod(offset, step)
+    inside = (offset > 0) & (remainder != 0) & (steps < n_steps)
+    return np.where(inside, steps, -1)
+
+
+def window_means(index, values, n):
+    """ Mean of the non-missing values and number of measurements of each of the n windows in index
+    """
+    counts = np.bincount(index, minlength=n).astype(float)
+    observed = ~np.isnan(values)
+    sums = np.bincount(index[observed], weights=values[observed], minlength=n)
+    n_observed = np.bincount(index[observed], minlength=n)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return sums / n_observed, counts
 
 
 def quantize_signal(signal, start, step_size, n_steps, value_column, charttime_column):
-    quantized_signal = []
-    quantized_counts = np.zeros((n_steps,))
-    l = start
-    u = start + timedelta(hours=step_size)
-    for i in range(n_steps):
-        signal_window = signal[value_column][(signal[charttime_column]>l) & (signal[charttime_column]<u)]
-        quantized_signal.append(signal_window.mean())
-        quantized_counts[i] = len(signal_window)
-        l = u
-        u = l + timedelta(hours=step_size)
-    return quantized_signal,quantized_counts
-
-
-def check_nan(A):
-    A = np.array(A)
-    nan_arr = np.isnan(A).astype(int)
-    nan_count = np.count_nonzero(nan_arr)
-    return nan_arr, nan_count
-
-
-def forward_impute(x, nan_arr):
-    x_impute = x.copy()
-    first_value = 0
-    while first_value<len(x) and nan_arr[first_value]==1:
-        first_value += 1
-    last = x_impute[first_value]
-    for i,measurement in enumerate(x):
-        if nan_arr[i]==1:
-            x_impute[i] = last
-        else:
-            last = measurement
-    return x_impute
+    bins = time_bins(signal[charttime_column], start, step_size, n_steps)
+    values = np.asarray(signal[value_column], dtype=float)
+    return window_means(bins[bins >= 0], values[bins >= 0], n_steps)
+
+
+def quantize_signals(data, ids, start, step_size, n_steps, id_column, value_column, charttime_column):
+    """
+    quantize_signal for all the signals of a patient at once
+    :param ids: Signal ids, row k of the outputs is the signal with data[id_column]==ids[k]
+    :return: Quantized signals and window counts, as [len(ids), n_steps] arrays
+    """
+    signal_index = pd.Index(ids).get_indexer(data[id_column])
+    bins = time_bins(data[charttime_column], start, step_size, n_steps)
+    keep = (signal_index >= 0) & (bins >= 0)
+    quantized, counts = window_means(signal_index[keep] * n_steps + bins[keep],
+                                     np.asarray(data[value_column], dtype=float)[keep], len(ids) * n_steps)
+    return quantized.reshape((len(ids), n_steps)), counts.reshape((len(ids), n_steps))
+
+
+def forward_impute(x, nan_arr=None):
+    """
+    Replace the missing values of signals along the last axis of x with the last observed value, and the missing values
+    before the first observation with the first observed value. Signals without any observation are left as they are
+    :param nan_arr: Missingness mask of x, computed from x when not given
+    """
+    x = np.asarray(x)
+    observed = ~np.isnan(x) if nan_arr is None else ~np.asarray(nan_arr, dtype=bool)
+    first = np.argmax(observed, axis=-1)[..., None]
+    last = np.maximum.accumulate(np.where(observed, np.arange(x.shape[-1]), first), axis=-1)
+    return np.take_along_axis(x, last, axis=-1)
 
 
 def impute_lab(lab_data):
     imputer = SimpleImputer(strategy="mean")
-    lab_data_impute = lab_data.copy()
     imputer.fit( lab_data.reshape((-1,lab_data.shape[1])) )
-    for i,patient in enumerate(lab_data):
-        for j,signal in enumerate(patient):
-            nan_arr , nan_count = check_nan(signal)
-            if nan_count!=len(signal):
-                lab_data_impute[i,j,:] = forward_impute(signal, nan_arr)
-    lab_data_impute = np.array( [imputer.transform(sample.T).T for sample in lab_data_impute] )
-    return lab_data_impute
-
-
-vital_data = pd.read_csv("./data/adult_icu_vital.gz", compression='gzip')#, nrows=5000)
-#print("Vitals:\n", vital_data[0:20])
-vital_data = vital_data.dropna(subset=['vitalid'])
-
-lab_data = pd.read_csv("./data/adult_icu_lab.gz", compression='gzip')#, nrows=5000)
-#print("Labs:\n", lab_data[0:20])
-lab_data = lab_data.dropna(subset=['label'])
-
-icu_id = vital_data.icustay_id.unique()
-## features for every patient will be the list of vital IDs, gender(male=1, female=0), age, ethnicity(unknown=0 ,white=1, black=2, hispanic=3, asian=4, other=5), first_icu_stay(True=1, False=0)
-x = np.zeros((len(icu_id), 12 , 48))
-x_lab = np.zeros((len(icu_id), len(lab_IDs) , 48))
-x_impute = np.zeros((len(icu_id), 12, 48))
-y = np.zeros((len(icu_id),))
-imp_mean = SimpleImputer(strategy="mean")
-
-missing_ids = []
-missing_map = np.zeros((len(icu_id), 12))
-missing_map_lab = np.zeros((len(icu_id), len(lab_IDs)))
-
-nan_map = np.zeros((len(icu_id), len(lab_IDs)+12))
-
-for i,id in enumerate(icu_id):
-    patient_data = vital_data.loc[vital_data['icustay_id']==id]
-    patient_data['vitalcharttime'] = patient_data['vitalcharttime'].astype('datetime64[s]')
-    patient_lab_data = lab_data.loc[lab_data['icustay_id']==id]
-    patient_lab_data['labcharttime'] = patient_lab_data['labcharttime'].astype('datetime64[s]')
-
+    lab_data_impute = forward_impute(lab_data)
+    n_samples, n_signals, n_steps = lab_data_impute.shape
+    lab_data_impute = imputer.transform(lab_data_impute.transpose(0, 2, 1).reshape((-1, n_signals)))
+    return lab_data_impute.reshape((n_samples, n_steps, -1)).transpose(0, 2, 1)
+
+
+def extract_patient(patient):
+    """
+    Features of a single ICU stay
+    :param patient: (vital measurements, lab measurements) data frames of the stay
+    :return: Dictionary of the vital signs and demographics x [12, 48], their imputation x_impute, the labs x_lab,
+             the label y, the number of missing windows of every signal nan_map and the signals that are never measured
+    """
+    patient_data, patient_lab_data = patient
     admit_time = patient_data['vitalcharttime'].min()
-    #print('Patient %d admitted at '%(id),admit_time)
-    n_missing_vitals = 0
+    sample = {'x': np.zeros((12, 48)), 'x_lab': np.zeros((len(lab_IDs), 48)), 'x_impute': np.zeros((12, 48)),
+              'nan_map': np.zeros((len(lab_IDs)+12,)), 'missing_map': np.zeros((12,)),
+              'missing_map_lab': np.zeros((len(lab_IDs),))}
 
     ## Extract demographics and repeat them over time
-    x[i,-4,:]= int(patient_data['gender'].iloc[0])
-    x[i,-3,:]= int(patient_data['age'].iloc[0])
-    x[i,-2,:]= eth_coder(patient_data['ethnicity'].iloc[0])
-    x[i,-1,:]= int(patient_data['first_icu_stay'].iloc[0])
-    y[i] = (int(patient_data['mort_icu'].iloc[0]))
+    sample['x'][-4,:]= int(patient_data['gender'].iloc[0])
+    sample['x'][-3,:]= int(patient_data['age'].iloc[0])
+    sample['x'][-2,:]= eth_coder(patient_data['ethnicity'].iloc[0])
+    sample['x'][-1,:]= int(patient_data['first_icu_stay'].iloc[0])
+    sample['y'] = (int(patient_data['mort_icu'].iloc[0]))
 
     ## Extract vital measurement information
-    vitals = patient_data.vitalid.unique()
-    for vital in vitals:
-        try:
-            vital_IDs.index(vital)
-            signal = patient_data[patient_data['vitalid']==vital]
-            quantized_signal, _ = quantize_signal(signal, start=admit_time, step_size=1, n_steps=48, value_column='vitalvalue', charttime_column='vitalcharttime')
-            nan_arr, nan_count = check_nan(quantized_signal)
-            x[i, vital_IDs.index(vital) , :] = np.array(quantized_signal)
-            nan_map[i,len(lab_IDs)+vital_IDs.index(vital)] = nan_count
-            if nan_count==48:
-                n_missing_vitals =+ 1
-                missing_map[i,vital_IDs.index(vital)]=1
-            else:
-                x_impute[i,:,:] = imp_mean.fit_transform(x[i,:,:].T).T
-        except:
-            pass
+    vitals = np.isin(vital_IDs, patient_data.vitalid.unique())
+    quantized_signals, _ = quantize_signals(patient_data, vital_IDs, start=admit_time, step_size=1, n_steps=48,
+                                            id_column='vitalid', value_column='vitalvalue',
+                                            charttime_column='vitalcharttime')
+    nan_count = np.isnan(quantized_signals).sum(-1)
+    sample['x'][:len(vital_IDs)][vitals] = quantized_signals[vitals]
+    sample['nan_map'][len(lab_IDs):len(lab_IDs)+len(vital_IDs)][vitals] = nan_count[vitals]
+    sample['missing_map'][:len(vital_IDs)][vitals & (nan_count==48)] = 1
+    ## Remove a patient that is missing a measurement for the entire 48 hours
+    sample['missing'] = bool(sample['missing_map'].any())
+    if vitals.any() and not sample['missing']:
+        sample['x_impute'] = SimpleImputer(strategy="mean").fit_transform(sample['x'].T).T
 
     ## Extract lab measurement informations
-    labs = patient_lab_data.label.unique()
-    for lab in labs:
-        try:
-            lab_IDs.index(lab)
-            lab_measures = patient_lab_data[patient_lab_data['label']==lab]
-            quantized_lab , quantized_measures = quantize_signal(lab_measures, start=admit_time, step_size=1, n_steps=48, value_column='labvalue', charttime_column='labcharttime')
-            nan_arr, nan_count = check_nan(quantized_lab)
-            x_lab[i, lab_IDs.index(lab) , :] = np.array(quantized_lab)
-            nan_map[i,lab_IDs.index(lab)] = nan_count
-            if nan_count==48:
-                missing_map_lab[i,lab_IDs.index(lab)]=1
-        except:
-            pass
-
-    ## Remove a patient that is missing a measurement for the entire 48 hours
-    if n_missing_vitals>0:
-        missing_ids.append(i)
-
-
-## Record statistics of the dataset, remove missing samples and save the signals
-f = open("./data/stats.txt","a")
-f.write('\n ******************* Before removing missing *********************')
-f.write('\n Number of patients: '+ str(len(y))+'\n Number of patients who died within their stay: '+str(np.count_nonzero(y)))
-f.write("\nMissingness report for Vital signals")
-for i,vital in enumerate(vital_IDs):	
-        f.write("\nMissingness for %s: %.2f"%(vital,np.count_nonzero(missing_map[:,i])/len(icu_id)))
-        f.write("\n")
-f.write("\nMissingness report for Vital signals")	
-for i,lab in enumerate(lab_IDs):
-        f.write("\nMissingness for %s: %.2f"%(lab,np.count_nonzero(missing_map_lab[:,i])/len(icu_id)))
-        f.write("\n")
-
-
-x = np.delete(x, missing_ids, axis=0)
-x_lab = np.delete(x_lab, missing_ids, axis=0)
-x_impute = np.delete(x_impute, missing_ids, axis=0)
-y = np.delete(y, missing_ids, axis=0)
-nan_map = np.delete(nan_map, missing_ids, axis=0)
-
-x_lab_impute = impute_lab(x_lab)
-missing_map = np.delete(missing_map, missing_ids, axis=0)
-missing_map_lab = np.delete(missing_map_lab, missing_ids, axis=0)
-all_data = np.concatenate((x_lab_impute,x_impute),axis=1)
-f.write('\n ******************* After removing missing *********************')
-f.write('\n Final number of patients: '+str(len(y))+'\n Number of patients who died within their stay: '+str(np.count_nonzero(y)))
-f.write("\nMissingness report for Vital signals")	
-for i,vital in enumerate(vital_IDs):
-        f.write("\nMissingness for %s: %.2f"%(vital,np.count_nonzero(missing_map[:,i])/len(icu_id)))
-        f.write("\n")
-f.write("\nMissingness report for Vital signals")	
-for i,lab in enumerate(lab_IDs):
-        f.write("\nMissingness for %s: %.2f"%(lab,np.count_nonzero(missing_map_lab[:,i])/len(icu_id)))
-        f.write("\n")
-f.close()
-
-samples = [ (all_data[i,:,:],y[i],nan_map[i,:]) for i in range(len(y)) ]
-with open('./data/patient_vital_preprocessed.pkl','wb') as f:
-        pickle.dump(samples, f)
+    labs = np.isin(lab_IDs, patient_lab_data.label.unique())
+    quantized_labs, _ = quantize_signals(patient_lab_data, lab_IDs, start=admit_time, step_size=1, n_steps=48,
+                                         id_column='label', value_column='labvalue', charttime_column='labcharttime')
+    nan_count = np.isnan(quantized_labs).sum(-1)
+    sample['x_lab'][labs] = quantized_labs[labs]
+    sample['nan_map'][:len(lab_IDs)][labs] = nan_count[labs]
+    sample['missing_map_lab'][labs & (nan_count==48)] = 1
+    return sample
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Preprocess the ICU mortality vital and lab measurements')
+    parser.add_argument('--n_workers', type=int, default=os.cpu_count(), help='Number of processes extracting the patients')
+    args = parser.parse_args()
+
+    vital_data = pd.read_csv("./data/adult_icu_vital.gz", compression='gzip')#, nrows=5000)
+    #print("Vitals:\n", vital_data[0:20])
+    vital_data = vital_data.dropna(subset=['vitalid'])
+    vital_data['vitalcharttime'] = vital_data['vitalcharttime'].astype('datetime64[s]')
+
+    lab_data = pd.read_csv("./data/adult_icu_lab.gz", compression='gzip')#, nrows=5000)
+    #print("Labs:\n", lab_data[0:20])
+    lab_data = lab_data.dropna(subset=['label'])
+    lab_data['labcharttime'] = lab_data['labcharttime'].astype('datetime64[s]')
+
+    icu_id = vital_data.icustay_id.unique()
+    ## Group the measurements of every ICU stay once, instead of filtering the whole tables for each patient
+    vital_rows = vital_data.groupby('icustay_id', sort=False).indices
+    lab_rows = lab_data.groupby('icustay_id', sort=False).indices
+    patients = ((vital_data.iloc[vital_rows[id]], lab_data.iloc[lab_rows.get(id, [])]) for id in icu_id)
+    with Pool(args.n_workers) as pool:
+        extracted = list(pool.imap(extract_patient, patients, chunksize=64))
+
+    ## features for every patient will be the list of vital IDs, gender(male=1, female=0), age, ethnicity(unknown=0 ,white=1, black=2, hispanic=3, asian=4, other=5), first_icu_stay(True=1, False=0)
+    x = np.stack([sample['x'] for sample in extracted])
+    x_lab = np.stack([sample['x_lab'] for sample in extracted])
+    x_impute = np.stack([sample['x_impute'] for sample in extracted])
+    y = np.array([sample['y'] for sample in extracted], dtype=float)
+    missing_map = np.stack([sample['missing_map'] for sample in extracted])
+    missing_map_lab = np.stack([sample['missing_map_lab'] for sample in extracted])
+    nan_map = np.stack([sample['nan_map'] for sample in extracted])
+    missing_ids = [i for i, sample in enumerate(extracted) if sample['missing']]
+
+    ## Record statistics of the dataset, remove missing samples and save the signals
+    f = open("./data/stats.txt","a")
+    f.write('\n ******************* Before removing missing *********************')
+    f.write('\n Number of patients: '+ str(len(y))+'\n Number of patients who died within their stay: '+str(np.count_nonzero(y)))
+    f.write("\nMissingness report for Vital signals")
+    for i,vital in enumerate(vital_IDs):	
+            f.write("\nMissingness for %s: %.2f"%(vital,np.count_nonzero(missing_map[:,i])/len(icu_id)))
+            f.write("\n")
+    f.write("\nMissingness report for Vital signals")	
+    for i,lab in enumerate(lab_IDs):
+            f.write("\nMissingness for %s: %.2f"%(lab,np.count_nonzero(missing_map_lab[:,i])/len(icu_id)))
+            f.write("\n")
+
+
+    x = np.delete(x, missing_ids, axis=0)
+    x_lab = np.delete(x_lab, missing_ids, axis=0)
+    x_impute = np.delete(x_impute, missing_ids, axis=0)
+    y = np.delete(y, missing_ids, axis=0)
+    nan_map = np.delete(nan_map, missing_ids, axis=0)
+
+    x_lab_impute = impute_lab(x_lab)
+    missing_map = np.delete(missing_map, missing_ids, axis=0)
+    missing_map_lab = np.delete(missing_map_lab, missing_ids, axis=0)
+    all_data = np.concatenate((x_lab_impute,x_impute),axis=1)
+    f.write('\n ******************* After removing missing *********************')
+    f.write('\n Final number of patients: '+str(len(y))+'\n Number of patients who died within their stay: '+str(np.count_nonzero(y)))
+    f.write("\nMissingness report for Vital signals")	
+    for i,vital in enumerate(vital_IDs):
+            f.write("\nMissingness for %s: %.2f"%(vital,np.count_nonzero(missing_map[:,i])/len(icu_id)))
+            f.write("\n")
+    f.write("\nMissingness report for Vital signals")	
+    for i,lab in enumerate(lab_IDs):
+            f.write("\nMissingness for %s: %.2f"%(lab,np.count_nonzero(missing_map_lab[:,i])/len(icu_id)))
+            f.write("\n")
+    f.close()
+
+    samples = [ (all_data[i,:,:],y[i],nan_map[i,:]) for i in range(len(y)) ]
+    with open('./data/patient_vital_preprocessed.pkl','wb') as f:
+            pickle.dump(samples, f)
 
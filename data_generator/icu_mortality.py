@@ -3,13 +3,26 @@
 
 import numpy as np
 import pandas as pd
-import psycopg2
 from scipy.stats import ks_2samp
 import os 
+import json
+import hashlib
 import random
+import sqlite3
 import argparse
 
 
+# SQL that differs between the MIMIC postgres server and the SQLite stand-in (data_generator/mimic_standin.py)
+DIALECTS = {
+  'postgres': {'add_hours': "{0} + interval '{1}' hour",
+               'days_between': "(CAST({0} AS DATE) - CAST({1} AS DATE))",
+               'distinct_from': 'IS DISTINCT FROM'},
+  'sqlite': {'add_hours': "datetime({0}, '+{1} hours')",
+             'days_between': "CAST(julianday(date({0})) - julianday(date({1})) AS INTEGER)",
+             'distinct_from': 'IS NOT'},
+}
+
+
 def replace(group):
   """ Replace missing values in measurements using mean imputation
   takes in a pandas group, and replaces the null value with the mean of the none null
@@ -20,19 +33,109 @@ def replace(group):
   return group
 
 
-def main(sqluser, sqlpass):
+def connect(sqluser, sqlpass, sqlite_path=None):
+  """ Connection to the local postgres version of mimic, or to a SQLite stand-in database when sqlite_path is given
+  :return: Connection and SQL dialect of the database, and an identity of the database used in the cache keys
+  """
+  if sqlite_path is not None:
+    # A regenerated stand-in database gets a new modification time, and new cache keys
+    database = 'sqlite:%s:%d' % (os.path.abspath(sqlite_path), os.stat(sqlite_path).st_mtime_ns)
+    return sqlite3.connect(sqlite_path), 'sqlite', database
+  import psycopg2
+  dbname = 'mimic'
+  host = '127.0.0.1'
+  schema_name = 'mimiciii'
+  con = psycopg2.connect(dbname=dbname, user=sqluser, host=host, password=sqlpass)
+  cur = con.cursor()
+  cur.execute('SET search_path to ' + schema_name)
+  return con, 'postgres', 'postgres:%s@%s/%s' % (dbname, host, schema_name)
+
+
+def format_query(query, dialect, icustay_ids=None):
+  """ Fill in the dialect specific SQL of a query, and the ICU stays it is restricted to
+  """
+  sql = DIALECTS[dialect]
+  stays = '' if icustay_ids is None else 'ie.icustay_id IN (%s)' % ','.join(str(int(i)) for i in icustay_ids)
+  return query.format(stays=stays, distinct_from=sql['distinct_from'],
+                      intime_48h=sql['add_hours'].format('ie.intime', 48),
+                      intime_168h=sql['add_hours'].format('ie.intime', 168),
+                      los_hospital=sql['days_between'].format('adm.dischtime', 'adm.admittime'),
+                      los_icu=sql['days_between'].format('ie.outtime', 'ie.intime'),
+                      age_days=sql['days_between'].format('adm.admittime', 'pat.dob'))
+
+
+def read_query(con, query, chunk_size=100000):
+  """ Run a query through a server-side cursor (a regular cursor for SQLite), fetching chunk_size rows at a time
+  :return: Data frame of the results, with lower case column names as returned by postgres
+  """
+  if isinstance(con, sqlite3.Connection):
+    cur = con.cursor()
+  else:
+    cur = con.cursor(name='icu_mortality')
+    cur.itersize = chunk_size
+  cur.execute(query)
+  chunks = []
+  while True:
+    rows = cur.fetchmany(chunk_size)
+    # Server-side cursors only describe their columns after the first fetch
+    columns = [c[0].lower() for c in cur.description]
+    chunks.append(pd.DataFrame.from_records(rows, columns=columns, coerce_float=True))
+    if len(rows) < chunk_size:
+      break
+  cur.close()
+  return pd.concat(chunks, ignore_index=True)
+
+
+def cached_stays(con, database, query, icustay_ids, path, name, stays_per_partition=2000, chunk_size=100000):
+  """
+  Results of a per ICU stay query for all the stays in icustay_ids. The stays are queried by batches of
+  stays_per_partition, and the results of each batch are stored as a partition path/<name>_<key>_<k>.pkl listed
+  in a manifest, where key is a hash of the database identity and the query. Only the stays that are not stored yet
+  are queried, so interrupted or extended extractions resume where they stopped
+  :param database: Identity of the database, as returned by connect
+  :param query: Function of a list of ICU stay ids returning the query restricted to these stays
+  """
+  prefix = '%s_%s' % (name, hashlib.sha1((database + '\n' + query([])).encode()).hexdigest()[:10])
+  manifest_file = os.path.join(path, prefix + '_manifest.json')
+  manifest = {'partitions': []}
+  if os.path.exists(manifest_file):
+    with open(manifest_file) as f:
+      manifest = json.load(f)
+  icustay_ids = set(int(i) for i in icustay_ids)
+  stored = set(i for partition in manifest['partitions'] for i in partition['icustay_ids'])
+  missing = sorted(icustay_ids - stored)
+  for start in range(0, len(missing), stays_per_partition):
+    batch = missing[start:start + stays_per_partition]
+    partition_file = '%s_%05d.pkl' % (prefix, len(manifest['partitions']))
+    read_query(con, query(batch), chunk_size).to_pickle(os.path.join(path, partition_file))
+    # The manifest is only updated once the partition is written
+    manifest['partitions'].append({'file': partition_file, 'icustay_ids': batch})
+    with open(manifest_file, 'w') as f:
+      json.dump(manifest, f)
+    print('%s: %d/%d ICU stays fetched' % (name, start + len(batch), len(missing)))
+  data = pd.concat([pd.read_pickle(os.path.join(path, partition['file'])) for partition in manifest['partitions']
+                    if icustay_ids.intersection(partition['icustay_ids'])], ignore_index=True)
+  return data[data.icustay_id.isin(icustay_ids)]
+
+
+def main(sqluser, sqlpass, sqlite_path=None, cache_dir='./data/mimic_cache', stays_per_partition=2000,
+         chunk_size=100000):
+  """
+  :param sqlite_path: Query a SQLite stand-in database (see data_generator/mimic_standin.py) instead of postgres
+  :param cache_dir: Directory of the stored query results, reused by later runs
+  :param stays_per_partition: Number of ICU stays queried and stored together
+  :param chunk_size: Number of rows fetched from the database at a time
+  """
   random.seed(22891)
   # Ouput directory to generate the files
   if not os.path.exists("./data/"):
     os.mkdir("./data/")
   mimicdir = os.path.expanduser("./data/")
+  if not os.path.exists(cache_dir):
+    os.makedirs(cache_dir)
 
   # create a database connection and connect to local postgres version of mimic
-  dbname = 'mimic'
-  schema_name = 'mimiciii'
-  con = psycopg2.connect(dbname=dbname, user=sqluser, host='127.0.0.1', password=sqlpass)
-  cur = con.cursor()
-  cur.execute('SET search_path to ' + schema_name)
+  con, dialect, database = connect(sqluser, sqlpass, sqlite_path)
 
 
 
@@ -57,8 +160,8 @@ def main(sqluser, sqlpass):
   SELECT ie.subject_id, ie.hadm_id, ie.icustay_id
   , pat.gender
   , adm.admittime, adm.dischtime, adm.diagnosis
-  , ROUND( (CAST(adm.dischtime AS DATE) - CAST(adm.admittime AS DATE)) , 4) AS los_hospital
-  , ROUND( (CAST(adm.admittime AS DATE) - CAST(pat.dob AS DATE))  / 365, 4) AS age
+  , ROUND( {los_hospital} , 4) AS los_hospital
+  , ROUND( {age_days}  / 365, 4) AS age
   , adm.ethnicity, adm.ADMISSION_TYPE
   --, adm.hospital_expire_flag
   , CASE when adm.deathtime between ie.intime and ie.outtime THEN 1 ELSE 0 END AS mort_icu
@@ -69,10 +172,10 @@ def main(sqluser, sqlpass):
   -- icu level factors
   , ie.intime, ie.outtime
   , ie.FIRST_CAREUNIT
-  , ROUND( (CAST(ie.outtime AS DATE) - CAST(ie.intime AS DATE)) , 4) AS los_icu
+  , ROUND( {los_icu} , 4) AS los_icu
   , DENSE_RANK() OVER (PARTITION BY ie.hadm_id ORDER BY ie.intime) AS icustay_seq
   , CASE
-      WHEN adm.deathtime between ie.intime and ie.intime + interval '168' hour THEN 1 ELSE 0 END AS mort_week
+      WHEN adm.deathtime between ie.intime and {intime_168h} THEN 1 ELSE 0 END AS mort_week
 
   -- first ICU stay *for the current hospitalization*
   , CASE
@@ -88,7 +191,10 @@ def main(sqluser, sqlpass):
   ORDER BY ie.subject_id, adm.admittime, ie.intime;
   """
 
-  den = pd.read_sql_query(denquery,con)
+  # The cohort is queried on every run, only the per stay measurements are stored
+  den = read_query(con, format_query(denquery, dialect), chunk_size)
+  for column in ['admittime', 'dischtime', 'intime', 'outtime']:
+    den[column] = pd.to_datetime(den[column])
 
   ## drop patients with less than 48 hour 
   den['los_icu_hr'] = (den.outtime - den.intime).astype('timedelta64[h]')
@@ -155,9 +261,9 @@ def main(sqluser, sqlpass):
     from icustays ie
     left join chartevents ce
     on ie.subject_id = ce.subject_id and ie.hadm_id = ce.hadm_id and ie.icustay_id = ce.icustay_id
-    and ce.charttime between ie.intime and ie.intime + interval '48' hour
+    and ce.charttime between ie.intime and {intime_48h}
     -- exclude rows marked as error
-    and ce.error IS DISTINCT FROM 1 
+    and ce.error {distinct_from} 1 
     where ce.itemid in
     (
     -- HEART RATE
@@ -214,12 +320,14 @@ def main(sqluser, sqlpass):
     678 --	"Temperature F"
 
     ) 
+    and {stays}
   ) pvt
   where VitalID is not null
   order by pvt.subject_id, pvt.hadm_id, pvt.icustay_id, pvt.VitalID, pvt.VitalChartTime;
   """
-  vit48 = pd.read_sql_query(vitquery,con)
-  vit48.isnull().sum()
+  vit48 = cached_stays(con, database, lambda stays: format_query(vitquery, dialect, stays), den.icustay_id,
+                       cache_dir, 'vitals', stays_per_partition, chunk_size)
+  vit48['vitalcharttime'] = pd.to_datetime(vit48['vitalcharttime'])
 
 
 
@@ -300,7 +408,7 @@ def main(sqluser, sqlpass):
     LEFT JOIN labevents le
       ON le.subject_id = ie.subject_id 
       AND le.hadm_id = ie.hadm_id
-      AND le.charttime between (ie.intime) AND (ie.intime + interval '48' hour)
+      AND le.charttime between (ie.intime) AND ({intime_48h})
       AND le.itemid IN
       (
         -- comment is: LABEL | CATEGORY | FLUID | NUMBER OF ROWS IN LABEVENTS
@@ -339,7 +447,7 @@ def main(sqluser, sqlpass):
       ON ie.subject_id = ad.subject_id
       AND ie.hadm_id = ad.hadm_id
 
-      
+    WHERE {stays}
   )
   SELECT pvt.subject_id, pvt.hadm_id, pvt.icustay_id, pvt.LabChartTime, pvt.label, pvt.LabValue 
   From pvt
@@ -348,7 +456,9 @@ def main(sqluser, sqlpass):
 
   """
 
-  lab48 = pd.read_sql_query(labquery,con)
+  lab48 = cached_stays(con, database, lambda stays: format_query(labquery, dialect, stays), den.icustay_id,
+                       cache_dir, 'labs', stays_per_partition, chunk_size)
+  lab48['labcharttime'] = pd.to_datetime(lab48['labcharttime'])
 
 
   #=====combine all variables 
@@ -380,5 +490,9 @@ if __name__=="__main__":
   parser = argparse.ArgumentParser(description='Query ICU mortality data from mimic database')
   parser.add_argument('--sqluser',type=str, default='mimicuser' ,help='postgres user to access mimic database')
   parser.add_argument('--sqlpass',type=str , default='Iv7bahqu', help='postgres user password to access mimic database')
+  parser.add_argument('--sqlite',type=str, default=None, help='SQLite stand-in database to query instead of postgres')
+  parser.add_argument('--cache_dir',type=str, default='./data/mimic_cache', help='Directory of the stored query results')
+  parser.add_argument('--stays_per_partition',type=int, default=2000, help='Number of ICU stays queried at a time')
+  parser.add_argument('--chunk_size',type=int, default=100000, help='Number of rows fetched from the database at a time')
   args = parser.parse_args()
-  main(args.sqluser, args.sqlpass)
+  main(args.sqluser, args.sqlpass, args.sqlite, args.cache_dir, args.stays_per_partition, args.chunk_size)
@@ -0,0 +1,109 @@
+
+# Generates a small SQLite database with the MIMIC-III tables and columns used by icu_mortality.py and random
+# measurements, so that the extraction pipeline can be run and benchmarked without a MIMIC postgres server
+
+import os
+import random
+import sqlite3
+import argparse
+from datetime import datetime, timedelta
+
+
+SCHEMA = """
+CREATE TABLE patients (subject_id INTEGER, gender TEXT, dob TEXT);
+CREATE TABLE admissions (subject_id INTEGER, hadm_id INTEGER, admittime TEXT, dischtime TEXT, deathtime TEXT,
+                         admission_type TEXT, diagnosis TEXT, ethnicity TEXT, has_chartevents_data INTEGER);
+CREATE TABLE icustays (subject_id INTEGER, hadm_id INTEGER, icustay_id INTEGER, first_careunit TEXT, intime TEXT,
+                       outtime TEXT);
+CREATE TABLE chartevents (subject_id INTEGER, hadm_id INTEGER, icustay_id INTEGER, itemid INTEGER, charttime TEXT,
+                          valuenum REAL, error INTEGER);
+CREATE TABLE labevents (subject_id INTEGER, hadm_id INTEGER, itemid INTEGER, charttime TEXT, valuenum REAL);
+CREATE INDEX chartevents_stay ON chartevents (icustay_id);
+CREATE INDEX labevents_admission ON labevents (subject_id, hadm_id);
+"""
+
+# (itemid, lowest value, highest value) of the generated measurements
+VITAL_ITEMS = [(220045, 60, 120), (220179, 90, 160), (220180, 50, 90), (220181, 60, 110), (220210, 10, 30),
+               (220277, 88, 100), (225664, 70, 200), (223762, 36, 39), (223761, 97, 102)]
+LAB_ITEMS = [(50868, 8, 20), (50862, 2, 5), (50882, 18, 30), (50885, 0.2, 3), (50912, 0.5, 3), (50902, 95, 110),
+             (50931, 70, 200), (51221, 25, 45), (51222, 8, 15), (50813, 0.5, 4), (50960, 1.5, 2.5), (50970, 2.5, 5),
+             (51265, 100, 400), (50971, 3.5, 5.5), (51275, 25, 40), (51237, 1, 2), (51274, 11, 15), (50983, 135, 145),
+             (51006, 7, 40), (51301, 4, 15)]
+CARE_UNITS = ['MICU', 'SICU', 'CCU', 'CSRU', 'TSICU', 'NICU']
+ETHNICITIES = ['WHITE', 'BLACK/AFRICAN AMERICAN', 'HISPANIC OR LATINO', 'ASIAN - CHINESE', 'UNKNOWN/NOT SPECIFIED']
+
+
+def _time(t):
+    return t.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _events(rng, intime, hours, items, rate):
+    """ Random measurements of items during the first hours of an ICU stay, rate measurements per hour on average
+    :return: List of (itemid, charttime, valuenum)
+    """
+    events = []
+    for _ in range(int(rate * hours * rng.uniform(0.5, 1.5))):
+        itemid, low, high = rng.choice(items)
+        events.append((itemid, _time(intime + timedelta(seconds=rng.randrange(hours * 3600))), rng.uniform(low, high)))
+    return sorted(events, key=lambda e: e[1])
+
+
+def create_database(path, n_patients=1000, seed=22891, vital_rate=9, lab_rate=2, hours=72):
+    """
+    Create a stand-in database at path, replacing any existing one
+    :param n_patients: Number of patients, with 1-2 admissions of 1-2 ICU stays each
+    :param vital_rate: Average number of vital measurements per hour of an ICU stay
+    :param lab_rate: Average number of lab measurements per hour of an ICU stay
+    :param hours: Measurements are generated for the first hours of every ICU stay
+    """
+    rng = random.Random(seed)
+    if os.path.exists(path):
+        os.remove(path)
+    con = sqlite3.connect(path)
+    con.executescript(SCHEMA)
+    patients, admissions, icustays, chartevents, labevents = [], [], [], [], []
+    hadm_id, icustay_id = 100000, 200000
+    for subject_id in range(1, n_patients + 1):
+        admittime = datetime(2100, 1, 1) + timedelta(hours=rng.randrange(24 * 365))
+        dob = admittime - timedelta(days=rng.randrange(18 * 365, 90 * 365))
+        patients.append((subject_id, rng.choice(['M', 'F']), _time(dob)))
+        for _ in range(rng.randint(1, 2)):
+            hadm_id += 1
+            intime = admittime + timedelta(hours=rng.randrange(24))
+            for _ in range(rng.randint(1, 2)):
+                icustay_id += 1
+                outtime = intime + timedelta(hours=rng.randrange(24, 240))
+                icustays.append((subject_id, hadm_id, icustay_id, rng.choice(CARE_UNITS), _time(intime), _time(outtime)))
+                chartevents.extend((subject_id, hadm_id, icustay_id, itemid, charttime, value,
+                                    1 if rng.random() < 0.01 else None)
+                                   for itemid, charttime, value in _events(rng, intime, hours, VITAL_ITEMS, vital_rate))
+                labevents.extend((subject_id, hadm_id, itemid, charttime, value)
+                                 for itemid, charttime, value in _events(rng, intime, hours, LAB_ITEMS, lab_rate))
+                intime = outtime + timedelta(hours=rng.randrange(1, 48))
+            dischtime = intime + timedelta(hours=rng.randrange(24, 240))
+            deathtime = _time(outtime - timedelta(hours=1)) if rng.random() < 0.1 else None
+            admissions.append((subject_id, hadm_id, _time(admittime), _time(dischtime), deathtime,
+                               rng.choice(['EMERGENCY', 'ELECTIVE', 'URGENT']), 'SEPSIS', rng.choice(ETHNICITIES), 1))
+            if deathtime is not None:
+                break
+            admittime = dischtime + timedelta(days=rng.randrange(30, 365))
+    con.executemany('INSERT INTO patients VALUES (?,?,?)', patients)
+    con.executemany('INSERT INTO admissions VALUES (?,?,?,?,?,?,?,?,?)', admissions)
+    con.executemany('INSERT INTO icustays VALUES (?,?,?,?,?,?)', icustays)
+    con.executemany('INSERT INTO chartevents VALUES (?,?,?,?,?,?,?)', chartevents)
+    con.executemany('INSERT INTO labevents VALUES (?,?,?,?,?)', labevents)
+    con.commit()
+    con.close()
+    print('Created %s: %d ICU stays, %d vital and %d lab measurements'
+          % (path, len(icustays), len(chartevents), len(labevents)))
+
+
+if __name__=="__main__":
+
+    parser = argparse.ArgumentParser(description='Create a SQLite stand-in of the mimic database')
+    parser.add_argument('--path', type=str, default='./data/mimic_standin.db', help='Path of the SQLite database')
+    parser.add_argument('--n_patients', type=int, default=1000, help='Number of patients to generate')
+    args = parser.parse_args()
+    if os.path.dirname(args.path) and not os.path.exists(os.path.dirname(args.path)):
+        os.makedirs(os.path.dirname(args.path))
+    create_database(args.path, args.n_patients)
@@ -0,0 +1,37 @@
+import numpy as np
+from multiprocessing import Pool
+
+
+def _simulate_chunk(task):
+    simulate, n, seed_sequence, kwargs = task
+    return simulate(n, rng=np.random.default_rng(seed_sequence), **kwargs)
+
+
+def generate_chunks(simulate, count, seed, chunk_size=1000, n_workers=1, **kwargs):
+    """
+    Generate count samples of a simulator in chunks of chunk_size samples, spread over n_workers processes.
+    Chunk k is simulated with a random generator seeded by the k-th child of SeedSequence(seed), so the samples only
+    depend on seed and chunk_size, and are the same for any number of workers
+    :param simulate: Module level function simulate(n, rng=rng, **kwargs) returning a tuple of arrays of n samples
+    :param seed: Seed of the dataset
+    :return: Tuple of the arrays of all the samples, concatenated along the first axis
+    """
+    sizes = [min(chunk_size, count - start) for start in range(0, count, chunk_size)]
+    tasks = [(simulate, n, child, kwargs) for n, child in zip(sizes, np.random.SeedSequence(seed).spawn(len(sizes)))]
+    pool = Pool(n_workers) if n_workers > 1 else None
+    chunks = []
+    try:
+        for chunk in (pool.imap(_simulate_chunk, tasks) if pool is not None else map(_simulate_chunk, tasks)):
+            chunks.append(chunk)
+            print('%d/%d samples' % (sum(sizes[:len(chunks)]), count))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return tuple(np.concatenate([chunk[k] for chunk in chunks]) for k in range(len(chunks[0])))
+
+
+def seed_legacy_random(rng):
+    """ Seed the global numpy random state from rng, for libraries that draw from it (e.g. timesynth)
+    """
+    np.random.seed(int(rng.integers(2**32)))
@@ -4,6 +4,7 @@ import argparse
 import os
 from scipy.signal import butter, lfilter, freqz
 import timesynth as ts
+from data_generator.parallel import generate_chunks, seed_legacy_random
 
 np.random.seed(42)
 
@@ -31,7 +32,7 @@ fs = 30.0       # sample rate, Hz
 cutoff = 6.8 # desired cutoff frequency of the filter, Hz
 
 
-def next_state(previous_state, t):
+def next_state(previous_state, t, rng):
     # params = [(abs(p-0.1)+timing_factor)/2. for p in previous_state]
     # print(params,previous_state)
     # params = [abs(p - 0.1) for p in previous_state]
@@ -46,7 +47,7 @@ def next_state(previous_state, t):
     # print('previous', previous_state)
     params = params - float(t / 500) if params > 0.8 else params
     # print('transition probability',params)
-    next_st = np.random.binomial(1, params)
+    next_st = rng.binomial(1, params)
     return next_st
 
 
@@ -111,21 +112,21 @@ def generate_additive_labels(X):
     return y
 
 
-def create_signal(sig_len, gp_params):
+def create_signal(sig_len, gp_params, rng):
     signal = []
     state_local = []
     y = []
     importance = []
     y_logits = []
 
-    previous = np.random.binomial(1, P_S0)[0]
+    previous = rng.binomial(1, P_S0)[0]
     previous_label = None
     delta_state = 0
     sample = np.array([gp.sample_vectorized(time_vector=np.array(range(sig_len))) for gp in gp_params])
     #sample = np.array([butter_lowpass_filter(sample[f,:], cutoff, fs, order) for f in range(SIG_NUM)])
     #print(sample)
     for ii in range(sig_len):
-        next_st = next_state(previous, delta_state)
+        next_st = next_state(previous, delta_state, rng)
         state_n = next_st
 
         if state_n == previous:
@@ -145,7 +146,7 @@ def create_signal(sig_len, gp_params):
         y_probs = state_n * generate_additive_labels(sample_ii[:, imp_feature[state_n]]) + \
                   (1 - state_n) * generate_orange_labels(sample_ii[:, imp_feature[state_n]])
         y_logit = y_probs[0][1]
-        y_label = np.random.binomial(1, y_logit)
+        y_label = rng.binomial(1, y_logit)
 
         imp_sig = np.zeros(SIG_NUM)
         #if y_label != previous_label or ii == 0:
@@ -171,6 +172,26 @@ def create_signal(sig_len, gp_params):
     return signal, y, state_local, importance, y_logits
 
 
+def create_signals(count, sig_len, gp_lengthscale, means, rng):
+    """
+    Simulate count signals with create_signal
+    :param rng: np.random.Generator the samples are drawn from. timesynth draws the Gaussian processes from the global
+                numpy random state, which is seeded from rng
+    :return: Signals, labels, importance, states and label probabilities
+    """
+    seed_legacy_random(rng)
+    gp_vec = [ts.signals.GaussianProcess(lengthscale=g, mean=m, variance=0.5) for g,m in zip(gp_lengthscale,means)]
+    dataset, labels, importance_score, states, label_logits = [], [], [], [], []
+    for num in range(count):
+        sig, y, state, importance, y_logits = create_signal(sig_len, gp_params=gp_vec, rng=rng)
+        dataset.append(sig)
+        labels.append(y)
+        importance_score.append(importance.T)
+        states.append(state)
+        label_logits.append(y_logits)
+    return np.array(dataset), np.array(labels), np.array(importance_score), np.array(states), np.array(label_logits)
+
+
 def decay(x):
     return [0.9 * (1 - 0.1) ** x, 0.9 * (1 - 0.1) ** x]
 
@@ -204,31 +225,18 @@ def normalize(train_data, test_data, config='mean_normalized'):
     return train_data_n, test_data_n
 
 
-def create_dataset(count, signal_len):
-    dataset = []
-    labels = []
-    importance_score = []
-    states = []
-    label_logits = []
+def create_dataset(count, signal_len, seed=234, n_workers=1, chunk_size=100):
+    """
+    :param seed: Seed of the dataset, which is the same for any number of workers n_workers
+    :param chunk_size: Number of signals simulated at a time by a worker
+    """
     # mean, cov = init_distribution_params()
-    gp_lengthscale = np.random.uniform(0.5,2.5, SIG_NUM)
+    gp_lengthscale = np.random.default_rng(seed).uniform(0.5,2.5, SIG_NUM)
     means = [1.2, 0.8,1.5, 0.4, 0.5, -1.2, -1.5, -0.8, -0.4, -0.5]
-    gp_vec = [ts.signals.GaussianProcess(lengthscale=g, mean=m, variance=0.5) for g,m in zip(gp_lengthscale,means)]
-    for num in range(count):
-        sig, y, state, importance, y_logits = create_signal(signal_len, gp_params=gp_vec)  # , mean, cov)
-        dataset.append(sig)
-        labels.append(y)
-        importance_score.append(importance.T)
-        states.append(state)
-        label_logits.append(y_logits)
-
-        if num %50==0:
-            print(num, count)
-    dataset = np.array(dataset)
-    labels = np.array(labels)
-    importance_score = np.array(importance_score)
-    states = np.array(states)
-    label_logits = np.array(label_logits)
+    dataset, labels, importance_score, states, label_logits = generate_chunks(create_signals, count, seed, chunk_size,
+                                                                               n_workers, sig_len=signal_len,
+                                                                               gp_lengthscale=gp_lengthscale,
+                                                                               means=means)
     n_train = int(len(dataset) * 0.8)
     train_data = dataset[:n_train]
     test_data = dataset[n_train:]
@@ -268,10 +276,13 @@ if __name__ == '__main__':
     parser.add_argument('--signal_len', type=int, default=100, help='Length of the signal to generate')
     parser.add_argument('--signal_num', type=int, default=1000, help='Number of the signals to generate')
     parser.add_argument('--plot', action='store_true')
+    parser.add_argument('--seed', type=int, default=234, help='Seed of the dataset')
+    parser.add_argument('--n_workers', type=int, default=1, help='Number of processes generating the signals')
+    parser.add_argument('--chunk_size', type=int, default=100, help='Number of signals generated at a time by a worker')
     args = parser.parse_args()
 
-    np.random.seed(234)
-    dataset, labels, states,label_logits = create_dataset(args.signal_num, args.signal_len)
+    dataset, labels, states,label_logits = create_dataset(args.signal_num, args.signal_len, args.seed, args.n_workers,
+                                                          args.chunk_size)
 
     if args.plot:
         import matplotlib.pyplot as plt
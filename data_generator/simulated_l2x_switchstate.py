@@ -5,6 +5,7 @@ import os
 from scipy.signal import butter, lfilter, freqz
 import timesynth as ts
 from TSX.utils import shade_state_state_data
+from data_generator.parallel import generate_chunks, seed_legacy_random
 
 np.random.seed(42)
 
@@ -45,7 +46,7 @@ def init_distribution_params():
     return mean, covariance
 
 
-def next_state(previous_state, t):
+def next_state(previous_state, t, rng):
     p_vec = transition_matrix[previous_state]
     # if previous_state == 0:
     #     params = 0.9
@@ -58,7 +59,7 @@ def next_state(previous_state, t):
     # p_vec = np.zeros(STATE_NUM)
     # p_vec[previous_state] = params
     # p_vec[np.setdiff1d([0,1,2], previous_state)] = (1-params)/2.
-    next_st = np.random.choice([0,1,2], p=p_vec)
+    next_st = rng.choice([0,1,2], p=p_vec)
     return next_st
 
 
@@ -121,14 +122,14 @@ def generate_linear_labels_v2(X):
     return y
 
 
-def create_signal(sig_len, gp_params, mean, cov):
+def create_signal(sig_len, gp_params, mean, cov, rng):
     signal = None
     state_local = []
     y = []
     importance = []
     y_logits = []
 
-    previous = np.random.binomial(1, P_S0)[0]
+    previous = rng.binomial(1, P_S0)[0]
     previous_label = None
     delta_state = 1
 
@@ -139,7 +140,7 @@ def create_signal(sig_len, gp_params, mean, cov):
     state_local.append(previous)
 
     for ii in range(1,sig_len):
-        next_st = next_state(previous, delta_state)
+        next_st = next_state(previous, delta_state, rng)
         state_n = next_st
 
         imp_sig = np.zeros(SIG_NUM)
@@ -163,7 +164,7 @@ def create_signal(sig_len, gp_params, mean, cov):
             y_probs = generate_linear_labels(sample_ii.T[:, imp_feature[previous]])
         
             y_logit = [yy[1] for yy in y_probs]
-            y_label = [np.random.binomial(1, yy) for yy in y_logit]
+            y_label = [rng.binomial(1, yy) for yy in y_logit]
 
             #y_logit_past = y_logit
             y.extend(y_label)
@@ -192,7 +193,7 @@ def create_signal(sig_len, gp_params, mean, cov):
     y_probs = generate_linear_labels(sample_ii.T[:, imp_feature[previous]])
         
     y_logit = [yy[1] for yy in y_probs]
-    y_label = [np.random.binomial(1, yy) for yy in y_logit]
+    y_label = [rng.binomial(1, yy) for yy in y_logit]
             
     y.extend(y_label)
     y_logits.extend(y_logit)
@@ -205,6 +206,26 @@ def create_signal(sig_len, gp_params, mean, cov):
     return signal, y, state_local, importance, y_logits
 
 
+def create_signals(count, sig_len, gp_lengthscale, mean, cov, rng):
+    """
+    Simulate count signals with create_signal
+    :param rng: np.random.Generator the samples are drawn from. timesynth draws the Gaussian processes from the global
+                numpy random state, which is seeded from rng
+    :return: Signals, labels, importance, states and label probabilities
+    """
+    seed_legacy_random(rng)
+    dataset, labels, importance_score, states, label_logits = [], [], [], [], []
+    for num in range(count):
+        sig, y, state, importance, y_logits = create_signal(sig_len, gp_params=gp_lengthscale, mean=mean, cov=cov,
+                                                            rng=rng)
+        dataset.append(sig)
+        labels.append(y)
+        importance_score.append(importance.T)
+        states.append(state)
+        label_logits.append(y_logits)
+    return np.array(dataset), np.array(labels), np.array(importance_score), np.array(states), np.array(label_logits)
+
+
 def decay(x):
     return [0.9 * (1 - 0.1) ** x, 0.9 * (1 - 0.1) ** x]
 
@@ -238,29 +259,17 @@ def normalize(train_data, test_data, config='mean_normalized'):
     return train_data_n, test_data_n
 
 
-def create_dataset(count, signal_len):
-    dataset = []
-    labels = []
-    importance_score = []
-    states = []
-    label_logits = []
+def create_dataset(count, signal_len, seed=234, n_workers=1, chunk_size=100):
+    """
+    :param seed: Seed of the dataset, which is the same for any number of workers n_workers
+    :param chunk_size: Number of signals simulated at a time by a worker
+    """
     mean, cov = init_distribution_params()
-    gp_lengthscale = np.random.uniform(0.2,0.2, SIG_NUM)
-    for num in range(count):
-        sig, y, state, importance, y_logits = create_signal(signal_len, gp_params=gp_lengthscale , mean=mean, cov=cov)
-        dataset.append(sig)
-        labels.append(y)
-        importance_score.append(importance.T)
-        states.append(state)
-        label_logits.append(y_logits)
-
-        if num %50==0:
-            print(num, count)
-    dataset = np.array(dataset)
-    labels = np.array(labels)
-    importance_score = np.array(importance_score)
-    states = np.array(states)
-    label_logits = np.array(label_logits)
+    gp_lengthscale = np.random.default_rng(seed).uniform(0.2,0.2, SIG_NUM)
+    dataset, labels, importance_score, states, label_logits = generate_chunks(create_signals, count, seed, chunk_size,
+                                                                               n_workers, sig_len=signal_len,
+                                                                               gp_lengthscale=gp_lengthscale,
+                                                                               mean=mean, cov=cov)
     n_train = int(len(dataset) * 0.8)
     train_data = dataset[:n_train]
     test_data = dataset[n_train:]
@@ -300,10 +309,13 @@ if __name__ == '__main__':
     parser.add_argument('--signal_len', type=int, default=100, help='Length of the signal to generate')
     parser.add_argument('--signal_num', type=int, default=1000, help='Number of the signals to generate')
     parser.add_argument('--plot', action='store_true')
+    parser.add_argument('--seed', type=int, default=234, help='Seed of the dataset')
+    parser.add_argument('--n_workers', type=int, default=1, help='Number of processes generating the signals')
+    parser.add_argument('--chunk_size', type=int, default=100, help='Number of signals generated at a time by a worker')
     args = parser.parse_args()
 
-    np.random.seed(234)
-    dataset, labels, states,label_logits = create_dataset(args.signal_num, args.signal_len)
+    dataset, labels, states,label_logits = create_dataset(args.signal_num, args.signal_len, args.seed, args.n_workers,
+                                                          args.chunk_size)
 
     if args.plot:
         import matplotlib.pyplot as plt
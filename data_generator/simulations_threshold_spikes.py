@@ -1,13 +1,10 @@
 import timesynth as ts
-import matplotlib.pyplot as plt
 import numpy as np
-from scipy.special import expit
 from scipy.signal import butter, lfilter, freqz
 import pickle as pkl
 import os
-from sklearn.preprocessing import OneHotEncoder
-from sklearn.preprocessing import StandardScaler, MinMaxScaler
-import random
+import argparse
+from data_generator.parallel import generate_chunks, seed_legacy_random
 
 def butter_lowpass(cutoff, fs, order=5):
     nyq = 0.5 * fs
@@ -16,8 +13,10 @@ def butter_lowpass(cutoff, fs, order=5):
     return b, a
 
 def butter_lowpass_filter(data, cutoff, fs, order=5):
+    """ Filter data along its last (time) axis, so that a whole [samples, features, time] array is filtered at once
+    """
     b, a = butter_lowpass(cutoff, fs, order=order)
-    y = lfilter(b, a, data)
+    y = lfilter(b, a, data, axis=-1)
     return y
 
 # Filter requirements.
@@ -25,163 +24,70 @@ order = 6
 fs = 30.0       # sample rate, Hz
 cutoff = 6.8 # desired cutoff frequency of the filter, Hz
 
-# Get the filter coefficients so we can check its frequency response.
-b, a = butter_lowpass(cutoff, fs, order)
-
-w, h = freqz(b, a, worN=8000)
-plt.subplot(1, 1, 1)
-plt.plot(0.5*fs*w/np.pi, np.abs(h), 'b')
-plt.plot(cutoff, 0.5*np.sqrt(2), 'ko')
-plt.axvline(cutoff, color='k')
-plt.xlim(0, 0.5*fs)
-plt.title("Lowpass Filter Frequency Response")
-plt.xlabel('Frequency [Hz]')
-plt.grid()
-
-
-def main(n_samples, plot, Tt=80):
-    signal_in = []
-    thresholds = []
-    trend_style=[]
-    for i in range(n_samples):
-        x,t,trend = generate_sample(plot, Tt=Tt)
-        signal_in.append(x)
-        thresholds.append(t)
-        trend_style.append(trend)
+
+def plot_filter_response():
+    """ Plot the frequency response of the lowpass filter
+    """
+    import matplotlib.pyplot as plt
+    b, a = butter_lowpass(cutoff, fs, order)
+    w, h = freqz(b, a, worN=8000)
+    plt.subplot(1, 1, 1)
+    plt.plot(0.5*fs*w/np.pi, np.abs(h), 'b')
+    plt.plot(cutoff, 0.5*np.sqrt(2), 'ko')
+    plt.axvline(cutoff, color='k')
+    plt.xlim(0, 0.5*fs)
+    plt.title("Lowpass Filter Frequency Response")
+    plt.xlabel('Frequency [Hz]')
+    plt.grid()
+    plt.show()
+
+
+def add_spikes(x, rng, p_spikes=0.3, lamda_poisson=3, kappa=1.5):
+    """
+    Add spikes of height kappa to each feature of each sample with probability p_spikes. The number of spikes follows a
+    Poisson distribution and their times are drawn uniformly without replacement
+    :param x: Signals [samples, features, time], modified in place
+    :return: Boolean array of the spike positions
+    """
+    n_samples, n_features, Tt = x.shape
+    has_spikes = rng.random((n_samples, n_features)) < p_spikes
+    n_spikes = np.where(has_spikes, np.minimum(rng.poisson(lamda_poisson, (n_samples, n_features)), Tt), 0)
+    # The n_spikes first times of a random permutation of the time steps
+    rank = np.argsort(np.argsort(rng.random((n_samples, n_features, Tt)), axis=-1), axis=-1)
+    spikes = rank < n_spikes[..., None]
+    x += kappa * spikes
+    return spikes
+
+
+def main(n_samples, plot, Tt=80, seed=1234, n_workers=1, chunk_size=100):
+    """
+    :param seed: Seed of the dataset, which is the same for any number of workers n_workers
+    :param chunk_size: Number of samples generated at a time by a worker
+    """
+    rng = np.random.default_rng(seed)
+    signal_in, thresholds, trend_style = generate_chunks(generate_samples, n_samples, seed, chunk_size, n_workers,
+                                                         plot=plot, Tt=Tt)
+    thresholds = list(thresholds)
 
     print('samples done!')
-    signal_in = np.array(signal_in)
+
+    x_n = butter_lowpass_filter(signal_in, cutoff, fs, order)
+    spikes = add_spikes(x_n, rng)
+    ## The label switches to 1 at the first spike of the first feature, which is the important observation
+    first_spike = np.argmax(spikes[:, 0, :], axis=-1)
+    has_spike = spikes[:, 0, :].any(axis=-1)
+    y = ((np.arange(Tt) >= first_spike[:, None]) & has_spike[:, None]).astype(float)
+    ground_truth_imp_mat = np.zeros((n_samples, 3, Tt))
+    ground_truth_imp_mat[np.nonzero(has_spike)[0], 0, first_spike[has_spike]] = 1
 
     n_train = int(0.8*n_samples)
-    x_train = signal_in[0:n_train,:,:]
-    thresholds_train = thresholds[0:n_train]
-    n_test = n_samples - n_train
-
-    x_test = signal_in[n_train:,:,:]
-    thresholds_test = thresholds[n_train:]
-
-    if 0:
-        scaler = MinMaxScaler()
-        x_train_flat = scaler.fit_transform(np.reshape(x_train,[x_train.shape[0],-1]))
-        x_train_n = np.reshape(x_train_flat,x_train.shape)
-        x_test_flat = scaler.transform(np.reshape(x_test,[x_test.shape[0],-1]))
-        x_test_n = np.reshape(x_test_flat,x_test.shape)
-    else:
-        x_train_n = x_train
-        x_test_n = x_test
-        
-    if 1:
-        x1_train_lpf = np.array([butter_lowpass_filter(x[0,:], cutoff, fs, order) for x in x_train_n])
-        x2_train_lpf = np.array([butter_lowpass_filter(x[1,:], cutoff, fs, order) for x in x_train_n])
-        x3_train_lpf = np.array([butter_lowpass_filter(x[2,:], cutoff, fs, order) for x in x_train_n])
-        x_train_n = np.stack([x1_train_lpf, x2_train_lpf, x3_train_lpf],axis=1)
-
-        x1_test_lpf = np.array([butter_lowpass_filter(x[0,:], cutoff, fs, order) for x in x_test_n])
-        x2_test_lpf = np.array([butter_lowpass_filter(x[1,:], cutoff, fs, order) for x in x_test_n])
-        x3_test_lpf = np.array([butter_lowpass_filter(x[2,:], cutoff, fs, order) for x in x_test_n])
-        x_test_n = np.stack([x1_test_lpf, x2_test_lpf, x3_test_lpf],axis=1)
-
-    kappa=1.5
-    y_train = []
-    ground_truth_importance_train=[]
-    ground_truth_importance_test=[]
-    pvec=[0.7,0.3]
-    lamda_poisson = 3
-    
-    for i in range(n_train):
-        gt_t = np.zeros((Tt))
-        add_spikes = np.random.choice([0,1],1,p=pvec)
-        if add_spikes:
-            nts = np.random.poisson(lamda_poisson,1)
-        else:
-            nts=0
-        t_vec = np.sort(np.random.choice(list(range(Tt)),nts,replace=False))
-        x_train_n[i,0,t_vec] +=   kappa
-        if len(t_vec)>0:
-            gt_t[t_vec[0]] = 1
-            
-        y_vec = np.zeros((Tt))
-        if len(t_vec)>0:
-            y_vec[t_vec[0]:] = 1
-        y_train.append(y_vec)
-        ground_truth_importance_train.append(gt_t)
-        
-        add_spikes = np.random.choice([0,1],1,p=pvec)
-        if add_spikes:
-            nts = np.random.poisson(lamda_poisson,1)
-        else:
-            nts=0
-        #nts=1
-        t = np.random.choice(list(range(Tt)),nts,replace=False)
-        if len(t)>0:
-            x_train_n[i,1,t] +=  kappa
-            
-        add_spikes = np.random.choice([0,1],1,p=pvec)
-        if add_spikes:
-            nts = np.random.poisson(lamda_poisson,1)
-        else:
-            nts=0
-        #nts=1
-        t = np.random.choice(list(range(Tt)),nts,replace=False)
-        if len(t)>0:
-            x_train_n[i,2,t] +=  kappa
-
-    y_test = []
-    for i in range(x_test_n.shape[0]):
-        gt_t = np.zeros((Tt))
-        add_spikes = np.random.choice([0,1],1,p=pvec)
-        if add_spikes:
-            nts = np.random.poisson(lamda_poisson,1)
-        else:
-            nts=0
-
-        t_vec = np.sort(np.random.choice(list(range(Tt)),nts,replace=False))
-        if len(t_vec)>0:
-            x_test_n[i,0,t_vec] +=   kappa
-
-        if len(t_vec)>0:
-            gt_t[t_vec[0]] = 1
-            
-        y_vec = np.zeros((Tt))
-        if len(t_vec)>0:
-            y_vec[t_vec[0]:] = 1
-        y_test.append(y_vec)
-        ground_truth_importance_test.append(gt_t)
-
-        add_spikes = np.random.choice([0,1],1,p=pvec)
-        if add_spikes:
-            nts = np.random.poisson(lamda_poisson,1)
-        else:
-            nts=0
-        #nts=1
-        t = np.random.choice(list(range(Tt)),nts,replace=False)
-        if len(t)>0:
-            x_test_n[i,1,t] +=  kappa
-
-        add_spikes = np.random.choice([0,1],1,p=pvec)
-        if add_spikes:
-            nts = np.random.poisson(lamda_poisson,1)
-        else:
-            nts=0
-        #nts=1
-        t = np.random.choice(list(range(Tt)),nts,replace=False)
-        if len(t)>0:
-            x_test_n[i,2,t] +=  kappa
-
-    y_train = np.array(y_train)
-    y_test = np.array(y_test)
-
-
-    ground_truth_importance_train = np.array(ground_truth_importance_train)
-    ground_truth_importance_test = np.array(ground_truth_importance_test)
-    
-    ground_truth_imp_train_mat = np.zeros((n_train,3,Tt))
-    ground_truth_imp_test_mat = np.zeros((n_test,3,Tt))
-    
-    ground_truth_imp_train_mat[:,0,:] = ground_truth_importance_train
-    ground_truth_imp_test_mat[:,0,:] = ground_truth_importance_test
+    x_train_n, x_test_n = x_n[:n_train], x_n[n_train:]
+    y_train, y_test = y[:n_train], y[n_train:]
+    thresholds_train, thresholds_test = thresholds[:n_train], thresholds[n_train:]
+    ground_truth_imp_train_mat, ground_truth_imp_test_mat = ground_truth_imp_mat[:n_train], ground_truth_imp_mat[n_train:]
  
     if plot:
+        import matplotlib.pyplot as plt
         for i in range(x_train_n.shape[0]):
             plt.plot(x_train_n[i,0,:], label='x1')
             plt.plot(x_train_n[i,1,:], label='x2')
@@ -201,24 +107,35 @@ def main(n_samples, plot, Tt=80):
 
     return x_train_n[:,:,:],y_train,x_test_n[:,:,:],y_test,thresholds_train,thresholds_test, ground_truth_imp_train_mat[:,:,:], ground_truth_imp_test_mat[:,:,:]
 
-def generate_sample(plot, Tt=80):
+def generate_samples(count, plot, rng, Tt=80):
+    """
+    :param rng: np.random.Generator the samples are drawn from. timesynth draws the noise from the global numpy random
+                state, which is seeded from rng
+    :return: Samples, thresholds and trend styles of count generate_sample calls
+    """
+    seed_legacy_random(rng)
+    samples = [generate_sample(plot, rng, Tt=Tt) for _ in range(count)]
+    return tuple(np.array([sample[k] for sample in samples]) for k in range(3))
+
+
+def generate_sample(plot, rng, Tt=80):
     trend_style='hill'
     noise = ts.noise.GaussianNoise(std=0.001)
-    x1 = ts.signals.NARMA(order=2,coefficients=[.5,.5,1.5,.5],seed=random.seed())
+    x1 = ts.signals.NARMA(order=2,coefficients=[.5,.5,1.5,.5],seed=int(rng.integers(2**32)))
     x1_ts = ts.TimeSeries(x1, noise_generator=noise)
     x1_sample, signals, errors = x1_ts.sample(np.array(range(Tt)))
     x1_sample += 0.003*np.array(range(Tt)) 
     x1_sample = x1_sample/(max(x1_sample)-min(x1_sample)) # - 1
     
     noise = ts.noise.GaussianNoise(std=0.001)
-    x2 = ts.signals.NARMA(order=2,coefficients=[.5,.5,1.5,.5],seed=random.seed())
+    x2 = ts.signals.NARMA(order=2,coefficients=[.5,.5,1.5,.5],seed=int(rng.integers(2**32)))
     x2_ts = ts.TimeSeries(x2,noise_generator=noise)
     x2_sample,signals,errors = x2_ts.sample(np.array(range(Tt)))
     x2_sample += 0.065*np.array(range(Tt)) 
     x2_sample /=(max(x2_sample)-min(x2_sample))
     
     noise = ts.noise.GaussianNoise(std=0.001)
-    x3 = ts.signals.NARMA(order=2,seed=random.seed())
+    x3 = ts.signals.NARMA(order=2,seed=int(rng.integers(2**32)))
     x3_ts = ts.TimeSeries(x3, noise_generator=noise)
     x3_sample, signals, errors = x3_ts.sample(np.array(range(Tt)))
     x3_sample = x3_sample/(max(x3_sample)-min(x3_sample)) - 0.5
@@ -240,8 +157,13 @@ def logistic(x):
 if __name__=='__main__':
     if not os.path.exists('./data'):
         os.mkdir('./data')
-    n_samples = 3000
-    x_train_n,y_train,x_test_n,y_test,thresholds_train,thresholds_test, gt_importance_train, gt_importance_test = main(n_samples=n_samples, plot=False)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_samples', type=int, default=3000, help='Number of the samples to generate')
+    parser.add_argument('--seed', type=int, default=1234, help='Seed of the dataset')
+    parser.add_argument('--n_workers', type=int, default=1, help='Number of processes generating the samples')
+    parser.add_argument('--chunk_size', type=int, default=100, help='Number of samples generated at a time by a worker')
+    args = parser.parse_args()
+    x_train_n,y_train,x_test_n,y_test,thresholds_train,thresholds_test, gt_importance_train, gt_importance_test = main(n_samples=args.n_samples, plot=False, seed=args.seed, n_workers=args.n_workers, chunk_size=args.chunk_size)
     if not os.path.exists('./data/simulated_spike_data'):
         os.mkdir('./data/simulated_spike_data')
     save_data('./data/simulated_spike_data/x_train.pkl', x_train_n)
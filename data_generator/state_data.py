@@ -1,7 +1,8 @@
 import numpy as np
-import pickle
 import argparse
 import os
+from TSX.array_store import save_arrays
+from data_generator.parallel import generate_chunks
 
 SIG_NUM = 3
 STATE_NUM = 1
@@ -39,7 +40,7 @@ def init_distribution_params():
     return mean, covariance
 
 
-def next_state(previous_state, t):
+def next_state(previous_state, t, rng):
     #params = [(abs(p-0.1)+timing_factor)/2. for p in previous_state]
     #print(params,previous_state)
     #params = [abs(p - 0.1) for p in previous_state]
@@ -54,7 +55,7 @@ def next_state(previous_state, t):
     #print('previous', previous_state)
     params = params-float(t/500) if params>0.8 else params
     #print('transition probability',params)
-    next = np.random.binomial(1,params)
+    next = rng.binomial(1,params)
     return next
 
 
@@ -70,20 +71,55 @@ def state_decoder(previous,next):
     return int(next*(1-previous)+(1-next)*(previous))
 
 
-def create_signal(sig_len,mean,cov):
+def transition_probability(previous_state, delta_state):
+    """ Probability of being in state 1 at the next step, next_state for arrays of states and of times spent in them
+    """
+    params = np.where(previous_state==1, 0.95, 0.05)
+    return np.clip(np.where(params>0.8, params-delta_state/500., params), 0., 1.)
+
+
+def create_signals(count, sig_len, mean, cov, rng):
+    """
+    Simulate count signals at once, advancing all the hidden state sequences together. Samples follow the same
+    distributions as those of create_signal
+    :param rng: np.random.Generator the samples are drawn from
+    :return: signals [count, SIG_NUM, sig_len], labels, states and label probabilities [count, sig_len], importance
+             [count, SIG_NUM, sig_len]
+    """
+    chol = np.linalg.cholesky(cov)
+    signals = np.zeros((count, sig_len, SIG_NUM))
+    importance = np.zeros((count, sig_len, SIG_NUM))
+    states = np.zeros((count, sig_len), dtype=int)
+    previous = rng.binomial(1, P_S0[0], size=count)
+    delta_state = np.zeros(count)
+    for i in range(sig_len):
+        state_n = rng.binomial(1, transition_probability(previous, delta_state))
+        delta_state = np.where(state_n==previous, delta_state+1, 0)
+        changed = (state_n!=previous) | (i==0)
+        importance[np.nonzero(changed)[0], i, np.array(imp_feature)[state_n[changed]]] = 1
+        noise = rng.standard_normal((count, SIG_NUM))
+        signals[:, i] = mean[state_n] + np.einsum('nij,nj->ni', chol[state_n], noise)
+        states[:, i] = state_n
+        previous = state_n
+    y_logits = logit(np.take_along_axis(signals, np.array(imp_feature)[states][..., None], axis=-1)[..., 0])
+    y = rng.binomial(1, y_logits)
+    return signals.transpose(0, 2, 1), y, states, importance.transpose(0, 2, 1), y_logits
+
+
+def create_signal(sig_len,mean,cov,rng):
     signal = []
     states = []
     y = []
     importance = []
     y_logits=[]
 
-    previous = np.random.binomial(1, P_S0)[0]
+    previous = rng.binomial(1, P_S0)[0]
     delta_state=0
     state_n=None
     for i in range(sig_len):
         #next = next_state(previous, i)
         
-        next = next_state(previous, delta_state)
+        next = next_state(previous, delta_state, rng)
         #state_n = state_decoder(previous,next)
         state_n = next
 
@@ -101,11 +137,11 @@ def create_signal(sig_len,mean,cov):
         #    imp_sig = [0, 0, 0]
 
         importance.append(imp_sig)
-        sample = np.random.multivariate_normal(mean[state_n], cov[state_n])
+        sample = rng.multivariate_normal(mean[state_n], cov[state_n])
         previous = state_n
         signal.append(sample)
         y_logit = logit(sample[imp_feature[state_n]])
-        y_label = np.random.binomial(1,y_logit)
+        y_label = rng.binomial(1,y_logit)
 
         #print('previous state:',previous,'next state probability:', next, 'delta_state:',delta_state,'current state:',state_n, 'mean:', mean[state_n], 'cov:', cov[state_n],'ylogit', y_logit)
 
@@ -152,53 +188,31 @@ def normalize(train_data, test_data, config='mean_normalized'):
     return train_data_n, test_data_n
 
 
-def create_dataset(count, signal_len):
-    dataset = []
-    labels = []
-    importance_score = []
-    states = []
-    label_logits=[]
+def create_dataset(count, signal_len, seed=234, n_workers=1, chunk_size=1000):
+    """
+    :param seed: Seed of the dataset, which is the same for any number of workers n_workers
+    :param chunk_size: Number of signals simulated at a time by a worker
+    """
     mean, cov = init_distribution_params()
-    for num in range(count):
-        sig, y, state, importance,y_logits = create_signal(signal_len,mean,cov)
-        dataset.append(sig)
-        labels.append(y)
-        importance_score.append(importance.T)
-        states.append(state)
-        label_logits.append(y_logits)
-    dataset = np.array(dataset)
-    labels = np.array(labels)
-    importance_score = np.array(importance_score)
-    states = np.array(states)
-    label_logits = np.array(label_logits)
+    dataset, labels, states, importance_score, label_logits = generate_chunks(create_signals, count, seed, chunk_size,
+                                                                               n_workers, sig_len=signal_len, mean=mean,
+                                                                               cov=cov)
     n_train= int(len(dataset)*0.8)
     train_data = dataset[:n_train]
     test_data = dataset[n_train:]
     #train_data_n, test_data_n = normalize(train_data, test_data)
     train_data_n= train_data
     test_data_n = test_data
-    if not os.path.exists('./data/simulated_data'):
-        os.mkdir('./data/simulated_data')
-    with open('./data/simulated_data/state_dataset_x_train.pkl', 'wb') as f:
-        pickle.dump(train_data_n, f)
-    with open('./data/simulated_data/state_dataset_x_test.pkl', 'wb') as f:
-        pickle.dump(test_data_n, f)
-    with open('./data/simulated_data/state_dataset_y_train.pkl', 'wb') as f:
-        pickle.dump(labels[:n_train], f)
-    with open('./data/simulated_data/state_dataset_y_test.pkl', 'wb') as f:
-        pickle.dump(labels[n_train:], f)
-    with open('./data/simulated_data/state_dataset_importance_train.pkl', 'wb') as f:
-        pickle.dump(importance_score[:n_train], f)
-    with open('./data/simulated_data/state_dataset_importance_test.pkl', 'wb') as f:
-        pickle.dump(importance_score[n_train:], f)
-    with open('./data/simulated_data/state_dataset_logits_train.pkl', 'wb') as f:
-        pickle.dump(label_logits[:n_train], f)
-    with open('./data/simulated_data/state_dataset_logits_test.pkl', 'wb') as f:
-        pickle.dump(label_logits[n_train:], f)
-    with open('./data/simulated_data/state_dataset_states_train.pkl', 'wb') as f:
-        pickle.dump(states[:n_train], f)
-    with open('./data/simulated_data/state_dataset_states_test.pkl', 'wb') as f:
-        pickle.dump(states[n_train:], f)
+    save_arrays('./data/simulated_data', {'x_train': train_data_n.astype(np.float32),
+                                          'x_test': test_data_n.astype(np.float32),
+                                          'y_train': labels[:n_train].astype(np.float32),
+                                          'y_test': labels[n_train:].astype(np.float32),
+                                          'importance_train': importance_score[:n_train],
+                                          'importance_test': importance_score[n_train:],
+                                          'logits_train': label_logits[:n_train],
+                                          'logits_test': label_logits[n_train:],
+                                          'states_train': states[:n_train],
+                                          'states_test': states[n_train:]}, prefix='state_dataset_')
 
 
     return dataset, labels, states
@@ -211,10 +225,13 @@ if __name__ =='__main__':
     parser.add_argument('--signal_len', type=int, default=100, help='Length of the signal to generate')
     parser.add_argument('--signal_num', type=int, default=1000, help='Number of the signals to generate')
     parser.add_argument('--plot', action='store_true')
+    parser.add_argument('--seed', type=int, default=234, help='Seed of the dataset')
+    parser.add_argument('--n_workers', type=int, default=1, help='Number of processes generating the signals')
+    parser.add_argument('--chunk_size', type=int, default=1000, help='Number of signals generated at a time by a worker')
     args = parser.parse_args()
 
-    np.random.seed(234)
-    dataset, labels, states = create_dataset(args.signal_num, args.signal_len)
+    dataset, labels, states = create_dataset(args.signal_num, args.signal_len, args.seed, args.n_workers,
+                                             args.chunk_size)
 
     if args.plot:
         import matplotlib.pyplot as plt
@@ -1,4 +1,5 @@
 from TSX.utils import load_data, load_simulated_data, load_ghg_data
+from TSX.loaders import dataset_signals
 from TSX.models import DeepKnn, EncoderRNN
 from TSX.experiments import EncoderPredictor, FeatureGeneratorExplainer, BaselineExplainer
 from data_generator.true_generator_state_data import TrueFeatureGenerator
@@ -32,10 +33,10 @@ def main(generator_type, data_path):
                                     historical=(configs['historical'] == 1), generator_type=generator_type, data=data,
                                     experiment=experiment + '_' + generator_type)
 
-    exp.generator.load_state_dict(torch.load(os.path.join('./ckpt/%s/%s.pt' % ('mimic', generator_type))))
+    exp.generator.load_state_dict(torch.load(os.path.join('./ckpt/%s/%s' % ('mimic', exp.generator_ckpt_name()))))
     baselines = ['FFC','AFO','FO']
-    testset = list(exp.test_loader.dataset)
-    test_signals = torch.stack(([x[0] for x in testset])).to(device)
+    testset = exp.test_loader.dataset
+    test_signals = dataset_signals(testset).to(device)
 
     sum_matrix = np.zeros((3,3))
     top_n = 6
@@ -12,7 +12,10 @@ from matplotlib import rc, rcParams
 rc('font', weight='bold')
 
 from TSX.utils import load_simulated_data, train_model_rt, compute_median_rank, train_model_rt_binary, \
-    train_model_multiclass, train_model, load_data
+    train_model_multiclass, train_model, load_data, load_sharded_data
+from TSX.distributed import run_data_parallel
+from TSX.array_store import load_array
+from TSX.loaders import is_sequential
 from TSX.models import StateClassifier, RETAIN, EncoderRNN, ConvClassifier, StateClassifierMIMIC
 
 from TSX.generator import JointFeatureGenerator, JointDistributionGenerator
@@ -47,9 +50,20 @@ if __name__ == '__main__':
     parser.add_argument('--generator_type', type=str, default='history')
     parser.add_argument('--out_path', type=str, default='./output/')
     parser.add_argument('--mimic_path', type=str)
+    parser.add_argument('--shard_path', type=str, default=None,
+                        help='directory of a sharded cohort, streamed from disk instead of loading the mimic data')
     parser.add_argument('--binary', action='store_true', default=False)
     parser.add_argument('--gt', type=str, default='true_model', help='specify ground truth score')
     parser.add_argument('--cv', type=int, default=0, help='cross validation')
+    parser.add_argument('--teacher_forcing', action='store_true', default=False,
+                        help='train the generator on every time step from a single pass')
+    parser.add_argument('--n_procs', type=int, default=1, help='number of local processes for data-parallel training')
+    parser.add_argument('--single_pass', action='store_true', default=False,
+                        help='train the black-box model on all time steps of a batch from a single forward pass')
+    parser.add_argument('--sample_store_seed', type=int, default=None,
+                        help='reuse FIT generator samples from a store keyed by the generator checkpoint and this seed')
+    parser.add_argument('--cov_rank', type=int, default=None,
+                        help='rank of the low-rank plus diagonal generator covariance (full covariance if not set)')
     args = parser.parse_args()
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
     batch_size = 100
@@ -105,7 +119,11 @@ if __name__ == '__main__':
         os.mkdir(plot_path)
 
     # Load data
-    if args.data == 'mimic' or args.data=='mimic_int':
+    if (args.data == 'mimic' or args.data=='mimic_int') and args.shard_path is not None:
+        p_data, train_loader, valid_loader, test_loader = load_sharded_data(batch_size=batch_size, path=args.shard_path)
+        feature_size = p_data.feature_size
+        class_weight = p_data.pos_weight
+    elif args.data == 'mimic' or args.data=='mimic_int':
         if args.mimic_path is None:
             raise ValueError('Specify the data directory containing processed mimic data')
         p_data, train_loader, valid_loader, test_loader = load_data(batch_size=batch_size, \
@@ -149,45 +167,47 @@ if __name__ == '__main__':
             if not args.binary:
                 optimizer = torch.optim.Adam(model.parameters(), lr=0.0001, weight_decay=1e-3)
                 if args.data=='mimic':
-                    train_model(model, train_loader, valid_loader, optimizer=optimizer, n_epochs=100,
-                                device=device, experiment='model',cv=args.cv)
+                    run_data_parallel(train_model, model, train_loader, valid_loader, optimizer=optimizer, n_epochs=100,
+                                device=device, experiment='model',cv=args.cv, n_procs=args.n_procs)
                 elif 'simulation' in args.data:
-                    train_model_rt(model=model, train_loader=train_loader, valid_loader=valid_loader, optimizer=optimizer, n_epochs=50,
-                               device=device, experiment='model', data=args.data,cv=args.cv)
+                    run_data_parallel(train_model_rt, model, train_loader, valid_loader=valid_loader, optimizer=optimizer, n_epochs=50,
+                               device=device, experiment='model', data=args.data,cv=args.cv, single_pass=args.single_pass, n_procs=args.n_procs)
                 elif args.data=='mimic_int':
                     optimizer = torch.optim.Adam(model.parameters(), lr=0.0001, weight_decay=0.0001)
                     if type(activation).__name__==type(torch.nn.Softmax(-1)).__name__: #suresh et al
-                        train_model_multiclass(model=model, train_loader=train_loader, valid_loader=test_loader, 
+                        run_data_parallel(train_model_multiclass, model, train_loader, valid_loader=test_loader, 
                         optimizer=optimizer, n_epochs=50, device=device, experiment='model', data=args.data,num=5, 
-                        loss_criterion=torch.nn.CrossEntropyLoss(weight=torch.FloatTensor(class_weight).to(device)),cv=args.cv)
+                        loss_criterion=torch.nn.CrossEntropyLoss(weight=torch.FloatTensor(class_weight).to(device)),cv=args.cv,
+                        single_pass=args.single_pass, n_procs=args.n_procs)
                     else:
-                        train_model_multiclass(model=model, train_loader=train_loader, valid_loader=test_loader,
+                        run_data_parallel(train_model_multiclass, model, train_loader, valid_loader=test_loader,
                         optimizer=optimizer, n_epochs=25, device=device, experiment='model', data=args.data,num=5,
                         #loss_criterion=torch.nn.BCEWithLogitsLoss(pos_weight=torch.tensor(class_weight).cuda()),cv=args.cv)
-                        loss_criterion=torch.nn.BCEWithLogitsLoss(),cv=args.cv)
+                        loss_criterion=torch.nn.BCEWithLogitsLoss(),cv=args.cv, single_pass=args.single_pass, n_procs=args.n_procs)
                         #loss_criterion=torch.nn.CrossEntropyLoss(weight=torch.FloatTensor(class_weight).cuda()),cv=args.cv)
                         #loss_criterion=torch.nn.CrossEntropyLoss(),cv=args.cv)
             else:
                 #this learning rate works much better for spike data
                 optimizer = torch.optim.Adam(model.parameters(), lr=0.001, weight_decay=1e-4)
                 if args.data=='mimic':
-                    train_model(model, train_loader, valid_loader, optimizer=optimizer, n_epochs=200,
-                                device=device, experiment='model',cv=args.cv)
+                    run_data_parallel(train_model, model, train_loader, valid_loader, optimizer=optimizer, n_epochs=200,
+                                device=device, experiment='model',cv=args.cv, n_procs=args.n_procs)
                 else:
-                    train_model_rt_binary(model, train_loader, valid_loader, optimizer=optimizer, n_epochs=250,
-                               device=device, experiment='model', data=args.data,cv=args.cv)
+                    run_data_parallel(train_model_rt_binary, model, train_loader, valid_loader, optimizer=optimizer, n_epochs=250,
+                               device=device, experiment='model', data=args.data,cv=args.cv, n_procs=args.n_procs)
 
         model.load_state_dict(torch.load(os.path.join('./ckpt/%s/%s_%d.pt' % (args.data, 'model',args.cv))))
 
         if args.explainer == 'fit':
             if args.generator_type=='history':
-                generator = JointFeatureGenerator(feature_size, hidden_size=feature_size * 3, data=args.data)
+                generator = JointFeatureGenerator(feature_size, hidden_size=feature_size * 3, data=args.data, rank=args.cov_rank)
                 if args.train:
                     if args.data=='mimic_int' or args.data=='simulation_spike':
                         explainer = FITExplainer(model,activation=torch.nn.Sigmoid(),n_classes=n_classes)
                     else:
                         explainer = FITExplainer(model)
-                    explainer.fit_generator(generator, train_loader, valid_loader,cv=args.cv)
+                    explainer.fit_generator(generator, train_loader, valid_loader,cv=args.cv,
+                                            teacher_forcing=args.teacher_forcing, n_procs=args.n_procs)
                 else:
                     generator.load_state_dict(torch.load(os.path.join('./ckpt/%s/%s_%d.pt' % (args.data, 'joint_generator',args.cv))))
                     if args.data=='mimic_int' or args.data=='simulation_spike':
@@ -201,6 +221,9 @@ if __name__ == '__main__':
                 else:
                     explainer = FITExplainer(model, generator)
 
+            if args.sample_store_seed is not None:
+                explainer.enable_sample_store(seed=args.sample_store_seed)
+
         elif args.explainer == 'integrated_gradient':
             if args.data=='mimic_int' or args.data=='simulation_spike':
                 explainer = IGExplainer(model,activation=activation)
@@ -238,15 +261,15 @@ if __name__ == '__main__':
                 explainer = GradientShapExplainer(model)
 
         elif args.explainer == 'ffc':
-            generator = JointFeatureGenerator(feature_size, hidden_size=feature_size * 3, data=args.data)
+            generator = JointFeatureGenerator(feature_size, hidden_size=feature_size * 3, data=args.data, rank=args.cov_rank)
             if args.train:
                 if args.data=='mimic_int' or args.data=='simulation_spike':
                     explainer = FFCExplainer(model,activation=activation)
                 else:
                     explainer = FFCExplainer(model)
-                explainer.fit_generator(generator, train_loader, valid_loader)
+                explainer.fit_generator(generator, train_loader, valid_loader, cv=args.cv)
             else:
-                generator.load_state_dict(torch.load(os.path.join('./ckpt/%s/%s.pt' % (args.data, 'joint_generator'))))
+                generator.load_state_dict(torch.load(os.path.join('./ckpt/%s/%s_%d.pt' % (args.data, 'joint_generator', args.cv))))
                 if args.data=='mimic_int' or args.data=='simulation_spike':
                     explainer = FFCExplainer(model, generator,activation=activation)
                 else:
@@ -268,12 +291,9 @@ if __name__ == '__main__':
 
     # Load ground truth for simulations
     if data_type == 'state':
-        with open(os.path.join(data_path, 'state_dataset_importance_test.pkl'), 'rb') as f:
-            gt_importance_test = pkl.load(f)
-        with open(os.path.join(data_path, 'state_dataset_states_test.pkl'), 'rb') as f:
-            state_test = pkl.load(f)
-        with open(os.path.join(data_path, 'state_dataset_logits_test.pkl'), 'rb') as f:
-            logits_test = pkl.load(f)
+        gt_importance_test = load_array(data_path, 'importance_test', prefix='state_dataset_')
+        state_test = load_array(data_path, 'states_test', prefix='state_dataset_')
+        logits_test = load_array(data_path, 'logits_test', prefix='state_dataset_')
     elif data_type == 'spike':
         with open(os.path.join(data_path, 'gt_test.pkl'), 'rb') as f:
             gt_importance_test = pkl.load(f)
@@ -281,6 +301,12 @@ if __name__ == '__main__':
     importance_scores = []
     ranked_feats=[]
     n_samples = 1
+    # The stored FIT samples are indexed by the position of the samples in the test set
+    if isinstance(explainer, FITExplainer) and explainer.store_config is not None:
+        assert is_sequential(test_loader), 'The sample store requires a test loader that visits the test set in order'
+        # The stored samples are drawn with the seed of the store key
+        torch.manual_seed(args.sample_store_seed)
+    n_seen = 0
     for x, y in test_loader:
         model.train()
         model.to(device)
@@ -288,7 +314,12 @@ if __name__ == '__main__':
         y = y.to(device)
 
         t0 = time.time()
-        score = explainer.attribute(x, y if args.data=='mimic' else y[:, -1].long())
+        if isinstance(explainer, FITExplainer):
+            score = explainer.attribute(x, y if args.data=='mimic' else y[:, -1].long(),
+                                        sample_ids=np.arange(n_seen, n_seen + len(x)))
+        else:
+            score = explainer.attribute(x, y if args.data=='mimic' else y[:, -1].long())
+        n_seen += len(x)
 
         ranked_features = np.array([((-(score[n])).argsort(0).argsort(0) + 1) \
                                     for n in range(x.shape[0])])
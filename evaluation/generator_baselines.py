@@ -1,4 +1,5 @@
 from TSX.utils import load_data, load_simulated_data, load_ghg_data
+from TSX.loaders import dataset_signals
 from TSX.models import EncoderRNN
 from TSX.experiments import FeatureGeneratorExplainer
 from data_generator.true_generator_state_data import TrueFeatureGenerator
@@ -39,8 +40,8 @@ def main(data, generator_type, output_path, predictor_model):
                                                                               path='./data/simulated_data')
         feature_size = p_data.shape[1]
 
-    testset = list(exp.test_loader.dataset)
-    test_signals = torch.stack(([x[0] for x in testset])).to(device)
+    testset = exp.test_loader.dataset
+    test_signals = dataset_signals(testset).to(device)
 
     true_generator = TrueFeatureGenerator()
 
@@ -109,12 +109,12 @@ def main(experiment, train, user, data,n_features_to_use=3):
             elif data == 'simulation_spike':
                 p_data, train_loader, valid_loader, test_loader = load_simulated_data(batch_size=configs['batch_size'],
                                                                               path='./data_generator/data/simulated_data',data_type='spike',features=features)
-                feature_size = p_data.shape[1]
+                feature_size = len(features)
 
             elif data == 'simulation':
                 p_data, train_loader, valid_loader, test_loader = load_simulated_data(batch_size=configs['batch_size'],
                                                                               path='./data/simulated_data',features=features)
-                feature_size = p_data.shape[1]
+                feature_size = len(features)
 
             if data=='simulation_spike':
                 data='simulation'
@@ -150,12 +150,12 @@ def main(experiment, train, user, data,n_features_to_use=3):
             elif data == 'simulation_spike':
                 p_data, train_loader, valid_loader, test_loader = load_simulated_data(batch_size=configs['batch_size'],
                                                                               path='./data_generator/data/simulated_data',data_type='spike',features=features)
-                feature_size = p_data.shape[1]
+                feature_size = len(features)
 
             elif data == 'simulation':
                 p_data, train_loader, valid_loader, test_loader = load_simulated_data(batch_size=configs['batch_size'],
                                                                               path='./data/simulated_data',features=features)
-                feature_size = p_data.shape[1]
+                feature_size = len(features)
 
             if data=='simulation_spike':
                 data='simulation'
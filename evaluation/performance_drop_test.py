@@ -7,6 +7,8 @@ from sklearn import metrics
 import torch
 from TSX.models import StateClassifier, ConvClassifier, EncoderRNN, StateClassifierMIMIC, RETAIN
 from TSX.utils import load_data
+from TSX.array_store import load_array
+from TSX.loaders import dataset_signals, dataset_labels
 
 TOP_PATIENTS = [1534, 3734, 82, 3663, 3509, 870, 3305, 1484, 2604, 1672, 2733, 1057, 2599, 3319, 1239, 1671, 
 3095, 3783, 1935, 720, 1961, 3476, 262, 816, 2268, 723, 4469, 3818, 4126, 1575, 1526, 1457, 4542, 2015, 2512, 
@@ -62,8 +64,8 @@ def main(args):
     if args.data == 'mimic' or args.data=='mimic_int':
         p_data, train_loader, valid_loader, test_loader = load_data(batch_size=100, path=data_path,task=task,cv=0,train_pc=1.)
         feature_size = p_data.feature_size
-        x_test = torch.stack(([x[0] for x in list(test_loader.dataset)])).cpu().numpy()
-        y_test = torch.stack(([x[1] for x in list(test_loader.dataset)])).cpu().numpy()
+        x_test = dataset_signals(test_loader.dataset).cpu().numpy()
+        y_test = dataset_labels(test_loader.dataset).cpu().numpy()
         if args.explainer=='lime':
             x_test = x_test[:300]
             y_test = y_test[:300]
@@ -72,10 +74,8 @@ def main(args):
             file_name = 'state_dataset_'
         else:
             file_name = ''
-        with open(os.path.join(data_path, file_name + 'x_test.pkl'), 'rb') as f:
-            x_test = pkl.load(f)
-        with open(os.path.join(data_path, file_name +'y_test.pkl'), 'rb') as f:
-            y_test = pkl.load(f)
+        x_test = load_array(data_path, 'x_test', prefix=file_name)
+        y_test = load_array(data_path, 'y_test', prefix=file_name)
 
         ## Select patients with varying state
         # span = []
@@ -95,14 +95,15 @@ def main(args):
         # print([xx[1] for xx in span[0:300]])
         # top_patients = [xx[0] for xx in span[0:300]]
 
-    testset = list(test_loader.dataset)
+    testset = test_loader.dataset
     if args.percentile:
         top_patients = list(range(len(testset)))
     else:
         top_patients = TOP_PATIENTS
 
-    x_test = torch.stack(([x[0] for x_ind, x in enumerate(testset) if x_ind in top_patients])).cpu().numpy()
-    y_test = torch.stack(([x[1] for x_ind, x in enumerate(testset) if x_ind in top_patients])).cpu().numpy()
+    selected = torch.from_numpy(np.isin(np.arange(len(testset)), top_patients))
+    x_test = dataset_signals(testset)[selected].cpu().numpy()
+    y_test = dataset_labels(testset)[selected].cpu().numpy()
 
 
     # importance_path = '/scratch/gobi2/projects/tsx/new_results/%s' % args.data
@@ -138,11 +139,12 @@ def main(args):
         # print([xx[1] for xx in span[0:300]])
         # top_patients = [xx[0] for xx in span[0:300]]
 
-        testset = list(test_loader.dataset)
+        testset = test_loader.dataset
         if args.percentile:
             top_patients = list(range(len(testset)))
-        x_test = torch.stack(([x[0] for x_ind, x in enumerate(testset) if x_ind in top_patients])).cpu().numpy()
-        y_test = torch.stack(([x[1] for x_ind, x in enumerate(testset) if x_ind in top_patients])).cpu().numpy()
+        selected = torch.from_numpy(np.isin(np.arange(len(testset)), top_patients))
+        x_test = dataset_signals(testset)[selected].cpu().numpy()
+        y_test = dataset_labels(testset)[selected].cpu().numpy()
 
 
     # importance_path = '/scratch/gobi2/projects/tsx/new_results/%s' % args.data
@@ -228,7 +230,7 @@ def main(args):
 
         if args.subpop:
             span = []
-            testset = list(test_loader.dataset)
+            testset = test_loader.dataset
             for i,(signal,label) in enumerate(testset):
                model.to(device)
                model.eval()
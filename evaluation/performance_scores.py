@@ -1,6 +1,7 @@
 import os
 import numpy as np
 import pickle as pkl
+from TSX.array_store import load_array
 from sklearn import metrics
 import argparse
 
@@ -42,8 +43,7 @@ def main(args):
 
     score_path = '/scratch/gobi1/shalmali/TSX_results/new_results/%s' %(args.data)
     if data_type == 'state':
-        with open(os.path.join(data_path, 'state_dataset_importance_test.pkl'), 'rb') as f:
-            gt_importance_test = pkl.load(f)
+        gt_importance_test = load_array(data_path, 'importance_test', prefix='state_dataset_')
     elif data_type == 'spike':
         with open(os.path.join(data_path, 'gt_test.pkl'), 'rb') as f:
             gt_importance_test = pkl.load(f)
@@ -5,6 +5,8 @@ import torch
 import pickle as pkl
 import matplotlib.pyplot as plt
 from TSX.utils import load_data
+from TSX.array_store import load_array
+from TSX.loaders import dataset_signals, dataset_labels
 from TSX.models import StateClassifier, ConvClassifier, EncoderRNN, StateClassifierMIMIC, RETAIN
 
 plt.rcParams['axes.labelweight'] = 'bold'
@@ -497,17 +499,15 @@ if __name__ == '__main__':
     if args.data == 'mimic' or args.data=='mimic_int':
         p_data, _, _, test_loader = load_data(batch_size=100, path=data_path,task=task,cv=0,train_pc=1.)
         feature_size = p_data.feature_size
-        x_test = torch.stack(([x[0] for x in list(test_loader.dataset)])).cpu().numpy()
-        y_test = torch.stack(([x[1] for x in list(test_loader.dataset)])).cpu().numpy()
+        x_test = dataset_signals(test_loader.dataset).cpu().numpy()
+        y_test = dataset_labels(test_loader.dataset).cpu().numpy()
     else:
         if args.data=='simulation_l2x' or args.data=='simulation':
             file_name = 'state_dataset_'
         else:
             file_name = ''
-        with open(os.path.join(data_path, file_name + 'x_test.pkl'), 'rb') as f:
-            x_test = pkl.load(f)
-        with open(os.path.join(data_path, file_name +'y_test.pkl'), 'rb') as f:
-            y_test = pkl.load(f)
+        x_test = load_array(data_path, 'x_test', prefix=file_name)
+        y_test = load_array(data_path, 'y_test', prefix=file_name)
 
     if args.data=='simulation_spike':
         model = EncoderRNN(feature_size=feature_size, hidden_size=50, regres=True, return_all=False, data=args.data, rnn="GRU")
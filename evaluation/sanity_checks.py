@@ -1,4 +1,5 @@
 from TSX.utils import load_data, load_simulated_data, test_model_rt, train_model
+from TSX.loaders import dataset_signals
 from TSX.experiments import FeatureGeneratorExplainer, BaselineExplainer
 
 import torch
@@ -62,11 +63,10 @@ def main(args):
 
     if args.explainer == 'fit':
         generator = JointFeatureGenerator(feature_size, hidden_size=feature_size * 3, data=args.data)
-        generator.load_state_dict(torch.load(os.path.join('./ckpt/%s/%s.pt' % (args.data, 'joint_generator'))))
+        generator.load_state_dict(torch.load(os.path.join('./ckpt/%s/%s_%d.pt' % (args.data, 'joint_generator', args.cv))))
 
 
-    testset = [smpl[0] for smpl in test_loader.dataset]
-    samples = torch.stack([testset[sample] for sample in samples_to_analyze[args.data]])
+    samples = dataset_signals(test_loader.dataset)[samples_to_analyze[args.data]]
 
     model.load_state_dict(torch.load(os.path.join('./ckpt/%s/%s.pt' % (args.data, 'model'))))
     if args.explainer == 'fit':